@@ -0,0 +1,118 @@
+import os
+import random
+from loadtest.fake_services import property_rows
+from loadtest.payloads import encrypt_media
+
+# Message texts for the intent detector: short chat, long messages, Arabic, and scheduling requests.
+INTENT_MESSAGES = [
+    "hi",
+    "What is your commission?",
+    "Can I book a viewing tomorrow at 3pm?",
+    "I'd like to schedule a meeting on 12/05 in the afternoon",
+    "أبحث عن شقة بغرفتين في دبي مارينا بسعر أقل من مليوني درهم",
+    "show me villas below 5 million aed in dubai with a private pool and at least 4 bedrooms please",
+    ("I've been looking at a number of listings across Dubai Marina, JLT and Downtown and honestly I'm a bit lost. "
+     "My budget is flexible but ideally under 3 million, I need parking for two cars, and my kids' school is near "
+     "Al Barsha so the commute matters. What would you recommend, and is anything available to see on the 21st?"),
+]
+
+# Admin commands, as matched by the webhook before anything reaches the LLM.
+COMMAND_MESSAGES = [
+    "bot pause all",
+    "Bot resume all",
+    "bot pause 971500000000@s.whatsapp.net",
+    "bot start outreach https://docs.google.com/spreadsheets/d/1AbCdEfGhIjKlMnOp/edit",
+]
+
+# Scheduling requests for the local date/time rules (English and Arabic).
+DATETIME_MESSAGES = [
+    "Can I book a viewing tomorrow at 3pm?",
+    "schedule on 12/05 at 4:30 pm for 30 minutes",
+    "next Friday 19:00 please",
+    "ابي احجز معاينة بكرة الساعة ٥ العصر",
+    "موعد يوم الخميس الساعة 7 مساءً",
+]
+
+# Time given but a date the rules cannot resolve; they must defer to the next tier instead of assuming today.
+DATETIME_DEFERRED_MESSAGES = [
+    "in 3 days at 5pm",
+    "after 2 days at 4pm",
+    "on the weekend at 5pm",
+    "2-3pm tomorrow",
+    "بعد يومين الساعة 6 مساء",
+]
+# Abbreviated weekdays with a time, and the weekday (Monday = 0) the rules must resolve them to.
+DATETIME_WEEKDAY_MESSAGES = [
+    ("sat at 5pm", 5),
+    ("Can I come 5pm on Thur?", 3),
+]
+# Scheduling words next to property vocabulary; the router must send these to the property search.
+ROUTING_PROPERTY_MESSAGES = [
+    "I want to book a 3 bedroom apartment in Dubai Marina",
+    "Can I visit some villas under 2 million?",
+    "ابي احجز معاينة شقة بغرفتين",
+]
+
+def property_frame(rows: int, seed: int = 7):
+    """
+    A cleaned property DataFrame of the given size, built the same way get_sheet_data builds one.
+    """
+    from property_handler import records_to_dataframe
+    header, *values = property_rows(rows, seed)
+    return records_to_dataframe([dict(zip(header, row)) for row in values])
+
+
+def mixed_property_frames() -> list:
+    """
+    Property pages whose columns do not all hold strings: the sheet frame, a page with missing values,
+    numbers and non-URL text in the image columns, and the same page after a cursor round trip.
+    """
+    import json
+    import numpy as np
+    import pandas as pd
+    from property_handler import CONTEXT_COLUMNS
+    sheet = property_frame(20)
+    odd = pd.DataFrame({
+        'Title': ['Villa', None, 'Studio', 'Flat 7', np.nan],
+        'area': ['JVC', 'Downtown', np.nan, 'Marina', ''],
+        'city': ['Dubai'] * 5,
+        'emirate': ['Dubai'] * 5,
+        'Price_AED': [1_500_000.0, np.nan, 0.1 + 0.2, 2e20, 3.0],
+        'Bedrooms': pd.Series([3, 'two', None, 1.5, 0], dtype=object),
+        'Description': ['Nice', '', None, 'x' * 40, 'Sea view'],
+        'img1': ['http://x/1.jpg', None, np.nan, 'ftp://x/2.jpg', 'https://x/3.png'],
+        'img2': pd.Series([1, 2, 3, 4, 5], dtype=object), # Numbers only
+        'img3': ['', 'no image', 'http://x/4.jpg', 7, None],
+    })
+    cursor_page = pd.DataFrame.from_records(json.loads(odd.to_json(orient='records')), columns=CONTEXT_COLUMNS).fillna('')
+    return [sheet, sheet[CONTEXT_COLUMNS].astype(object), odd, odd.astype(object), cursor_page]
+
+
+def property_filters():
+    return {
+        'Price_AED': {'operator': '<', 'value': 3_000_000},
+        'Bedrooms': {'operator': '=', 'value': 2},
+        'city': {'operator': '=', 'value': 'dubai'},
+    }
+
+
+def encrypted_media(size_bytes: int, media_type: str = 'image'):
+    """
+    Returns (encrypted_bytes, media_key_b64) for random media of the given size.
+    """
+    return encrypt_media(os.urandom(size_bytes), media_type)
+
+
+def history(messages: int, seed: int = 3) -> list:
+    rng = random.Random(seed)
+    words = "apartment villa marina budget viewing bedroom price downtown available tomorrow payment plan".split()
+    turns = []
+    for i in range(messages):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(8, 60)))
+        turns.append({'role': 'user' if i % 2 == 0 else 'model', 'parts': [text]})
+    return turns
+
+
+def long_reply(lines: int, seed: int = 5) -> str:
+    rng = random.Random(seed)
+    return "\n".join("Line %d: %s" % (i, " ".join("word" for _ in range(rng.randint(3, 40)))) for i in range(lines))
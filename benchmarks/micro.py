@@ -0,0 +1,309 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import fixtures # noqa: E402
+
+DEFAULT_BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+# Each repeat runs the benchmark for at least this long; the reported time is per call.
+MIN_REPEAT_SECONDS = 0.2
+REPEATS = 5
+
+_BENCHMARKS = []
+
+
+# --- Registry ---
+def benchmark(name: str, params=(None,), quick=(None,)):
+    """
+    Registers a setup function. It is called once per parameter with that parameter and must return a
+    zero-argument callable to time. `quick` lists the parameters run with --quick.
+    """
+    def register(setup):
+        for param in params:
+            full_name = name if param is None else f"{name}[{param}]"
+            _BENCHMARKS.append((full_name, setup, param, param in quick))
+        return setup
+    return register
+
+
+def _script():
+    # Imported lazily: importing script.py starts the component initializers (which give up quickly
+    # without credentials) and creates its working files in the current directory.
+    import script
+    return script
+
+
+# --- Benchmarks ---
+@benchmark('split_message', params=('short', 'long'), quick=('short',))
+def bench_split_message(size):
+    split_message = _script().split_message
+    text = fixtures.long_reply(4 if size == 'short' else 400)
+    return lambda: split_message(text)
+
+@benchmark('detect_scheduling_intent')
+def bench_detect_scheduling_intent(_):
+    detect = _script().detect_scheduling_intent
+    messages = fixtures.INTENT_MESSAGES
+    def run():
+        for message in messages:
+            detect(message)
+    return run
+
+@benchmark('route_message', params=('router', 'legacy'), quick=('router', 'legacy'))
+def bench_route_message(implementation):
+    from intent_router import route_message
+    if implementation == 'router':
+        check_route_message()
+    route = route_message if implementation == 'router' else legacy_route_message
+    messages = fixtures.COMMAND_MESSAGES + fixtures.INTENT_MESSAGES + fixtures.DATETIME_MESSAGES
+    def run():
+        for message in messages:
+            route(message)
+    return run
+
+@benchmark('parse_datetime_rules')
+def bench_parse_datetime_rules(_):
+    import pytz
+    from datetime import datetime
+    from datetime_extractor import parse_datetime_rules
+    now = datetime.now(pytz.timezone('Asia/Dubai'))
+    check_datetime_rules(now)
+    messages = fixtures.INTENT_MESSAGES + fixtures.DATETIME_MESSAGES
+    def run():
+        for message in messages:
+            parse_datetime_rules(message, now)
+    return run
+
+@benchmark('filter_properties', params=(1_000, 10_000, 100_000), quick=(1_000,))
+def bench_filter_properties(rows):
+    import property_handler
+    logging.getLogger().setLevel(logging.WARNING)
+    df = fixtures.property_frame(rows)
+    filters = fixtures.property_filters()
+    return lambda: property_handler.filter_properties(df, filters)
+
+@benchmark('build_property_context', params=(5, 50), quick=(5,))
+def bench_build_property_context(limit):
+    import property_handler
+    check_property_context()
+    df = fixtures.property_frame(1_000)
+    return lambda: property_handler.build_property_context(df, limit)
+
+@benchmark('decrypt_media', params=('1MB', '16MB'), quick=('1MB',))
+def bench_decrypt_media(size):
+    import media_handler
+    logging.getLogger().setLevel(logging.WARNING)
+    encrypted, media_key_b64 = fixtures.encrypted_media((1 if size == '1MB' else 16) * 1024 * 1024)
+    return lambda: media_handler.decrypt_media(encrypted, media_key_b64, 'image')
+
+@benchmark('history_save_load', params=(12, 200, 2_000), quick=(12,))
+def bench_history_save_load(messages):
+    script = _script()
+    logging.getLogger().setLevel(logging.WARNING)
+    turns = fixtures.history(messages)
+    def run():
+        script.save_history('benchmark_user', turns)
+        script.load_history('benchmark_user')
+    return run
+
+
+# --- Reference Implementations ---
+def legacy_route_message(message):
+    """
+    The webhook's command checks and detect_scheduling_intent as they were before intent_router.py,
+    kept so the route_message benchmark compares against them.
+    """
+    normalized_body = message.lower().strip()
+    if normalized_body in ("bot pause all", "bot resume all", "bot start outreach"):
+        return normalized_body
+    for prefix in ("bot pause ", "bot resume ", "bot start outreach "):
+        if normalized_body.startswith(prefix):
+            return normalized_body.split(prefix, 1)[1].strip()
+
+    scheduling_keywords = [
+        'appointment', 'schedule', 'book', 'booking', 'meeting', 'consultation',
+        'reserve', 'reservation', 'visit', 'session', 'call', 'meet'
+    ]
+    time_indicators = [
+        'today', 'tomorrow', 'next week', 'monday', 'tuesday', 'wednesday', 'thursday',
+        'friday', 'saturday', 'sunday', 'am', 'pm', 'morning', 'afternoon', 'evening',
+        'at', 'on', 'o\'clock', ':', 'time'
+    ]
+    message_lower = message.lower()
+    has_scheduling_keyword = any(keyword in message_lower for keyword in scheduling_keywords)
+    has_time_indicator = any(indicator in message_lower for indicator in time_indicators)
+    date_patterns = [
+        r'\d{1,2}[/-]\d{1,2}',
+        r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}',
+        r'\b\d{1,2}(st|nd|rd|th)\b',
+    ]
+    has_date_pattern = any(re.search(pattern, message_lower) for pattern in date_patterns)
+    return has_scheduling_keyword or (has_time_indicator and has_date_pattern)
+
+
+def legacy_build_property_context(df, limit):
+    """
+    The iterrows renderer build_property_context replaced (without the paging note).
+    """
+    context_str = "Relevant Information Found:\n"
+    for _, prop in df.head(limit).iterrows():
+        context_str += (
+            f"Title: {prop['Title']}\n"
+            f"Location: {prop['area']}, {prop['city']}, {prop['emirate']}\n"
+            f"Price: {prop['Price_AED']} AED\n"
+            f"Bedrooms: {prop['Bedrooms']}\n"
+            f"Description: {prop['Description']}\n"
+        )
+        for img_col in ['img1', 'img2', 'img3']:
+            if prop[img_col] and isinstance(prop[img_col], str) and prop[img_col].startswith('http'):
+                context_str += f"[ACTION_SEND_IMAGE_VIA_URL]\n{prop[img_col]}\n{prop['Title']}\n"
+        context_str += "---\n"
+    return context_str
+
+def check_property_context():
+    """
+    Raises AssertionError unless build_property_context renders fixtures.mixed_property_frames()
+    exactly like the iterrows renderer, so a faster version cannot silently change the prompt.
+    """
+    import property_handler
+    for i, df in enumerate(fixtures.mixed_property_frames()):
+        expected = legacy_build_property_context(df, len(df))
+        actual = property_handler.build_property_context(df, len(df))
+        assert actual == expected, f"build_property_context differs from the iterrows renderer on mixed frame {i}:\n{actual!r}\n!=\n{expected!r}"
+
+
+def check_datetime_rules(now):
+    """
+    Raises AssertionError if the rules accept a guessed date for fixtures.DATETIME_DEFERRED_MESSAGES
+    or resolve fixtures.DATETIME_WEEKDAY_MESSAGES to the wrong day.
+    """
+    from datetime import date
+    from datetime_extractor import parse_datetime_rules, DATETIME_LOCAL_MIN_CONFIDENCE
+    for message in fixtures.DATETIME_DEFERRED_MESSAGES:
+        result = parse_datetime_rules(message, now)
+        assert result['confidence'] < DATETIME_LOCAL_MIN_CONFIDENCE, f"Rules should defer {message!r} to the next tier: {result}"
+    for message, weekday in fixtures.DATETIME_WEEKDAY_MESSAGES:
+        result = parse_datetime_rules(message, now)
+        assert result['confidence'] >= DATETIME_LOCAL_MIN_CONFIDENCE and date.fromisoformat(result['date']).weekday() == weekday, \
+            f"Rules should resolve {message!r} to weekday {weekday}: {result}"
+
+
+def check_route_message():
+    """
+    Raises AssertionError unless fixtures.ROUTING_PROPERTY_MESSAGES route to the property search, which
+    the skipped query analysis for scheduling would otherwise leave without a sheet search.
+    """
+    from intent_router import route_message, INTENT_PROPERTY_SEARCH
+    for message in fixtures.ROUTING_PROPERTY_MESSAGES:
+        route = route_message(message)
+        assert route['intent'] == INTENT_PROPERTY_SEARCH, f"{message!r} should route to the property search: {route}"
+
+
+# --- Timing ---
+def measure(function) -> dict:
+    """
+    Calibrates a loop count so one repeat takes at least MIN_REPEAT_SECONDS, then times REPEATS repeats.
+    """
+    function() # Warm-up (imports, caches)
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_REPEAT_SECONDS:
+            break
+        loops = max(loops * 2, int(loops * MIN_REPEAT_SECONDS / max(elapsed, 1e-9)))
+    per_call = [elapsed / loops]
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        per_call.append((time.perf_counter() - start) / loops)
+    return {'loops': loops, 'min_s': min(per_call), 'median_s': statistics.median(per_call), 'stdev_s': statistics.pstdev(per_call)}
+
+def _format_seconds(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+# --- Baseline ---
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns (name, baseline_median, current_median, change) for benchmarks slower than the baseline
+    by more than threshold (a fraction). Medians are compared, so one noisy repeat does not fail a run.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        change = result['median_s'] / previous['median_s'] - 1
+        if change > threshold:
+            regressions.append((name, previous['median_s'], result['median_s'], change))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for CPU-bound hot paths.")
+    parser.add_argument('-k', '--filter', default='', help="Only run benchmarks whose name contains this text.")
+    parser.add_argument('--quick', action='store_true', help="Only the smallest size of each benchmark.")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="Baseline JSON file.")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the baseline.")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed slowdown versus the baseline (fraction).")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this file.")
+    args = parser.parse_args(argv)
+    # Resolved before the chdir below, so relative paths mean the caller's directory.
+    args.baseline = os.path.abspath(args.baseline)
+    args.json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    selected = [(name, setup, param) for name, setup, param, is_quick in _BENCHMARKS
+                if args.filter in name and (is_quick or not args.quick)]
+    # Keep script.py's conversation and state files out of the repository.
+    os.chdir(tempfile.mkdtemp(prefix="benchmarks-"))
+
+    results = {}
+    for name, setup, param in selected:
+        function = setup(param)
+        results[name] = measure(function)
+        result = results[name]
+        print(f"{name:<36} median {_format_seconds(result['median_s']):>10}   min {_format_seconds(result['min_s']):>10}   ({result['loops']} loops x {REPEATS})", flush=True)
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if baseline.get('machine') != platform.node():
+            print(f"Note: baseline was recorded on '{baseline.get('machine')}'; timings across machines are not comparable.")
+        for name, previous, current, change in regressions:
+            print(f"REGRESSION {name}: {_format_seconds(previous)} -> {_format_seconds(current)} ({change:+.0%})")
+        status = 1 if regressions else 0
+        if not regressions:
+            print(f"No benchmark is more than {args.threshold:.0%} slower than the baseline.")
+
+    report = {'machine': platform.node(), 'python': platform.python_version(), 'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}.")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import os
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+import pytz
+from googleapiclient.errors import HttpError
+from metrics import timed, record_cache_lookup
+
+# --- Configuration ---
+# How often the background thread pulls calendar changes (incremental sync with a sync token).
+CALENDAR_SYNC_INTERVAL_SECONDS = float(os.getenv('CALENDAR_SYNC_INTERVAL_SECONDS', 60))
+# A full sync loads events that end after now minus this many days; older ones never matter for booking.
+CALENDAR_SYNC_LOOKBACK_DAYS = int(os.getenv('CALENDAR_SYNC_LOOKBACK_DAYS', 1))
+# If the last successful sync is older than this (e.g. the API keeps failing), availability checks
+# stop trusting the cache and query the Calendar API directly.
+CALENDAR_CACHE_MAX_STALENESS_SECONDS = float(os.getenv('CALENDAR_CACHE_MAX_STALENESS_SECONDS', 600))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Interval Index ---
+class BusyIntervals:
+    """
+    Busy intervals (UTC epoch seconds) keyed by event ID. Queries run on arrays sorted by start time plus
+    a running maximum of end times, rebuilt lazily after changes: "does this window overlap anything" is
+    one bisect, and listing the overlaps only visits intervals that can overlap.
+    """
+    def __init__(self):
+        self._events = {}
+        self._index = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def set(self, event_id: str, start: float, end: float):
+        self._events[event_id] = (start, end)
+        self._index = None
+
+    def discard(self, event_id: str):
+        if self._events.pop(event_id, None) is not None:
+            self._index = None
+
+    def _build(self):
+        intervals = sorted(self._events.values())
+        max_ends, running = [], float('-inf')
+        for _, end in intervals:
+            running = max(running, end)
+            max_ends.append(running)
+        self._index = (intervals, [start for start, _ in intervals], max_ends)
+        return self._index
+
+    def overlaps(self, start: float, end: float) -> bool:
+        _, starts, max_ends = self._index or self._build()
+        before_end = bisect.bisect_left(starts, end) # Intervals that start before the window ends
+        return before_end > 0 and max_ends[before_end - 1] > start
+
+    def overlapping(self, start: float, end: float) -> list:
+        """
+        (start, end) pairs overlapping the window, sorted by start.
+        """
+        intervals, starts, max_ends = self._index or self._build()
+        before_end = bisect.bisect_left(starts, end)
+        first_candidate = bisect.bisect_right(max_ends, start)
+        return [interval for interval in intervals[first_candidate:before_end] if interval[1] > start]
+
+
+def event_bounds(item: dict, calendar_timezone):
+    """
+    Start and end of a Calendar event as UTC epoch seconds. All-day events use the calendar's timezone.
+    """
+    bounds = []
+    for key in ('start', 'end'):
+        value = item.get(key) or {}
+        if value.get('dateTime'):
+            bounds.append(datetime.fromisoformat(value['dateTime'].replace('Z', '+00:00')).timestamp())
+        elif value.get('date'):
+            bounds.append(calendar_timezone.localize(datetime.strptime(value['date'], '%Y-%m-%d')).timestamp())
+        else:
+            return None
+    return tuple(bounds)
+
+
+# --- Free/Busy Cache ---
+class FreeBusyCache:
+    """
+    A local copy of a calendar's events for availability checks. A full sync loads upcoming events and
+    yields a sync token; afterwards a background thread fetches only changes (new, moved and cancelled
+    events) every CALENDAR_SYNC_INTERVAL_SECONDS. API calls go through a CalendarClient, which lends
+    each sync a pooled service.
+    """
+    def __init__(self, client, sync_interval: float = CALENDAR_SYNC_INTERVAL_SECONDS):
+        self.client = client
+        self.calendar_id = client.calendar_id
+        self.sync_interval = sync_interval
+        self._busy = BusyIntervals()
+        self._lock = threading.Lock() # Guards _busy
+        self._sync_lock = threading.Lock() # One sync at a time
+        self._sync_token = None
+        self._calendar_timezone = pytz.UTC
+        self.synced_at = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Runs the initial full sync (raising if it fails) and starts the background sync thread.
+        """
+        self.sync()
+        threading.Thread(target=self._run, name="calendar-sync", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logging.error(f"Calendar sync failed; availability checks keep using the cache until it is stale: {e}")
+
+    # --- Sync ---
+    def _list(self, service, **params):
+        """
+        Fetches every page of events().list. Returns (items, next_sync_token).
+        """
+        items, page_token = [], None
+        while True:
+            with timed('calendar_sync'):
+                result = service.events().list(calendarId=self.calendar_id, singleEvents=True, maxResults=2500, pageToken=page_token, **params).execute()
+            if result.get('timeZone'):
+                self._calendar_timezone = pytz.timezone(result['timeZone'])
+            items.extend(result.get('items', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return items, result.get('nextSyncToken')
+
+    def _apply(self, busy: BusyIntervals, item: dict):
+        if item.get('status') == 'cancelled':
+            busy.discard(item['id'])
+            return
+        bounds = event_bounds(item, self._calendar_timezone)
+        if bounds:
+            busy.set(item['id'], *bounds)
+
+    def sync(self):
+        """
+        Brings the cache up to date: incremental when a sync token is held, otherwise (or when Google
+        has expired the token) a full reload.
+        """
+        with self._sync_lock, self.client.service() as service:
+            if self._sync_token:
+                try:
+                    items, token = self._list(service, syncToken=self._sync_token)
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    logging.info("Calendar sync token expired; running a full sync.")
+                else:
+                    with self._lock:
+                        for item in items:
+                            self._apply(self._busy, item)
+                    self._sync_token, self.synced_at = token, time.monotonic()
+                    if items:
+                        logging.info(f"Calendar sync applied {len(items)} change(s); {len(self._busy)} event(s) cached.")
+                    return
+
+            time_min = datetime.now(pytz.UTC) - timedelta(days=CALENDAR_SYNC_LOOKBACK_DAYS)
+            items, token = self._list(service, timeMin=time_min.isoformat())
+            busy = BusyIntervals()
+            for item in items:
+                self._apply(busy, item)
+            with self._lock:
+                self._busy = busy
+            self._sync_token, self.synced_at = token, time.monotonic()
+            logging.info(f"Calendar full sync loaded {len(busy)} event(s) from '{self.calendar_id}'.")
+
+    # --- Queries ---
+    def is_fresh(self) -> bool:
+        return self.synced_at is not None and time.monotonic() - self.synced_at < CALENDAR_CACHE_MAX_STALENESS_SECONDS
+
+    def is_free(self, start: datetime, end: datetime):
+        """
+        True/False from the local cache for timezone-aware datetimes, or None if the cache is too stale
+        to answer (the caller then asks the API).
+        """
+        fresh = self.is_fresh()
+        record_cache_lookup('calendar_freebusy', fresh)
+        if not fresh:
+            return None
+        with self._lock:
+            return not self._busy.overlaps(start.timestamp(), end.timestamp())
+
+    def busy_between(self, start: datetime, end: datetime) -> list:
+        """
+        Busy (start, end) UTC datetimes overlapping the window, sorted by start.
+        """
+        with self._lock:
+            intervals = self._busy.overlapping(start.timestamp(), end.timestamp())
+        return [(datetime.fromtimestamp(s, pytz.UTC), datetime.fromtimestamp(e, pytz.UTC)) for s, e in intervals]
+
+    def confirm_free(self, start: datetime, end: datetime) -> bool:
+        """
+        Final conflict check right before an insert: pulls the latest changes, then checks locally.
+        Raises if the sync fails, so the caller can fall back to a direct query.
+        """
+        self.sync()
+        with self._lock:
+            return not self._busy.overlaps(start.timestamp(), end.timestamp())
+
+    def add_event(self, event: dict):
+        """
+        Records an event this process just created, so it blocks its slot before the next sync.
+        """
+        with self._lock:
+            self._apply(self._busy, event)
@@ -0,0 +1,146 @@
+import os
+import json
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from metrics import timed
+
+# --- Configuration ---
+CALENDAR_SCOPES = ['https://www.googleapis.com/auth/calendar']
+# Calendar that appointments are checked against and booked into, by both script.py and calendar_handler.py.
+GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID', 'mohomer12@gmail.com')
+# Service account key: the JSON content (preferred) or the path of a key file.
+GOOGLE_CALENDAR_CREDENTIALS = os.getenv('GOOGLE_CALENDAR_CREDENTIALS')
+GOOGLE_APPLICATION_CREDENTIALS = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+# Idle Calendar services kept for reuse. More are built when every pooled one is checked out;
+# those beyond this number are dropped when returned.
+CALENDAR_POOL_SIZE = int(os.getenv('CALENDAR_POOL_SIZE', 4))
+# Calls per batch request. The Calendar API rejects batches of more than 50.
+CALENDAR_BATCH_SIZE = min(int(os.getenv('CALENDAR_BATCH_SIZE', 50)), 50)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def load_credentials():
+    """
+    Service account credentials from GOOGLE_CALENDAR_CREDENTIALS (JSON) or, failing that, the key file
+    named by GOOGLE_APPLICATION_CREDENTIALS. Returns None if neither is set.
+    """
+    if GOOGLE_CALENDAR_CREDENTIALS:
+        return service_account.Credentials.from_service_account_info(json.loads(GOOGLE_CALENDAR_CREDENTIALS), scopes=CALENDAR_SCOPES)
+    if GOOGLE_APPLICATION_CREDENTIALS:
+        return service_account.Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS, scopes=CALENDAR_SCOPES)
+    logging.error("Neither GOOGLE_CALENDAR_CREDENTIALS nor GOOGLE_APPLICATION_CREDENTIALS is set.")
+    return None
+
+
+# --- Client ---
+class CalendarClient:
+    """
+    Google Calendar access for one calendar. The credentials are loaded once and their access token is
+    shared; services are built on demand and reused through a pool. A googleapiclient service (its
+    httplib2 connection) must not be used by two threads at once, so callers check one out with
+    `with client.service() as service:` and it goes back to the pool afterwards.
+    """
+    def __init__(self, credentials, calendar_id: str = GOOGLE_CALENDAR_ID, pool_size: int = CALENDAR_POOL_SIZE):
+        self.credentials = credentials
+        self.calendar_id = calendar_id
+        self._idle = queue.LifoQueue(maxsize=pool_size) # Most recently used first: its connection is likeliest to be open
+
+    def _build(self):
+        with timed('calendar_service_build'):
+            return build('calendar', 'v3', credentials=self.credentials, cache_discovery=False)
+
+    @contextmanager
+    def service(self):
+        try:
+            service = self._idle.get_nowait()
+        except queue.Empty:
+            service = self._build()
+        try:
+            yield service
+        finally:
+            try:
+                self._idle.put_nowait(service)
+            except queue.Full:
+                pass
+
+    def warm(self, count: int = 1):
+        """
+        Builds services ahead of the first request, so it does not pay for construction.
+        """
+        services = [self._build() for _ in range(min(count, self._idle.maxsize))]
+        for service in services:
+            try:
+                self._idle.put_nowait(service)
+            except queue.Full:
+                break
+        return self
+
+    # --- Single Calls ---
+    def insert_event(self, body: dict) -> dict:
+        with self.service() as service, timed('calendar_insert'):
+            return service.events().insert(calendarId=self.calendar_id, body=body).execute()
+
+    def get_event(self, event_id: str) -> dict:
+        with self.service() as service, timed('calendar_readback'):
+            return service.events().get(calendarId=self.calendar_id, eventId=event_id).execute()
+
+    def list_events(self, stage: str = 'calendar_availability', **params) -> dict:
+        with self.service() as service, timed(stage):
+            return service.events().list(calendarId=self.calendar_id, **params).execute()
+
+    # --- Batched Calls ---
+    def batch(self, make_requests, stage: str = 'calendar_batch') -> list:
+        """
+        Sends many calls in as few HTTP round trips as possible. make_requests(service) returns a list
+        of unexecuted requests built from that service; they go out CALENDAR_BATCH_SIZE at a time as
+        BatchHttpRequests. Returns one (response, exception) pair per request, in order; a failed call
+        does not fail the others.
+        """
+        with self.service() as service:
+            requests = make_requests(service)
+            results = [None] * len(requests)
+
+            def collect(request_id, response, exception):
+                results[int(request_id)] = (response, exception)
+
+            for offset in range(0, len(requests), CALENDAR_BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=collect)
+                for i, request in enumerate(requests[offset:offset + CALENDAR_BATCH_SIZE], start=offset):
+                    batch.add(request, request_id=str(i))
+                with timed(stage):
+                    batch.execute()
+        return results
+
+    def insert_events(self, bodies: list) -> list:
+        return self.batch(lambda service: [service.events().insert(calendarId=self.calendar_id, body=body) for body in bodies])
+
+    def get_events(self, event_ids: list) -> list:
+        return self.batch(lambda service: [service.events().get(calendarId=self.calendar_id, eventId=event_id) for event_id in event_ids])
+
+    def delete_events(self, event_ids: list) -> list:
+        return self.batch(lambda service: [service.events().delete(calendarId=self.calendar_id, eventId=event_id) for event_id in event_ids])
+
+
+def get_calendar_client():
+    """
+    The process-wide CalendarClient, created on first use with one service built up front. Returns
+    None (and retries on the next call) if credentials are missing or invalid.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            try:
+                credentials = load_credentials()
+                if credentials is not None:
+                    _client = CalendarClient(credentials).warm()
+            except Exception as e:
+                logging.error(f"Error initializing calendar client: {e}")
+        return _client
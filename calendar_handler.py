@@ -1,9 +1,9 @@
 import os
+import json
 from datetime import datetime, timedelta
 import dateparser
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import pytz # Added for timezone definitions
+from calendar_client import get_calendar_client, GOOGLE_CALENDAR_ID
 
 # --- Timezone Configuration (to align with main script's workaround) ---
 # Timezone for user interaction and display (if this script were to do that)
@@ -12,29 +12,13 @@ import pytz # Added for timezone definitions
 EVENT_STORAGE_TIMEZONE = pytz.timezone('America/New_York')
 # --- End Timezone Configuration ---
 
-# Load credentials path from environment variables
-CREDENTIALS_PATH = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-# Using 'primary' calendar for consistency with the main script's approach.
-# If a specific CALENDAR_ID is needed, set it via os.getenv('GOOGLE_CALENDAR_ID')
-# and ensure it's the correct target.
-CALENDAR_ID_TO_USE = 'primary' 
-# CALENDAR_ID_TO_USE = os.getenv('GOOGLE_CALENDAR_ID', 'primary') # Alternative if env var is preferred
+# Credentials and the calendar ID (GOOGLE_CALENDAR_ID) come from calendar_client.py, so this handler
+# books into the same calendar as the main script and reuses its pooled services.
+CALENDAR_ID_TO_USE = GOOGLE_CALENDAR_ID
 
 def get_calendar_service():
-    """Initialize and return the Google Calendar API service."""
-    try:
-        if not CREDENTIALS_PATH:
-            print("Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set.")
-            return None
-        credentials = service_account.Credentials.from_service_account_file(
-            CREDENTIALS_PATH,
-            scopes=['https://www.googleapis.com/auth/calendar']
-        )
-        service = build('calendar', 'v3', credentials=credentials)
-        return service
-    except Exception as e:
-        print(f"Error initializing calendar service: {e}")
-        return None
+    """Return the shared, pooled Google Calendar client (None if credentials are missing)."""
+    return get_calendar_client()
 
 def create_appointment(summary, start_time_str_event_tz, user_phone, duration_minutes=60):
     """
@@ -52,8 +36,8 @@ def create_appointment(summary, start_time_str_event_tz, user_phone, duration_mi
         str: HTML link to the created event if successful, None otherwise.
     """
     try:
-        service = get_calendar_service()
-        if not service:
+        client = get_calendar_service()
+        if not client:
             return None
 
         # Parse the start time. datetime.fromisoformat will correctly handle
@@ -88,13 +72,13 @@ def create_appointment(summary, start_time_str_event_tz, user_phone, duration_mi
 
         print(f"Calendar_handler: Creating calendar event with payload: {json.dumps(event_body, indent=2)}")
         # Insert the event
-        created_event = service.events().insert(calendarId=CALENDAR_ID_TO_USE, body=event_body).execute()
+        created_event = client.insert_event(event_body)
         
         print(f"Calendar_handler: Event created. Link: {created_event.get('htmlLink')}, ID: {created_event.get('id')}")
         # === Optional Diagnostic: Fetch event by ID (similar to main script) ===
         # if created_event and created_event.get('id'):
         #     try:
-        #         retrieved_event = service.events().get(calendarId=CALENDAR_ID_TO_USE, eventId=created_event.get('id')).execute()
+        #         retrieved_event = client.get_event(created_event.get('id'))
         #         print(f"Calendar_handler DIAGNOSTIC: Successfully retrieved event by ID. Summary: {retrieved_event.get('summary')}")
         #     except Exception as e_get_diag:
         #         print(f"Calendar_handler DIAGNOSTIC ERROR: Failed to retrieve event by ID. Error: {e_get_diag}")
@@ -141,7 +125,7 @@ def parse_human_datetime(text):
 if __name__ == '__main__':
     print("Testing calendar_handler.py...")
     
-    # This test assumes GOOGLE_APPLICATION_CREDENTIALS is set.
+    # This test assumes GOOGLE_CALENDAR_CREDENTIALS or GOOGLE_APPLICATION_CREDENTIALS is set.
     
     # 1. Test parse_human_datetime
     raw_time_text = "tomorrow 3pm"
@@ -162,15 +146,15 @@ if __name__ == '__main__':
         event_summary = "Test Appointment via Handler (Stored NY)"
         user_phone_example = "1234567890"
         
-        # Ensure GOOGLE_APPLICATION_CREDENTIALS is set in your environment to run this test
-        if os.getenv('GOOGLE_APPLICATION_CREDENTIALS'):
+        # Ensure calendar credentials are set in your environment to run this test
+        if os.getenv('GOOGLE_CALENDAR_CREDENTIALS') or os.getenv('GOOGLE_APPLICATION_CREDENTIALS'):
             html_link = create_appointment(event_summary, start_iso_for_handler, user_phone_example, duration_minutes=45)
             if html_link:
                 print(f"Successfully created test appointment. Link: {html_link}")
             else:
                 print("Failed to create test appointment via handler.")
         else:
-            print("Skipping create_appointment test as GOOGLE_APPLICATION_CREDENTIALS is not set.")
+            print("Skipping create_appointment test as no calendar credentials are set.")
             
     else:
         print(f"Could not parse '{raw_time_text}'")
@@ -0,0 +1,339 @@
+import os
+import re
+import time
+import logging
+from datetime import datetime, timedelta
+from metrics import timed, record_datetime_extraction
+
+# --- Configuration ---
+# Local results at or above this confidence are used as-is; anything less goes to the next tier.
+DATETIME_LOCAL_MIN_CONFIDENCE = float(os.getenv('DATETIME_LOCAL_MIN_CONFIDENCE', 0.8))
+# Try dateparser (if installed) between the rules and the LLM.
+DATETIME_DATEPARSER_TIER = os.getenv('DATETIME_DATEPARSER_TIER', 'true').lower() == 'true'
+# Until an LLM extraction has been timed in this process, the time saved by a local result is
+# estimated with this LLM latency.
+DATETIME_LLM_LATENCY_ESTIMATE_SECONDS = float(os.getenv('DATETIME_LLM_LATENCY_ESTIMATE_SECONDS', 1.5))
+
+TIER_RULES = 'rules'
+TIER_DATEPARSER = 'dateparser'
+TIER_LLM = 'llm'
+
+DEFAULT_DURATION_MINUTES = 60
+DEFAULT_SERVICE_TYPE = "General Consultation"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Normalization ---
+# One translation table: Arabic-Indic digits, letter variants, and harakat, tanween and tatweel (removed).
+ARABIC_FOLDING = str.maketrans({
+    **dict(zip('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')),
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ة': 'ه', 'ى': 'ي',
+    **dict.fromkeys([chr(code) for code in range(0x064B, 0x0653)] + ['ـ']),
+})
+
+def normalize(text: str) -> str:
+    """
+    Lowercases, converts Arabic-Indic digits and folds Arabic letter variants and diacritics, so the
+    patterns below only need one spelling of each word.
+    """
+    if not text.isascii():
+        text = text.translate(ARABIC_FOLDING)
+    return " ".join(text.lower().split())
+
+
+# --- Vocabulary (normalized spellings) ---
+MONTHS = {
+    'january': 1, 'jan': 1, 'february': 2, 'feb': 2, 'march': 3, 'mar': 3, 'april': 4, 'apr': 4, 'may': 5,
+    'june': 6, 'jun': 6, 'july': 7, 'jul': 7, 'august': 8, 'aug': 8, 'september': 9, 'sep': 9, 'sept': 9,
+    'october': 10, 'oct': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12,
+    'يناير': 1, 'فبراير': 2, 'مارس': 3, 'ابريل': 4, 'مايو': 5, 'يونيو': 6, 'يوليو': 7, 'اغسطس': 8,
+    'سبتمبر': 9, 'اكتوبر': 10, 'نوفمبر': 11, 'ديسمبر': 12,
+}
+WEEKDAYS = {
+    'monday': 0, 'mon': 0, 'tuesday': 1, 'tue': 1, 'tues': 1, 'wednesday': 2, 'wed': 2, 'thursday': 3, 'thu': 3,
+    'thur': 3, 'thurs': 3, 'friday': 4, 'fri': 4, 'saturday': 5, 'sat': 5, 'sunday': 6, 'sun': 6,
+    'الاثنين': 0, 'الاتنين': 0, 'الثلاثاء': 1, 'الاربعاء': 2, 'الخميس': 3, 'الجمعه': 4, 'السبت': 5, 'الاحد': 6,
+}
+RELATIVE_DAYS = [ # Longest phrases first
+    ('day after tomorrow', 2), ('بعد بكره', 2), ('بعد باكر', 2), ('بعد غد', 2),
+    ('tomorrow', 1), ('tmrw', 1), ('tmr', 1), ('بكره', 1), ('باكر', 1), ('غدا', 1), ('الغد', 1),
+    ('today', 0), ('tonight', 0), ('this evening', 0), ('اليوم', 0), ('الليله', 0),
+]
+PM_WORDS = ['pm', 'p.m', 'evening', 'tonight', 'afternoon', 'night', 'مساء', 'المساء', 'بعد الظهر', 'العصر', 'المغرب', 'العشاء', 'الليل', 'بالليل', 'الليله', 'م']
+AM_WORDS = ['am', 'a.m', 'morning', 'صباحا', 'صباح', 'الصبح', 'الصباح', 'الفجر', 'ص']
+NEXT_WORDS = ['next', 'coming', 'القادم', 'الجاي', 'الياي', 'الجايه']
+SERVICE_TYPES = [
+    (('viewing', 'view the', 'visit', 'see the property', 'معاينه', 'زياره', 'اشوف'), "Property Viewing"),
+    (('consultation', 'consult', 'استشاره'), "Consultation"),
+    (('meeting', 'meet', 'اجتماع', 'لقاء'), "Meeting"),
+    (('call', 'phone', 'مكالمه', 'اتصال'), "Call"),
+]
+# Words that show a message talks about time even if nothing below could resolve it. A message with
+# none of these and no digits is confidently "no date/time given"; otherwise the next tier decides.
+TEMPORAL_HINTS = re.compile(
+    r"\b(?:week|weekend|month|morning|afternoon|evening|night|noon|midnight|later|soon|asap|next|this|end of|"
+    r"اسبوع|الاسبوع|الويكند|الشهر|الصبح|العصر|المسا|الليل|بعدين|قريب|الجاي|القادم|نهايه)\b"
+)
+# Offsets from today that the rules do not resolve ("in 3 days", "after a week", "بعد يومين").
+RELATIVE_OFFSET = re.compile(
+    r"\b(?:in|after|within) (?:\d+|a|an|one|two|three|a few|few|a couple of|couple of) (?:days?|weeks?|months?)\b"
+    r"|(?<![\w])(?:بعد|خلال|يومين|اسبوعين)(?![\w])"
+)
+# Numbers that are not dates or times, so they do not count as unresolved.
+OTHER_NUMBER = re.compile(r"\d[\d,.]* ?(?:bedrooms?|beds?|br|bhk|people|persons|guests|sq ?ft|sqft|aed|million|mn|k)(?![\w])")
+
+_WORD = r"(?<![\w])(?:{})(?![\w])"
+def _alternation(words):
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+MONTH_NAMES = _alternation(MONTHS)
+ISO_DATE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+# Day first, as in the UAE. Dashes only with a year, so "2-3 bedrooms" is not a date.
+NUMERIC_DATE = re.compile(r"(?<![\d:.])(\d{1,2})/(\d{1,2})(?:/(\d{2,4}))?(?![\d:])|(?<![\d:.])(\d{1,2})-(\d{1,2})-(\d{2,4})(?![\d:])")
+DAY_MONTH = re.compile(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?(?: of)? ({MONTH_NAMES})(?:,? (\d{{4}}))?(?![\w])")
+MONTH_DAY = re.compile(rf"(?<![\w])({MONTH_NAMES}) (\d{{1,2}})(?:st|nd|rd|th)?(?:,? (\d{{4}}))?\b")
+ORDINAL_DAY = re.compile(r"\b(?:the )?(\d{1,2})(?:st|nd|rd|th)\b")
+RELATIVE_DAY = re.compile(_WORD.format(_alternation(phrase for phrase, _ in RELATIVE_DAYS)))
+WEEKDAY = re.compile(rf"(?:({_alternation(NEXT_WORDS)}|this) )?" + _WORD.format(_alternation(WEEKDAYS)) + rf"(?: ({_alternation(NEXT_WORDS)}))?")
+TIME_12H = re.compile(r"(?<![\d/.-])(\d{1,2})(?:[:.](\d{2}))? ?(a\.?m\.?|p\.?m\.?|ص|م)(?![\w])")
+TIME_24H = re.compile(r"(?<![\d/.-])(\d{1,2}):(\d{2})(?![\d])")
+TIME_AT = re.compile(r"(?:\bat|\baround|الساعه|ساعه|على) (\d{1,2})(?![\d/:.-])")
+NAMED_TIME = re.compile(r"\b(noon|midday|midnight)\b|(?<![\w])(?<!بعد )(الظهر)(?![\w])") # Not "بعد الظهر" (afternoon)
+PERIOD_WORD = re.compile(_WORD.format(_alternation(PM_WORDS + AM_WORDS)))
+DURATION = re.compile(r"(\d{1,3}) ?(minutes|minute|mins|min|hours|hour|hrs|hr|دقيقه|دقائق|دقايق|ساعات|ساعه)(?![\w])")
+HALF_HOUR = re.compile(r"half an hour|نص ساعه|نصف ساعه")
+# Everything the rules understand, in one pattern; what is left over after removing it is checked by _leftovers.
+RESOLVED = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in (
+    ISO_DATE, NUMERIC_DATE, DAY_MONTH, MONTH_DAY, ORDINAL_DAY, RELATIVE_DAY, WEEKDAY, TIME_12H, TIME_24H,
+    TIME_AT, NAMED_TIME, PERIOD_WORD, DURATION, HALF_HOUR, OTHER_NUMBER)))
+
+
+# --- Tier 1: Rules ---
+def _future_date(now_date, year, month, day):
+    """
+    The date for day/month (and optional year), rolling a year forward if it already passed.
+    Returns None for impossible dates.
+    """
+    try:
+        if year:
+            return datetime(year + 2000 if year < 100 else year, month, day).date()
+        candidate = datetime(now_date.year, month, day).date()
+        return candidate if candidate >= now_date else datetime(now_date.year + 1, month, day).date()
+    except ValueError:
+        return None
+
+def _find_dates(text, now):
+    """
+    Returns ([dates found], ambiguous) for every date expression in text.
+    """
+    today = now.date()
+    dates, ambiguous = [], False
+    for match in ISO_DATE.finditer(text):
+        dates.append(_future_date(today, int(match.group(1)), int(match.group(2)), int(match.group(3))))
+    text = ISO_DATE.sub(' ', text)
+    for match in NUMERIC_DATE.finditer(text):
+        day, month, year = (match.group(1), match.group(2), match.group(3)) if match.group(1) else match.group(4, 5, 6)
+        dates.append(_future_date(today, int(year) if year else None, int(month), int(day)))
+    for match in DAY_MONTH.finditer(text):
+        dates.append(_future_date(today, int(match.group(3)) if match.group(3) else None, MONTHS[match.group(2)], int(match.group(1))))
+    for match in MONTH_DAY.finditer(text):
+        dates.append(_future_date(today, int(match.group(3)) if match.group(3) else None, MONTHS[match.group(1)], int(match.group(2))))
+    if not dates:
+        for match in ORDINAL_DAY.finditer(text):
+            day = int(match.group(1))
+            month_start = today.replace(day=1)
+            for months_ahead in (0, 1, 2):
+                year, month = divmod(month_start.month - 1 + months_ahead, 12)
+                candidate = _future_date(today, month_start.year + year, month + 1, day)
+                if candidate and candidate >= today:
+                    dates.append(candidate)
+                    break
+    for match in RELATIVE_DAY.finditer(text):
+        dates.append(today + timedelta(days=dict(RELATIVE_DAYS)[match.group(0)]))
+    for match in WEEKDAY.finditer(text):
+        prefix, weekday_name, suffix = match.group(1), match.group(0), match.group(2)
+        weekday_name = next(name for name in WEEKDAYS if re.search(_WORD.format(re.escape(name)), weekday_name))
+        days_ahead = (WEEKDAYS[weekday_name] - today.weekday()) % 7
+        if days_ahead == 0:
+            if prefix in NEXT_WORDS or suffix in NEXT_WORDS:
+                days_ahead = 7
+            elif prefix != 'this':
+                ambiguous = True # "Monday" on a Monday: today or next week?
+        dates.append(today + timedelta(days=days_ahead))
+    if any(date is None for date in dates):
+        ambiguous = True
+    return [date for date in dates if date], ambiguous
+
+def _find_time(text):
+    """
+    Returns ((hour, minute) or None, ambiguous).
+    """
+    period_words = PERIOD_WORD.findall(text)
+    has_pm = any(word in PM_WORDS for word in period_words)
+    has_am = any(word in AM_WORDS for word in period_words)
+
+    match = TIME_12H.search(text)
+    if match:
+        hour, minute = int(match.group(1)), int(match.group(2) or 0)
+        if not 1 <= hour <= 12 or minute > 59:
+            return None, True
+        is_pm = match.group(3).startswith(('p', 'م'))
+        return ((hour % 12) + (12 if is_pm else 0), minute), False
+
+    match = NAMED_TIME.search(text)
+    if match:
+        return ((0, 0) if match.group(1) == 'midnight' else (12, 0)), False
+
+    match = TIME_24H.search(text) or TIME_AT.search(text)
+    if not match:
+        return None, False
+    hour = int(match.group(1))
+    minute = int(match.group(2)) if match.re is TIME_24H else 0
+    if hour > 23 or minute > 59:
+        return None, True
+    if hour >= 13 or hour == 0 or (match.re is TIME_24H and (len(match.group(1)) == 2 or hour >= 10)):
+        return (hour, minute), False # 24-hour ("09:00", "11:30"); "5:30" could be morning or evening
+    if has_pm != has_am:
+        return ((hour % 12) + (12 if has_pm else 0), minute), False
+    return (hour, minute), True # "at 5": morning or evening?
+
+def _leftovers(text):
+    """
+    Returns (digits left, date words left) once every expression the rules resolved is removed from
+    text: numbers such as "2-3pm" or "in 3 days", and words such as "weekend" or "بعد" that point at
+    a date the rules did not find.
+    """
+    text = RESOLVED.sub(' ', text)
+    return bool(re.search(r'\d', text)), bool(TEMPORAL_HINTS.search(text) or RELATIVE_OFFSET.search(text))
+
+def _duration(text):
+    if HALF_HOUR.search(text):
+        return 30
+    match = DURATION.search(text)
+    if not match:
+        return DEFAULT_DURATION_MINUTES
+    amount, unit = int(match.group(1)), match.group(2)
+    return amount * 60 if unit.startswith(('h', 'ساع')) else amount
+
+def _service_type(text):
+    for keywords, service_type in SERVICE_TYPES:
+        if any(keyword in text for keyword in keywords):
+            return service_type
+    return DEFAULT_SERVICE_TYPE
+
+def parse_datetime_rules(message: str, now: datetime) -> dict:
+    """
+    Extracts a date and time from English or Arabic text with fixed rules, relative to now (aware,
+    Dubai time). Returns the same fields as the LLM extraction plus a confidence; low confidence means
+    the text had time expressions the rules could not resolve unambiguously.
+    """
+    text = normalize(message)
+    dates, dates_ambiguous = _find_dates(text, now)
+    time_of_day, time_ambiguous = _find_time(text)
+    result = {
+        'has_datetime': False, 'date': None, 'time': None,
+        'duration_minutes': _duration(text), 'service_type': _service_type(text), 'confidence': 0.0,
+    }
+
+    if not dates and not time_of_day:
+        if not re.search(r'\d', text) and not TEMPORAL_HINTS.search(text) and not PERIOD_WORD.search(text):
+            result['confidence'] = 0.9 # Nothing that looks like a date or time
+        return result
+
+    result['has_datetime'] = True
+    confidence = 1.0
+    digits_left, date_words_left = _leftovers(text)
+    if digits_left or (date_words_left and not dates):
+        confidence -= 0.4 # "2-3pm tomorrow", "in 3 days at 5pm", "on the weekend at 5pm": not "today at 5pm"
+    if len(set(dates)) > 1 or dates_ambiguous:
+        confidence -= 0.4
+    if dates:
+        result['date'] = dates[0].isoformat()
+    if time_of_day:
+        result['time'] = f"{time_of_day[0]:02d}:{time_of_day[1]:02d}"
+        if time_ambiguous:
+            confidence -= 0.4
+        if not dates:
+            # Like the LLM prompt: no date means today, unless that time has already passed.
+            moment = now.replace(hour=time_of_day[0], minute=time_of_day[1], second=0, microsecond=0)
+            result['date'] = now.date().isoformat()
+            confidence -= 0.15 if moment > now else 0.4
+    elif time_ambiguous:
+        confidence -= 0.4
+    elif PERIOD_WORD.search(text):
+        confidence -= 0.3 # e.g. "Friday evening": a time of day the rules cannot pin down
+    result['confidence'] = round(max(confidence, 0.0), 2)
+    return result
+
+
+# --- Tier 2: dateparser ---
+def parse_datetime_dateparser(message: str, now: datetime):
+    """
+    Finds a single date expression with dateparser.search (English and Arabic). A result is only
+    returned when the matched text also contains a time the rules understand, because dateparser fills
+    in the current time when none is given. Returns None if dateparser is not installed.
+    """
+    try:
+        from dateparser.search import search_dates # Optional dependency
+    except ImportError:
+        return None
+    settings = {'PREFER_DATES_FROM': 'future', 'RELATIVE_BASE': now.replace(tzinfo=None), 'RETURN_AS_TIMEZONE_AWARE': False}
+    matches = search_dates(message, languages=['en', 'ar'], settings=settings) or []
+    if len({parsed for _, parsed in matches}) != 1:
+        return None
+    matched_text, parsed = matches[0]
+    time_of_day, time_ambiguous = _find_time(normalize(matched_text))
+    text = normalize(message)
+    return {
+        'has_datetime': True, 'date': parsed.date().isoformat(),
+        'time': parsed.strftime('%H:%M') if time_of_day and not time_ambiguous else None,
+        'duration_minutes': _duration(text), 'service_type': _service_type(text),
+        'confidence': 0.85 if time_of_day and not time_ambiguous else 0.6,
+    }
+
+
+# --- Tiered Extraction ---
+class DateTimeExtractor:
+    """
+    Runs the tiers in order (rules, dateparser, LLM) and returns the first result confident enough.
+    Each resolution is counted per tier in /metrics, together with an estimate of the LLM time saved
+    (a running average of this process's LLM extraction latency minus the local time taken).
+    """
+    def __init__(self, llm_extract, timezone, min_confidence: float = DATETIME_LOCAL_MIN_CONFIDENCE):
+        self.llm_extract = llm_extract
+        self.timezone = timezone
+        self.min_confidence = min_confidence
+        self.llm_latency = DATETIME_LLM_LATENCY_ESTIMATE_SECONDS
+
+    def _accept(self, tier, result, started):
+        elapsed = time.perf_counter() - started
+        record_datetime_extraction(tier, max(self.llm_latency - elapsed, 0.0))
+        result = dict(result, tier=tier)
+        logging.info(f"Datetime resolved by {tier} tier in {elapsed * 1000:.1f} ms (interpreted as {self.timezone.zone} time): {result}")
+        return result
+
+    def extract(self, message: str, now: datetime = None):
+        now = now or datetime.now(self.timezone)
+        started = time.perf_counter()
+
+        with timed('datetime_rules'):
+            result = parse_datetime_rules(message, now)
+        if result['confidence'] >= self.min_confidence:
+            return self._accept(TIER_RULES, result, started)
+
+        if DATETIME_DATEPARSER_TIER:
+            try:
+                with timed('datetime_dateparser'):
+                    parsed = parse_datetime_dateparser(message, now)
+            except Exception as e:
+                logging.warning(f"dateparser tier failed: {e}")
+                parsed = None
+            if parsed and parsed['confidence'] >= self.min_confidence:
+                return self._accept(TIER_DATEPARSER, parsed, started)
+
+        llm_started = time.perf_counter()
+        result = self.llm_extract(message)
+        self.llm_latency = 0.8 * self.llm_latency + 0.2 * (time.perf_counter() - llm_started)
+        record_datetime_extraction(TIER_LLM if result else 'unresolved', 0.0)
+        return dict(result, tier=TIER_LLM) if result else result
@@ -0,0 +1,289 @@
+import os
+import time
+import heapq
+import queue
+import atexit
+import logging
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from metrics import timed, record_error, count_event, register_queue_depth
+
+# --- Configuration ---
+APPOINTMENT_EMAIL_SENDER = os.getenv('APPOINTMENT_EMAIL_SENDER')
+APPOINTMENT_EMAIL_PASSWORD = os.getenv('APPOINTMENT_EMAIL_PASSWORD')
+APPOINTMENT_SMTP_SERVER = os.getenv('APPOINTMENT_SMTP_SERVER', 'smtp.gmail.com')
+APPOINTMENT_SMTP_PORT = int(os.getenv('APPOINTMENT_SMTP_PORT', 587))
+# "smtp" delivers through the server above. "local" delivers nowhere: messages are kept in memory and,
+# if EMAIL_LOCAL_MAILBOX_PATH is set, appended to that file. Meant for tests and local runs.
+EMAIL_TRANSPORT = os.getenv('EMAIL_TRANSPORT', 'smtp').lower()
+EMAIL_LOCAL_MAILBOX_PATH = os.getenv('EMAIL_LOCAL_MAILBOX_PATH')
+# Messages waiting for delivery. Submissions beyond this are refused instead of growing memory.
+EMAIL_QUEUE_MAX_SIZE = int(os.getenv('EMAIL_QUEUE_MAX_SIZE', 1000))
+# Once a message arrives, the worker waits this long for more, so a burst goes out in one pass.
+EMAIL_BATCH_WINDOW_SECONDS = float(os.getenv('EMAIL_BATCH_WINDOW_SECONDS', 0.2))
+EMAIL_BATCH_MAX_SIZE = int(os.getenv('EMAIL_BATCH_MAX_SIZE', 20))
+# Delivery attempts per message. Temporary failures (4xx replies, dropped connections) are retried
+# after EMAIL_RETRY_BASE_SECONDS, doubling each time; permanent ones (5xx) are dropped at once.
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 5))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', 2))
+# The SMTP session is closed after this long without mail; servers drop idle sessions anyway.
+EMAIL_IDLE_DISCONNECT_SECONDS = float(os.getenv('EMAIL_IDLE_DISCONNECT_SECONDS', 120))
+# On interpreter exit, wait up to this long for queued mail to be delivered.
+EMAIL_SHUTDOWN_FLUSH_SECONDS = float(os.getenv('EMAIL_SHUTDOWN_FLUSH_SECONDS', 5))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def is_temporary_failure(error: Exception) -> bool:
+    """
+    Whether a delivery error is worth retrying: 4xx replies, dropped connections and network errors.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError) # Socket errors and timeouts
+
+
+# --- Transports ---
+class SMTPTransport:
+    """
+    One authenticated SMTP session, opened on first use and kept for later messages. A session the
+    server has dropped while idle is reopened once before the send is reported as failed.
+    """
+    def __init__(self, host: str, port: int, username: str = None, password: str = None, starttls: bool = True, timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._server = None
+
+    def _connect(self):
+        with timed('smtp_connect'):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.starttls:
+                    server.starttls()
+                if self.username and self.password:
+                    server.login(self.username, self.password)
+            except Exception:
+                server.close()
+                raise
+        logging.info(f"SMTP session opened to {self.host}:{self.port}.")
+        self._server = server
+
+    def send(self, message):
+        for attempt in range(2):
+            if self._server is None:
+                self._connect()
+            try:
+                with timed('smtp_send'):
+                    self._server.send_message(message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt:
+                    raise
+                logging.info("SMTP session was closed by the server; reconnecting.")
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                raise # The session is still usable (smtplib has reset it)
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+
+class LocalMailbox:
+    """
+    Stand-in transport for tests and local runs: keeps every message in `messages` and optionally
+    appends it to a file in mbox-like form.
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+        if self.path:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(f"From {message.get('From', 'unknown')} {time.strftime('%a %b %d %H:%M:%S %Y')}\n{message.as_string()}\n\n")
+
+    def close(self):
+        pass
+
+
+# --- Dispatcher ---
+class EmailDispatcher:
+    """
+    Delivers mail from a background thread so callers never wait on SMTP. submit() only enqueues.
+    The worker sends bursts over the transport's single session and retries temporary failures
+    with exponential backoff.
+    """
+    def __init__(self, transport, max_queue_size: int = EMAIL_QUEUE_MAX_SIZE, batch_window: float = EMAIL_BATCH_WINDOW_SECONDS,
+                 batch_max_size: int = EMAIL_BATCH_MAX_SIZE, max_attempts: int = EMAIL_MAX_ATTEMPTS,
+                 retry_base: float = EMAIL_RETRY_BASE_SECONDS, idle_disconnect: float = EMAIL_IDLE_DISCONNECT_SECONDS):
+        self.transport = transport
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.idle_disconnect = idle_disconnect
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._retries = [] # Heap of (due, sequence, attempt, message); only the worker touches it
+        self._sequence = 0
+        self._pending = 0 # Submitted and not yet delivered or dropped
+        self._pending_changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="email-dispatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = EMAIL_SHUTDOWN_FLUSH_SECONDS):
+        self.flush(timeout)
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+
+    def submit(self, message) -> bool:
+        """
+        Queues a message for delivery. Returns False (and logs) if the queue is full.
+        """
+        with self._pending_changed:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((1, message))
+        except queue.Full:
+            self._settle()
+            logging.error(f"Email queue is full; dropping message '{message.get('Subject')}'.")
+            record_error('email_dispatch')
+            return False
+        return True
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until every submitted message is delivered or dropped. Returns False on timeout.
+        """
+        with self._pending_changed:
+            return self._pending_changed.wait_for(lambda: self._pending == 0, timeout)
+
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def _settle(self):
+        with self._pending_changed:
+            self._pending -= 1
+            self._pending_changed.notify_all()
+
+    # --- Worker ---
+    def _next_batch(self) -> list:
+        """
+        Blocks until mail is due, then returns up to batch_max_size (attempt, message) pairs: due
+        retries plus whatever arrives within batch_window. Returns [] when idle for idle_disconnect.
+        """
+        timeout = self.idle_disconnect
+        if self._retries:
+            timeout = min(timeout, max(0.0, self._retries[0][0] - time.monotonic()))
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            pass
+        deadline = time.monotonic() + self.batch_window
+        while batch and len(batch) < self.batch_max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        now = time.monotonic()
+        while self._retries and self._retries[0][0] <= now and len(batch) < self.batch_max_size:
+            _, _, attempt, message = heapq.heappop(self._retries)
+            batch.append((attempt, message))
+        return batch
+
+    def _deliver(self, attempt: int, message):
+        try:
+            self.transport.send(message)
+        except Exception as e:
+            if is_temporary_failure(e) and attempt < self.max_attempts:
+                delay = self.retry_base * 2 ** (attempt - 1)
+                logging.warning(f"Email '{message.get('Subject')}' failed (attempt {attempt}/{self.max_attempts}), retrying in {delay:.1f}s: {e}")
+                count_event('email_retried')
+                self._sequence += 1
+                heapq.heappush(self._retries, (time.monotonic() + delay, self._sequence, attempt + 1, message))
+                return
+            logging.error(f"Email '{message.get('Subject')}' to {message.get('To')} dropped after {attempt} attempt(s): {e}")
+            record_error('email_dispatch')
+        else:
+            logging.info(f"Email '{message.get('Subject')}' delivered to {message.get('To')}.")
+            count_event('email_sent')
+        self._settle()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                if not self._retries:
+                    self.transport.close() # Idle: let the server-side session go
+                continue
+            for attempt, message in batch:
+                self._deliver(attempt, message)
+
+
+def build_transport():
+    if EMAIL_TRANSPORT == 'local':
+        return LocalMailbox(EMAIL_LOCAL_MAILBOX_PATH)
+    return SMTPTransport(APPOINTMENT_SMTP_SERVER, APPOINTMENT_SMTP_PORT, APPOINTMENT_EMAIL_SENDER, APPOINTMENT_EMAIL_PASSWORD)
+
+
+def get_email_dispatcher():
+    """
+    The process-wide dispatcher, started on first use. Returns None if SMTP delivery is selected but
+    the sender credentials are not configured.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            if EMAIL_TRANSPORT != 'local' and not (APPOINTMENT_EMAIL_SENDER and APPOINTMENT_EMAIL_PASSWORD):
+                logging.error("Sender email or password not configured for APPOINTMENT_EMAIL. Emails cannot be sent.")
+                return None
+            _dispatcher = EmailDispatcher(build_transport()).start()
+            register_queue_depth('email_outbox', _dispatcher.queue_depth)
+            atexit.register(_dispatcher.stop)
+        return _dispatcher
+
+
+def send_email(subject: str, body: str, receiver: str, sender: str = None) -> bool:
+    """
+    Queues a UTF-8 plain-text email. Returns True once queued, not when delivered.
+    """
+    dispatcher = get_email_dispatcher()
+    if dispatcher is None:
+        return False
+    message = MIMEText(body, _charset='utf-8') # Ensure UTF-8 for non-English characters
+    message['Subject'] = subject
+    message['From'] = sender or APPOINTMENT_EMAIL_SENDER or 'whatsapp-bot@localhost'
+    message['To'] = receiver
+    return dispatcher.submit(message)
@@ -0,0 +1,112 @@
+import os
+import json
+import base64
+import hashlib
+import logging
+from langchain.schema import HumanMessage
+from metrics import record_cache_lookup
+from shared_state import get_shared_state
+from structured_output import invoke_structured
+
+# --- Configuration ---
+# Inbound photos are described by the (vision-capable) chat model, so the reply can address what
+# the photo shows instead of a placeholder.
+IMAGE_ANALYSIS_ENABLED = os.getenv('IMAGE_ANALYSIS_ENABLED', 'true').lower() == 'true'
+# OpenAI image detail: "low" sends one 512px tile (a fixed ~85 tokens), which is enough to tell a
+# villa from a tower and read a building sign. "high" or "auto" cost more per photo.
+IMAGE_ANALYSIS_DETAIL = os.getenv('IMAGE_ANALYSIS_DETAIL', 'low')
+# Results are kept per photo (WhatsApp's fileSha256). Forwarded listing photos and re-sent images
+# are answered from the cache without downloading or calling the model again.
+IMAGE_ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv('IMAGE_ANALYSIS_CACHE_TTL_SECONDS', 30 * 24 * 3600))
+
+IMAGE_ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'required': ['description'],
+    'properties': {
+        'description': {'type': 'string'},
+        'is_property': {'type': 'boolean', 'default': False},
+        'property_type': {'type': ['string', 'null'], 'default': None},
+        'location': {'type': ['string', 'null'], 'default': None},
+        'building': {'type': ['string', 'null'], 'default': None},
+        'visible_text': {'type': ['string', 'null'], 'default': None},
+    },
+}
+
+IMAGE_ANALYSIS_PROMPT = """
+A client of a Dubai real estate agency sent this photo on WhatsApp. Describe what it shows in one or two sentences.
+If it shows a property (building, villa, apartment interior, floor plan, listing screenshot), also identify:
+- "property_type": apartment, villa, townhouse, penthouse, studio, office, land, or null.
+- "location": the community or area (e.g. "Dubai Marina", "Palm Jumeirah") if it is recognisable or written, else null.
+- "building": the building or project name if it is recognisable or written, else null.
+- "visible_text": prices, bedroom counts, names or other text written in the image, else null.
+Respond with a JSON object with the keys "description", "is_property", "property_type", "location", "building" and "visible_text".
+"""
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _cache_key(file_sha256: str) -> str:
+    return f"image_analysis:{file_sha256}"
+
+
+def cached_image_analysis(file_sha256: str):
+    """
+    The stored analysis of the photo with this fileSha256, or None. Lets the webhook skip the download.
+    """
+    if not file_sha256:
+        return None
+    try:
+        raw = get_shared_state().get_value(_cache_key(file_sha256))
+    except Exception as e:
+        logging.error(f"Failed to read image analysis cache: {e}")
+        raw = None
+    record_cache_lookup('image_analysis', raw is not None)
+    return json.loads(raw) if raw is not None else None
+
+
+def analyze_image(ai_model, image_bytes: bytes, mimetype: str = 'image/jpeg', file_sha256: str = None, listing_matches: list = None):
+    """
+    Describes a decrypted photo with the chat model and caches the result under file_sha256 (WhatsApp's
+    base64 SHA-256 of the plaintext, computed here if missing). listing_matches (from
+    image_index.match_listing_photos) are cached with it. Returns the analysis dict
+    (IMAGE_ANALYSIS_SCHEMA plus 'listing_matches') or None if the model gave no usable answer.
+    """
+    file_sha256 = file_sha256 or base64.b64encode(hashlib.sha256(image_bytes).digest()).decode('ascii')
+    data_url = f"data:{mimetype or 'image/jpeg'};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+    message = HumanMessage(content=[
+        {'type': 'text', 'text': IMAGE_ANALYSIS_PROMPT},
+        {'type': 'image_url', 'image_url': {'url': data_url, 'detail': IMAGE_ANALYSIS_DETAIL}},
+    ])
+    analysis = invoke_structured(ai_model, [message], IMAGE_ANALYSIS_SCHEMA, 'image_analysis')
+    if analysis is None:
+        return None
+    analysis['listing_matches'] = listing_matches or []
+    try:
+        get_shared_state().put_value(_cache_key(file_sha256), json.dumps(analysis, ensure_ascii=False), IMAGE_ANALYSIS_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logging.error(f"Failed to store image analysis: {e}")
+    return analysis
+
+
+def _listing_names(matches: list) -> str:
+    return "; ".join(f"{match['title']} in {match['area']} (PropertyID {match['property_id']})" for match in matches)
+
+def describe_image_message(analysis: dict, caption: str = None) -> str:
+    """
+    The message body handed to the LLM pipeline for a photo: the caption, if any, followed by what
+    the photo shows. Property details and catalogue matches are spelled out so the query analysis
+    can turn them into listing filters in the same turn.
+    """
+    details = [analysis['description'].strip()]
+    for label, key in (("Property type", 'property_type'), ("Location", 'location'), ("Building", 'building'), ("Text in the image", 'visible_text')):
+        if analysis.get(key):
+            details.append(f"{label}: {analysis[key]}.")
+    matches = analysis.get('listing_matches') or []
+    same = [match for match in matches if match.get('same_photo')]
+    similar = [match for match in matches if not match.get('same_photo')]
+    if same:
+        details.append(f"It is a photo from our listing(s): {_listing_names(same)}.")
+    if similar:
+        details.append(f"It looks similar to photos of these listings, but may be a different property: {_listing_names(similar)}.")
+    description = f"[User sent an image. {' '.join(details)}]"
+    return f"{caption.strip()}\n{description}" if caption and caption.strip() else description
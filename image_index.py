@@ -0,0 +1,330 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+import requests
+from index_builder import build_index, extract_vectors
+from property_handler import IMAGE_COLUMNS, get_sheet_data
+from metrics import timed
+
+# --- Configuration ---
+# Directory holding the catalogue image index: index.faiss (one vector per distinct photo) and
+# catalogue.json (per photo: perceptual hash, content hash, URLs and PropertyIDs).
+IMAGE_INDEX_PATH = os.getenv('IMAGE_INDEX_PATH', 'image_index')
+# FAISS factory for the photo vectors (see index_builder.py). A catalogue has thousands of photos at
+# most, so exact search is fast; "HNSW32" suits much larger ones. Avoid PQ: refreshes re-read the vectors.
+IMAGE_INDEX_FACTORY = os.getenv('IMAGE_INDEX_FACTORY', 'Flat')
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv('IMAGE_DOWNLOAD_WORKERS', 4))
+IMAGE_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv('IMAGE_DOWNLOAD_TIMEOUT_SECONDS', 20))
+IMAGE_DOWNLOAD_MAX_BYTES = int(os.getenv('IMAGE_DOWNLOAD_MAX_BYTES', 15 * 1024 * 1024))
+# Perceptual hashes (64-bit dHash) at most this many bits apart are the same photo, re-encoded,
+# resized or lightly cropped.
+IMAGE_DUPLICATE_MAX_DISTANCE = int(os.getenv('IMAGE_DUPLICATE_MAX_DISTANCE', 6))
+# Cosine similarity of the photo vectors from which an inbound photo is reported as looking similar to a
+# listing's photo. The vector is a weak descriptor (distinct skylines can pass 0.92), so only a dHash
+# duplicate is reported as the listing's own photo; re-encoded or cropped copies score above 0.99.
+IMAGE_MATCH_MIN_SIMILARITY = float(os.getenv('IMAGE_MATCH_MIN_SIMILARITY', 0.98))
+
+INDEX_FILE = "index.faiss"
+CATALOGUE_FILE = "catalogue.json"
+THUMBNAIL_SIZE = 64
+LAYOUT_SIZE = 8
+VECTOR_DIMENSION = 4 ** 3 + LAYOUT_SIZE * LAYOUT_SIZE
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_loaded = None # (catalogue mtime, ImageIndex)
+_loaded_lock = threading.Lock()
+
+
+# --- Fingerprints ---
+def _open_image(data: bytes):
+    from PIL import Image # Pillow (in requirements.txt), imported here so other modules load without it
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (THUMBNAIL_SIZE * 4, THUMBNAIL_SIZE * 4)) # Lets JPEG decode at reduced size
+    return image.convert('RGB')
+
+def fingerprint(data: bytes):
+    """
+    (vector, dhash) for an encoded image. The vector is a cheap CPU descriptor, not a neural
+    embedding: a 4x4x4 colour histogram and an 8x8 brightness layout, each L2-normalized, so the
+    same photo re-encoded, resized or cropped a little stays close. dhash is the 64-bit difference
+    hash of a 9x8 greyscale thumbnail.
+    """
+    from PIL import Image
+    image = _open_image(data)
+    thumbnail = np.asarray(image.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR), dtype=np.uint8) // 64
+    bins = thumbnail[..., 0].astype(np.int32) * 16 + thumbnail[..., 1] * 4 + thumbnail[..., 2]
+    colour = np.sqrt(np.bincount(bins.ravel(), minlength=64).astype(np.float32))
+    grey = image.convert('L')
+    layout = np.asarray(grey.resize((LAYOUT_SIZE, LAYOUT_SIZE), Image.BILINEAR), dtype=np.float32).ravel()
+    layout -= layout.mean()
+    parts = [part / (np.linalg.norm(part) or 1.0) for part in (colour, layout)]
+    vector = np.concatenate(parts) / np.sqrt(2)
+    gradient = np.asarray(grey.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    dhash = int.from_bytes(np.packbits(gradient[:, 1:] > gradient[:, :-1]).tobytes(), 'big')
+    return vector.astype(np.float32), dhash
+
+def hamming_distances(dhash: int, dhashes: np.ndarray) -> np.ndarray:
+    """
+    Bit distances between one hash and an array of uint64 hashes.
+    """
+    differing = np.bitwise_xor(dhashes, np.uint64(dhash))
+    return np.unpackbits(differing.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+# --- Index ---
+class ImageIndex:
+    """
+    The catalogue photos: FAISS index of photo vectors plus, by position, each photo's content hash,
+    dhash, URLs and PropertyIDs. Identical files at different URLs or in several listings share one
+    position.
+    """
+    def __init__(self, index=None, photos: list = None, properties: dict = None, failed: dict = None):
+        self.index = index
+        self.photos = photos or []
+        self.properties = properties or {} # PropertyID -> {'Title', 'area'}
+        self.failed = failed or {} # URL -> error, retried on the next refresh
+        self.dhashes = np.array([int(photo['dhash'], 16) for photo in self.photos], dtype=np.uint64)
+
+    @classmethod
+    def load(cls, path: str = IMAGE_INDEX_PATH):
+        catalogue_path = os.path.join(path, CATALOGUE_FILE)
+        if not os.path.exists(catalogue_path):
+            return cls()
+        with open(catalogue_path, encoding='utf-8') as f:
+            catalogue = json.load(f)
+        index_path = os.path.join(path, INDEX_FILE)
+        index = faiss.read_index(index_path) if catalogue['photos'] else None
+        return cls(index, catalogue['photos'], catalogue.get('properties'), catalogue.get('failed'))
+
+    def save(self, path: str = IMAGE_INDEX_PATH):
+        """
+        Writes both files through temporary names, catalogue last, so readers that reload on a
+        changed catalogue.json never see a half-written index.
+        """
+        os.makedirs(path, exist_ok=True)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(path, f"{INDEX_FILE}.tmp"))
+            os.replace(os.path.join(path, f"{INDEX_FILE}.tmp"), os.path.join(path, INDEX_FILE))
+        catalogue = {'built_at': time.time(), 'factory': IMAGE_INDEX_FACTORY, 'photos': self.photos, 'properties': self.properties, 'failed': self.failed}
+        with open(os.path.join(path, f"{CATALOGUE_FILE}.tmp"), 'w', encoding='utf-8') as f:
+            json.dump(catalogue, f, ensure_ascii=False)
+        os.replace(os.path.join(path, f"{CATALOGUE_FILE}.tmp"), os.path.join(path, CATALOGUE_FILE))
+
+    def vectors(self) -> np.ndarray:
+        if self.index is None:
+            return np.zeros((0, VECTOR_DIMENSION), dtype=np.float32)
+        return extract_vectors(self.index)
+
+    def match(self, data: bytes, k: int = 3) -> list:
+        """
+        Listings whose catalogue photos look like this image, best first, as dicts with 'property_id',
+        'title', 'area', 'similarity', 'same_photo' and 'url'. A dhash within IMAGE_DUPLICATE_MAX_DISTANCE
+        is the same photo (same_photo, similarity 1.0); vector neighbours above IMAGE_MATCH_MIN_SIMILARITY
+        only look similar.
+        """
+        if self.index is None:
+            return []
+        vector, dhash = fingerprint(data)
+        scores = {}
+        for position in np.nonzero(hamming_distances(dhash, self.dhashes) <= IMAGE_DUPLICATE_MAX_DISTANCE)[0]:
+            scores[int(position)] = 1.0
+        distances, positions = self.index.search(vector.reshape(1, -1), min(k * 3, self.index.ntotal))
+        for distance, position in zip(distances[0], positions[0]):
+            similarity = 1.0 - float(distance) / 2 # Squared L2 between unit vectors
+            if position >= 0 and similarity >= IMAGE_MATCH_MIN_SIMILARITY:
+                scores.setdefault(int(position), similarity)
+        matches, seen = [], set()
+        for position, similarity in sorted(scores.items(), key=lambda item: -item[1]):
+            photo = self.photos[position]
+            for property_id in photo['property_ids']:
+                if property_id not in seen:
+                    seen.add(property_id)
+                    details = self.properties.get(property_id, {})
+                    matches.append({'property_id': property_id, 'title': details.get('Title', ''), 'area': details.get('area', ''),
+                                    'similarity': round(similarity, 3), 'same_photo': similarity == 1.0, 'url': photo['urls'][0]})
+        return matches[:k]
+
+    def duplicates(self) -> list:
+        """
+        Groups of photo positions that are the same picture, used by more than one listing: identical
+        files (one position with several PropertyIDs) and near-identical dhashes across positions.
+        """
+        groups, grouped = [], set()
+        for position, photo in enumerate(self.photos):
+            if position in grouped:
+                continue
+            close = [int(p) for p in np.nonzero(hamming_distances(int(photo['dhash'], 16), self.dhashes) <= IMAGE_DUPLICATE_MAX_DISTANCE)[0]]
+            property_ids = {property_id for p in close for property_id in self.photos[p]['property_ids']}
+            if len(property_ids) > 1:
+                groups.append({'positions': close, 'property_ids': sorted(property_ids), 'urls': [url for p in close for url in self.photos[p]['urls']]})
+                grouped.update(close)
+        return groups
+
+
+# --- Refresh ---
+def _download(url: str) -> bytes:
+    with requests.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS, stream=True) as response:
+        response.raise_for_status()
+        chunks, received = [], 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            received += len(chunk)
+            if received > IMAGE_DOWNLOAD_MAX_BYTES:
+                raise ValueError(f"larger than {IMAGE_DOWNLOAD_MAX_BYTES} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+def _fetch_photo(url: str):
+    try:
+        data = _download(url)
+        vector, dhash = fingerprint(data)
+        return url, hashlib.sha256(data).hexdigest(), vector, dhash, None
+    except Exception as e:
+        return url, None, None, None, str(e)
+
+def catalogue_photos(df) -> tuple:
+    """
+    ({URL: [PropertyID, ...]}, {PropertyID: {'Title', 'area'}}) from the property sheet's image columns.
+    """
+    urls, properties = {}, {}
+    for row in df.to_dict('records'):
+        property_id = str(row.get('PropertyID', '')).strip()
+        if not property_id:
+            continue
+        properties[property_id] = {'Title': str(row.get('Title', '')), 'area': str(row.get('area', ''))}
+        for column in IMAGE_COLUMNS:
+            url = str(row.get(column, '')).strip()
+            if url.startswith(('http://', 'https://')):
+                urls.setdefault(url, [])
+                if property_id not in urls[url]:
+                    urls[url].append(property_id)
+    return urls, properties
+
+@timed('image_index_refresh')
+def refresh_image_index(df, path: str = IMAGE_INDEX_PATH, full: bool = False) -> dict:
+    """
+    Brings the index in line with the property sheet. Only URLs not indexed before (or that failed
+    last time) are downloaded; photos whose URLs left the sheet are dropped, and PropertyIDs are
+    re-read for all. full=True downloads everything again. Returns counts of what changed.
+    """
+    previous = ImageIndex() if full else ImageIndex.load(path)
+    wanted, properties = catalogue_photos(df)
+    old_vectors = previous.vectors()
+
+    by_sha = {} # Content hash -> photo, merging identical files at different URLs
+    kept_url_positions = {}
+    for position, photo in enumerate(previous.photos):
+        for url in photo['urls']:
+            if url in wanted:
+                kept_url_positions[url] = position
+    for url, position in kept_url_positions.items():
+        photo = previous.photos[position]
+        entry = by_sha.setdefault(photo['sha256'], {'sha256': photo['sha256'], 'dhash': photo['dhash'], 'urls': [], 'vector': old_vectors[position]})
+        entry['urls'].append(url)
+
+    new_urls = [url for url in wanted if url not in kept_url_positions]
+    failed = {}
+    if new_urls:
+        logging.info(f"Downloading {len(new_urls)} new catalogue photos ({len(kept_url_positions)} already indexed).")
+        with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as pool:
+            for url, sha256, vector, dhash, error in pool.map(_fetch_photo, new_urls):
+                if error:
+                    logging.warning(f"Catalogue photo {url} could not be indexed: {error}")
+                    failed[url] = error
+                    continue
+                entry = by_sha.setdefault(sha256, {'sha256': sha256, 'dhash': f"{dhash:016x}", 'urls': [], 'vector': vector})
+                entry['urls'].append(url)
+
+    photos, vectors = [], []
+    for entry in by_sha.values():
+        property_ids = []
+        for url in entry['urls']:
+            property_ids += [property_id for property_id in wanted[url] if property_id not in property_ids]
+        photos.append({'sha256': entry['sha256'], 'dhash': entry['dhash'], 'urls': entry['urls'], 'property_ids': property_ids})
+        vectors.append(entry['vector'])
+    index = build_index(np.vstack(vectors).astype(np.float32), IMAGE_INDEX_FACTORY) if vectors else None
+    refreshed = ImageIndex(index, photos, properties, failed)
+    refreshed.save(path)
+
+    stats = {'photos': len(photos), 'urls': len(wanted), 'downloaded': len(new_urls) - len(failed), 'failed': len(failed),
+             'removed': len(previous.photos) - len({previous.photos[p]['sha256'] for p in kept_url_positions.values()}),
+             'shared_photos': sum(1 for photo in photos if len(photo['property_ids']) > 1)}
+    logging.info(f"Image index refreshed: {stats}")
+    return stats
+
+def refresh_from_sheet(path: str = IMAGE_INDEX_PATH, full: bool = False) -> bool:
+    """
+    Job entry point: re-reads the property sheet and refreshes the index. Returns False if the sheet
+    could not be read, so a queued job is retried.
+    """
+    df = get_sheet_data()
+    if df.empty:
+        logging.error("Image index not refreshed: the property sheet could not be read or is empty.")
+        return False
+    refresh_image_index(df, path, full)
+    return True
+
+
+# --- Lookup ---
+def get_image_index(path: str = IMAGE_INDEX_PATH):
+    """
+    The index as last written to disk, reloaded when catalogue.json changes (refreshes may run in
+    another process). None if no index has been built.
+    """
+    global _loaded
+    try:
+        mtime = os.path.getmtime(os.path.join(path, CATALOGUE_FILE))
+    except OSError:
+        return None
+    with _loaded_lock:
+        if _loaded is None or _loaded[0] != mtime:
+            _loaded = (mtime, ImageIndex.load(path))
+            logging.info(f"Loaded image index with {len(_loaded[1].photos)} catalogue photos.")
+        return _loaded[1]
+
+def match_listing_photos(data: bytes, k: int = 3) -> list:
+    """
+    ImageIndex.match against the current index; [] if there is none or the image cannot be read.
+    """
+    image_index = get_image_index()
+    if image_index is None:
+        return []
+    try:
+        with timed('image_match'):
+            return image_index.match(data, k)
+    except Exception as e:
+        logging.warning(f"Image could not be matched against the catalogue: {e}")
+        return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Catalogue photo index: perceptual hashes and CPU vectors of the property sheet's img1-img3, keyed by PropertyID.")
+    parser.add_argument('--path', default=IMAGE_INDEX_PATH, help=f"Index directory (default: {IMAGE_INDEX_PATH})")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = subparsers.add_parser('refresh', help="Index new photos from the property sheet and drop removed ones.")
+    refresh_parser.add_argument('--full', action='store_true', help="Download and fingerprint every photo again")
+    match_parser = subparsers.add_parser('match', help="List the listings whose photos look like an image file.")
+    match_parser.add_argument('image', help="Image file")
+    match_parser.add_argument('--k', type=int, default=3)
+    subparsers.add_parser('duplicates', help="List photos used by more than one listing.")
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        sys.exit(0 if refresh_from_sheet(args.path, args.full) else 1)
+    image_index = ImageIndex.load(args.path)
+    if args.command == 'match':
+        with open(args.image, 'rb') as f:
+            for match in image_index.match(f.read(), args.k):
+                print(f"{match['similarity']:.3f}  {match['property_id']}  {match['title']} ({match['area']})  {match['url']}")
+    else:
+        for group in image_index.duplicates():
+            print(f"{', '.join(group['property_ids'])}: {' '.join(group['urls'])}")
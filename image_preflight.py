@@ -0,0 +1,246 @@
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from property_handler import IMAGE_COLUMNS, get_sheet_data
+from shared_state import get_shared_state
+from metrics import timed, count_event, record_cache_lookup, register_queue_depth
+
+# --- Configuration ---
+# Catalogue image URLs are checked (HEAD, status, type, size) before WaSender is asked to send them,
+# so a broken or oversized image fails in milliseconds instead of after four retries.
+IMAGE_PREFLIGHT_ENABLED = os.getenv('IMAGE_PREFLIGHT_ENABLED', 'true').lower() == 'true'
+IMAGE_PREFLIGHT_WORKERS = int(os.getenv('IMAGE_PREFLIGHT_WORKERS', 4))
+IMAGE_PREFLIGHT_TIMEOUT_SECONDS = float(os.getenv('IMAGE_PREFLIGHT_TIMEOUT_SECONDS', 5))
+# How long a verdict is trusted. Bad URLs are re-checked sooner, in case the sheet's host recovers.
+IMAGE_PREFLIGHT_TTL_SECONDS = float(os.getenv('IMAGE_PREFLIGHT_TTL_SECONDS', 24 * 3600))
+IMAGE_PREFLIGHT_BAD_TTL_SECONDS = float(os.getenv('IMAGE_PREFLIGHT_BAD_TTL_SECONDS', 3600))
+# WhatsApp accepts JPEG and PNG images of up to 5 MB.
+IMAGE_PREFLIGHT_MAX_BYTES = int(os.getenv('IMAGE_PREFLIGHT_MAX_BYTES', 5 * 1024 * 1024))
+IMAGE_PREFLIGHT_CONTENT_TYPES = ('image/jpeg', 'image/png')
+# Optional local thumbnail cache (requires Pillow). When IMAGE_THUMBNAIL_BASE_URL is set (the public URL
+# of this app's /thumbnails/ route), every good catalogue image is also stored as a resized JPEG in
+# IMAGE_THUMBNAIL_DIR and sent from there. Oversized or WebP/GIF originals become sendable this way.
+IMAGE_THUMBNAIL_BASE_URL = os.getenv('IMAGE_THUMBNAIL_BASE_URL', '').rstrip('/')
+IMAGE_THUMBNAIL_DIR = os.getenv('IMAGE_THUMBNAIL_DIR', 'thumbnails')
+IMAGE_THUMBNAIL_MAX_SIDE = int(os.getenv('IMAGE_THUMBNAIL_MAX_SIDE', 1280))
+# Originals larger than this are not downloaded for thumbnailing either.
+IMAGE_THUMBNAIL_SOURCE_MAX_BYTES = int(os.getenv('IMAGE_THUMBNAIL_SOURCE_MAX_BYTES', 25 * 1024 * 1024))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_preflight = None
+_preflight_lock = threading.Lock()
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def catalogue_image_urls(df) -> set:
+    urls = set()
+    for column in IMAGE_COLUMNS:
+        if column in df.columns:
+            urls.update(url.strip() for url in df[column].astype(str) if url.strip().startswith(('http://', 'https://')))
+    return urls
+
+
+# --- Checks ---
+def _probe(session, url: str):
+    """
+    (status code, content type, content length or None) from a HEAD request, falling back to a
+    streamed GET whose body is not read for servers that refuse HEAD.
+    """
+    response = session.head(url, timeout=IMAGE_PREFLIGHT_TIMEOUT_SECONDS, allow_redirects=True)
+    if response.status_code in (403, 405, 501) or not response.headers.get('Content-Type'):
+        with session.get(url, timeout=IMAGE_PREFLIGHT_TIMEOUT_SECONDS, stream=True) as response:
+            pass
+    length = response.headers.get('Content-Length')
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    return response.status_code, content_type, int(length) if length and length.isdigit() else None
+
+def _make_thumbnail(session, url: str) -> str:
+    """
+    Downloads url, stores a JPEG of at most IMAGE_THUMBNAIL_MAX_SIDE pixels per side in
+    IMAGE_THUMBNAIL_DIR and returns its public URL.
+    """
+    from PIL import Image # Optional dependency (Pillow), only needed for thumbnails
+    name = f"{_url_key(url)}.jpg"
+    path = os.path.join(IMAGE_THUMBNAIL_DIR, name)
+    if not os.path.exists(path):
+        with session.get(url, timeout=IMAGE_PREFLIGHT_TIMEOUT_SECONDS * 4, stream=True) as response:
+            response.raise_for_status()
+            data = response.raw.read(IMAGE_THUMBNAIL_SOURCE_MAX_BYTES + 1, decode_content=True)
+        if len(data) > IMAGE_THUMBNAIL_SOURCE_MAX_BYTES:
+            raise ValueError(f"original is larger than {IMAGE_THUMBNAIL_SOURCE_MAX_BYTES} bytes")
+        image = Image.open(io.BytesIO(data))
+        image.draft('RGB', (IMAGE_THUMBNAIL_MAX_SIDE, IMAGE_THUMBNAIL_MAX_SIDE))
+        image = image.convert('RGB')
+        image.thumbnail((IMAGE_THUMBNAIL_MAX_SIDE, IMAGE_THUMBNAIL_MAX_SIDE))
+        os.makedirs(IMAGE_THUMBNAIL_DIR, exist_ok=True)
+        image.save(f"{path}.tmp", 'JPEG', quality=85, optimize=True)
+        os.replace(f"{path}.tmp", path)
+    return f"{IMAGE_THUMBNAIL_BASE_URL}/{name}"
+
+def check_image_url(session, url: str) -> dict:
+    """
+    The verdict for one image URL: {'ok', 'send_url', 'reason', 'transient', 'content_type', 'bytes',
+    'checked_at'}. send_url is the URL to hand WaSender (the thumbnail when thumbnails are on), None when
+    not ok. transient marks failures that say nothing about the image (timeouts, connection errors,
+    408/429/5xx); those verdicts are not cached.
+    """
+    result = {'ok': False, 'send_url': None, 'reason': None, 'transient': False, 'content_type': None, 'bytes': None, 'checked_at': time.time()}
+    try:
+        status, content_type, length = _probe(session, url)
+    except requests.exceptions.RequestException as e:
+        result['reason'], result['transient'] = f"unreachable: {e.__class__.__name__}", True
+        return result
+    result['content_type'], result['bytes'] = content_type, length
+    if not 200 <= status < 300:
+        result['reason'], result['transient'] = f"HTTP {status}", status in (408, 429) or status >= 500
+    elif not content_type.startswith('image/'):
+        result['reason'] = f"not an image ({content_type or 'no content type'})"
+    elif IMAGE_THUMBNAIL_BASE_URL:
+        try:
+            result['send_url'] = _make_thumbnail(session, url)
+        except requests.exceptions.RequestException as e:
+            result['reason'], result['transient'] = f"thumbnail download failed: {e.__class__.__name__}", True
+        except Exception as e:
+            result['reason'] = f"thumbnail failed: {e}"
+    elif content_type not in IMAGE_PREFLIGHT_CONTENT_TYPES:
+        result['reason'] = f"unsupported type {content_type}"
+    elif length is not None and length > IMAGE_PREFLIGHT_MAX_BYTES:
+        result['reason'] = f"too large ({length} bytes)"
+    else:
+        result['send_url'] = url
+    result['ok'] = result['send_url'] is not None
+    return result
+
+
+# --- Cache ---
+class ImagePreflight:
+    """
+    Definitive verdicts per image URL, kept in memory and in the shared state backend (so every worker
+    benefits from one check). Checks run on a small background pool; schedule() queues the URLs that have no
+    fresh verdict here or in the shared state.
+    """
+    def __init__(self, workers: int = IMAGE_PREFLIGHT_WORKERS):
+        self._session = requests.Session()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-preflight")
+        self._results = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fresh(result: dict) -> bool:
+        ttl = IMAGE_PREFLIGHT_TTL_SECONDS if result['ok'] else IMAGE_PREFLIGHT_BAD_TTL_SECONDS
+        return time.time() - result['checked_at'] < ttl
+
+    def _store(self, url: str, result: dict):
+        with self._lock:
+            self._pending.discard(url)
+            if result['transient']:
+                return # Unknown, not bad: the next send tries the original URL and schedules a new check
+            self._results[url] = result
+        ttl = IMAGE_PREFLIGHT_TTL_SECONDS if result['ok'] else IMAGE_PREFLIGHT_BAD_TTL_SECONDS
+        try:
+            get_shared_state().put_value(f"image_preflight:{_url_key(url)}", json.dumps(result), ttl)
+        except Exception as e:
+            logging.error(f"Failed to store image preflight result: {e}")
+
+    def lookup(self, url: str):
+        """
+        The fresh verdict for url, from memory or another worker's check, or None.
+        """
+        result = self._results.get(url)
+        if result is None or not self._fresh(result):
+            try:
+                raw = get_shared_state().get_value(f"image_preflight:{_url_key(url)}")
+            except Exception as e:
+                logging.error(f"Failed to read image preflight result: {e}")
+                raw = None
+            result = json.loads(raw) if raw else None
+            if result is not None:
+                with self._lock:
+                    self._results[url] = result
+        return result if result is not None and self._fresh(result) else None
+
+    def check(self, url: str) -> dict:
+        with timed('image_preflight'):
+            result = check_image_url(self._session, url)
+        if result['transient']:
+            logging.info(f"Catalogue image could not be checked ({result['reason']}); will retry: {url}")
+        elif not result['ok']:
+            logging.warning(f"Catalogue image failed preflight ({result['reason']}): {url}")
+            count_event('image_preflight_rejected')
+        self._store(url, result)
+        return result
+
+    def schedule(self, urls, force: bool = False) -> int:
+        """
+        Queues background checks for URLs without a fresh verdict, in memory or stored by another
+        worker (all of them with force). Returns how many were queued.
+        """
+        with self._lock:
+            due = [url for url in urls if url not in self._pending and (force or url not in self._results or not self._fresh(self._results[url]))]
+        if not force:
+            due = [url for url in due if self.lookup(url) is None]
+        with self._lock:
+            due = [url for url in due if url not in self._pending]
+            self._pending.update(due)
+        for url in due:
+            self._executor.submit(self.check, url)
+        return len(due)
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def delivery_url(self, url: str):
+        """
+        The URL to send for a catalogue image, or None if it is known to be bad. An image without a
+        verdict is sent as is, and checked in the background (a thumbnail can mean downloading and
+        resizing the original, which does not belong on the reply path).
+        """
+        result = self.lookup(url)
+        record_cache_lookup('image_preflight', result is not None)
+        if result is None:
+            self.schedule([url])
+            return url
+        return result['send_url']
+
+
+def get_image_preflight():
+    global _preflight
+    with _preflight_lock:
+        if _preflight is None:
+            _preflight = ImagePreflight()
+            register_queue_depth('image_preflight', _preflight.pending)
+        return _preflight
+
+
+def schedule_catalogue_preflight(df, force: bool = False) -> int:
+    """
+    Queues checks for the catalogue's image URLs that have no fresh verdict; returns how many were
+    queued. This scans the whole catalogue, so it belongs on the sheet sync path, not the reply path.
+    """
+    if not IMAGE_PREFLIGHT_ENABLED or df is None or df.empty:
+        return 0
+    return get_image_preflight().schedule(catalogue_image_urls(df), force)
+
+
+def refresh_catalogue_preflight() -> bool:
+    """
+    Re-checks every image of the property sheet in the background, e.g. after the sheet changed.
+    """
+    df = get_sheet_data()
+    if df.empty:
+        logging.error("Image preflight not refreshed: the property sheet could not be read or is empty.")
+        return False
+    queued = schedule_catalogue_preflight(df, force=True)
+    logging.info(f"Queued preflight checks for {queued} catalogue images.")
+    return True
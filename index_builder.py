@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import logging
+import argparse
+import numpy as np
+import faiss
+
+# --- Configuration ---
+# FAISS index factory string for the RAG vector store, e.g.:
+#   "Flat"              exact brute-force search (default, small stores)
+#   "HNSW32"            graph index, low latency, no training needed
+#   "IVF4096,PQ64"      inverted lists + product quantization, ~48x less memory (needs training)
+#   "OPQ64,IVF65536_HNSW32,PQ64"  for millions of chunks
+RAG_INDEX_FACTORY = os.getenv('RAG_INDEX_FACTORY', 'Flat')
+RAG_HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', 64))
+RAG_IVF_NPROBE = int(os.getenv('RAG_IVF_NPROBE', 16))
+# Maximum number of vectors used to train IVF/PQ indexes.
+RAG_TRAIN_SAMPLE_SIZE = int(os.getenv('RAG_TRAIN_SAMPLE_SIZE', 200000))
+INDEX_FACTORY_FILE = "index_factory.json"
+# Deleted chunks of non-removable indexes stay in the index as tombstones (position -> None) until the
+# offline rebuild compacts them; above this fraction of the index a warning suggests running it.
+TOMBSTONE_WARN_FRACTION = 0.2
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def create_index(dimension: int, factory: str = None):
+    """
+    Creates an empty FAISS index from a factory string (L2 metric, as used by the LangChain FAISS store).
+    """
+    return faiss.index_factory(dimension, factory or RAG_INDEX_FACTORY, faiss.METRIC_L2)
+
+
+def apply_search_params(index):
+    """
+    Applies query-time parameters (HNSW efSearch, IVF nprobe) from the environment to a loaded index.
+    """
+    params = faiss.ParameterSpace()
+    for name, value in (('efSearch', RAG_HNSW_EF_SEARCH), ('nprobe', RAG_IVF_NPROBE)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass # Parameter does not apply to this index type
+    return index
+
+
+def supports_removal(index) -> bool:
+    """
+    Only flat indexes renumber the remaining vectors after remove_ids, which is what the LangChain
+    store's position->ID mapping assumes. HNSW graphs cannot remove at all, and IVF indexes keep the
+    removed labels' gaps and later label new vectors from ntotal, colliding with existing ones.
+    """
+    base_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+    return isinstance(base_index, faiss.IndexFlat)
+
+
+def extract_vectors(index) -> np.ndarray:
+    """
+    Reconstructs all stored vectors in position order (exact for flat/HNSW-flat, approximate for PQ).
+    """
+    ivf_index = None
+    try:
+        ivf_index = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        pass
+    if ivf_index is not None:
+        ivf_index.make_direct_map()
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(vectors: np.ndarray, factory: str = None):
+    """
+    Builds (and trains, if the index type requires it) a FAISS index over vectors, preserving their order
+    so positions keep mapping to the same docstore IDs.
+    """
+    factory = factory or RAG_INDEX_FACTORY
+    index = create_index(vectors.shape[1], factory)
+    if not index.is_trained:
+        sample_size = min(len(vectors), RAG_TRAIN_SAMPLE_SIZE)
+        if sample_size == 0:
+            raise ValueError(f"Index factory '{factory}' needs training data but no vectors were provided.")
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)] if sample_size < len(vectors) else vectors
+        logging.info(f"Training '{factory}' index on {sample_size} vectors...")
+        start = time.perf_counter()
+        index.train(sample)
+        logging.info(f"Training finished in {time.perf_counter() - start:.1f}s.")
+    index.add(vectors)
+    return apply_search_params(index)
+
+
+def delete_from_store(vector_store, ids: list):
+    """
+    Deletes chunks by docstore ID. Index types that cannot remove in place (HNSW, IVF) keep the
+    vectors as tombstones: their positions map to None, which searches skip, so a deletion costs
+    nothing per stored vector. `python index_builder.py rebuild` compacts them away.
+    """
+    if supports_removal(vector_store.index):
+        return vector_store.delete(ids)
+
+    ids_to_remove = set(ids)
+    positions = [position for position, doc_id in vector_store.index_to_docstore_id.items() if doc_id in ids_to_remove]
+    for position in positions:
+        vector_store.index_to_docstore_id[position] = None
+    vector_store.docstore.delete([doc_id for doc_id in ids if doc_id in vector_store.docstore._dict])
+    tombstones = len(vector_store.index_to_docstore_id) - len(vector_store.docstore._dict)
+    logging.info(f"Tombstoned {len(positions)} chunks in non-removable index ({tombstones} of {vector_store.index.ntotal} positions are tombstones).")
+    if tombstones > vector_store.index.ntotal * TOMBSTONE_WARN_FRACTION:
+        logging.warning("Many deleted chunks remain in the index; run 'python index_builder.py rebuild' to compact it.")
+    return True
+
+
+def save_index_factory(store_path: str, factory: str):
+    with open(os.path.join(store_path, INDEX_FACTORY_FILE), 'w') as f:
+        json.dump({'factory': factory, 'built_at': time.time()}, f)
+
+
+def load_index_factory(store_path: str):
+    path = os.path.join(store_path, INDEX_FACTORY_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f).get('factory')
+    except (IOError, json.JSONDecodeError):
+        return None
+
+
+# --- Recall / Latency Evaluation ---
+def _timed_search(index, queries: np.ndarray, k: int):
+    latencies = []
+    results = np.empty((len(queries), k), dtype=np.int64)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, positions = index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results[i] = positions[0]
+    return results, np.array(latencies)
+
+
+def evaluate_index(candidate_index, vectors: np.ndarray, num_queries: int = 200, k: int = 10) -> dict:
+    """
+    Compares a candidate index against an exact flat baseline over the same vectors.
+    Queries are stored vectors with small Gaussian noise, so they resemble real embeddings.
+    Returns recall@k and per-query latency percentiles (ms) for both indexes.
+    """
+    if len(vectors) == 0:
+        return {}
+    rng = np.random.default_rng(1)
+    query_positions = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+    noise_scale = float(vectors.std()) * 0.1
+    queries = (vectors[query_positions] + rng.normal(0, noise_scale, (len(query_positions), vectors.shape[1]))).astype(np.float32)
+    k = min(k, len(vectors))
+
+    baseline = faiss.IndexFlatL2(vectors.shape[1])
+    baseline.add(vectors)
+    exact, baseline_latencies = _timed_search(baseline, queries, k)
+    approximate, candidate_latencies = _timed_search(candidate_index, queries, k)
+
+    hits = sum(len(set(exact[i]) & set(approximate[i])) for i in range(len(queries)))
+    return {
+        'queries': len(queries),
+        'k': k,
+        'recall_at_k': hits / (len(queries) * k),
+        'baseline_p50_ms': float(np.percentile(baseline_latencies, 50)),
+        'baseline_p95_ms': float(np.percentile(baseline_latencies, 95)),
+        'candidate_p50_ms': float(np.percentile(candidate_latencies, 50)),
+        'candidate_p95_ms': float(np.percentile(candidate_latencies, 95)),
+        'baseline_bytes': vectors.nbytes,
+        'candidate_bytes': len(faiss.serialize_index(candidate_index)),
+    }
+
+
+def print_report(report: dict, factory: str):
+    if not report:
+        print("No vectors to evaluate.")
+        return
+    print(f"Index '{factory}' vs Flat baseline ({report['queries']} queries, k={report['k']}):")
+    print(f"  recall@{report['k']}:      {report['recall_at_k']:.3f}")
+    print(f"  latency p50/p95: {report['candidate_p50_ms']:.3f} / {report['candidate_p95_ms']:.3f} ms (flat: {report['baseline_p50_ms']:.3f} / {report['baseline_p95_ms']:.3f} ms)")
+    print(f"  size:            {report['candidate_bytes'] / 1e6:.1f} MB (flat vectors: {report['baseline_bytes'] / 1e6:.1f} MB)")
+
+
+# --- Offline Rebuild Command ---
+def rebuild_store_index(store_path: str, factory: str, evaluate: bool = True, num_queries: int = 200, k: int = 10, dry_run: bool = False) -> dict:
+    """
+    Migrates an existing faiss_index/ directory to a new index type. Vectors are re-added in the same
+    order, so the pickled docstore and position->ID mapping (index.pkl) stay valid. Tombstoned
+    positions (deleted chunks, mapped to None) are dropped, and only then is the mapping renumbered.
+    The previous files are kept as index.faiss.bak and index.pkl.bak.
+    """
+    index_path = os.path.join(store_path, "index.faiss")
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No FAISS index found at {index_path}")
+
+    current_index = faiss.read_index(index_path)
+    logging.info(f"Loaded index with {current_index.ntotal} vectors of dimension {current_index.d} from {index_path}.")
+    vectors = extract_vectors(current_index)
+    mapping_path = os.path.join(store_path, "index.pkl")
+    with open(mapping_path, 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    kept_positions = [position for position, doc_id in sorted(index_to_docstore_id.items()) if doc_id is not None]
+    compacted = len(kept_positions) < len(index_to_docstore_id)
+    if compacted:
+        vectors = vectors[kept_positions]
+        index_to_docstore_id = {new_position: index_to_docstore_id[old_position] for new_position, old_position in enumerate(kept_positions)}
+        logging.info(f"Dropping {current_index.ntotal - len(kept_positions)} tombstoned positions.")
+    if load_index_factory(store_path) not in (None, 'Flat'):
+        logging.warning("Source index is not flat; reconstructed vectors may be approximate (PQ) and the baseline is only as exact as they are.")
+
+    start = time.perf_counter()
+    new_index = build_index(vectors, factory)
+    logging.info(f"Built '{factory}' index with {new_index.ntotal} vectors in {time.perf_counter() - start:.1f}s.")
+
+    report = evaluate_index(new_index, vectors, num_queries, k) if evaluate else {}
+    if report:
+        print_report(report, factory)
+
+    if dry_run:
+        logging.info("Dry run: existing index left unchanged.")
+        return report
+
+    tmp_path = f"{index_path}.tmp"
+    faiss.write_index(new_index, tmp_path)
+    if compacted:
+        with open(f"{mapping_path}.tmp", 'wb') as f:
+            pickle.dump((docstore, index_to_docstore_id), f)
+        shutil.copy2(mapping_path, f"{mapping_path}.bak")
+    shutil.copy2(index_path, f"{index_path}.bak")
+    os.replace(tmp_path, index_path)
+    if compacted:
+        os.replace(f"{mapping_path}.tmp", mapping_path)
+    save_index_factory(store_path, factory)
+    logging.info(f"Replaced {index_path} with '{factory}' index (previous index saved as index.faiss.bak).")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train/rebuild the RAG FAISS index with a different index type and report recall/latency against a flat baseline.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = subparsers.add_parser('rebuild', help="Rebuild faiss_index/ with a new index factory.")
+    rebuild_parser.add_argument('--path', default="faiss_index", help="Vector store directory (default: faiss_index)")
+    rebuild_parser.add_argument('--factory', default=RAG_INDEX_FACTORY, help="FAISS index factory string, e.g. HNSW32 or IVF4096,PQ64")
+    rebuild_parser.add_argument('--queries', type=int, default=200, help="Number of evaluation queries")
+    rebuild_parser.add_argument('--k', type=int, default=10, help="k for recall@k")
+    rebuild_parser.add_argument('--no-eval', action='store_true', help="Skip recall/latency evaluation")
+    rebuild_parser.add_argument('--dry-run', action='store_true', help="Build and evaluate without replacing the index")
+
+    report_parser = subparsers.add_parser('report', help="Evaluate a factory against the flat baseline without modifying anything.")
+    report_parser.add_argument('--path', default="faiss_index")
+    report_parser.add_argument('--factory', default=RAG_INDEX_FACTORY)
+    report_parser.add_argument('--queries', type=int, default=200)
+    report_parser.add_argument('--k', type=int, default=10)
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'rebuild':
+            rebuild_store_index(args.path, args.factory, evaluate=not args.no_eval, num_queries=args.queries, k=args.k, dry_run=args.dry_run)
+        else:
+            rebuild_store_index(args.path, args.factory, evaluate=True, num_queries=args.queries, k=args.k, dry_run=True)
+    except Exception as e:
+        logging.error(f"Index rebuild failed: {e}", exc_info=True)
+        sys.exit(1)
@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import fcntl
+import signal
+import logging
+import argparse
+from dotenv import load_dotenv
+from rag_handler import (
+    VECTOR_STORE_PATH,
+    initialize_vector_store,
+    process_document,
+    get_processed_files_log,
+    remove_document_from_store,
+    process_google_document_text
+)
+from google_drive_handler import (
+    get_google_drive_file_mime_type,
+    get_google_doc_content,
+    get_google_sheet_content
+)
+from shared_index import RAG_SHARED_INDEX
+from job_queue import JobQueue, enqueue_job, JOB_GOOGLE_DOCUMENT, JOB_COMPANY_DATA_SCAN, JOB_IMAGE_INDEX
+from image_index import refresh_from_sheet as refresh_image_index
+from metrics import timed
+from tracing import span
+
+load_dotenv()
+
+# --- Configuration ---
+COMPANY_DATA_FOLDER = 'company_data'
+# 'inline': web workers apply document updates themselves in a background thread.
+# 'external': web workers only enqueue jobs; this process is the single writer of faiss_index/
+#             and publishes snapshots that the (read-only) workers swap to. Requires RAG_SHARED_INDEX=true.
+RAG_INDEXER_MODE = os.getenv('RAG_INDEXER_MODE', 'inline').lower()
+INDEXER_POLL_SECONDS = float(os.getenv('INDEXER_POLL_SECONDS', 1))
+INDEXER_LOCK_FILE = os.path.join(VECTOR_STORE_PATH, ".indexer.lock")
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Company Data Folder ---
+def find_company_data_changes():
+    """
+    Compares the company data folder with the processed files log without touching the vector store.
+    Returns (files_to_process, files_to_remove), or None if the folder cannot be read.
+    """
+    if not os.path.exists(COMPANY_DATA_FOLDER) or not os.path.isdir(COMPANY_DATA_FOLDER):
+        logging.error(f"scan_company_data_folder: Company data folder '{COMPANY_DATA_FOLDER}' not found or is not a directory. Aborting scan.")
+        return None
+    processed_log = get_processed_files_log()
+    current_file_paths_in_folder = []
+    try:
+        for filename in os.listdir(COMPANY_DATA_FOLDER):
+            full_path = os.path.join(COMPANY_DATA_FOLDER, filename)
+            if os.path.isfile(full_path):
+                if filename.endswith(('.txt', '.pdf')) and not filename.startswith('.'):
+                    current_file_paths_in_folder.append(full_path)
+                elif not filename.startswith('.'):
+                    logging.debug(f"scan_company_data_folder: Skipping unsupported file type or hidden file: {filename}")
+    except Exception as e:
+        logging.error(f"scan_company_data_folder: Error listing files in {COMPANY_DATA_FOLDER}: {e}", exc_info=True)
+        return None
+    files_to_process = []
+    for file_path in current_file_paths_in_folder:
+        try:
+            file_mtime = os.path.getmtime(file_path)
+        except FileNotFoundError:
+            logging.warning(f"scan_company_data_folder: File '{file_path}' found during scan but disappeared before processing. Skipping.")
+            continue
+        file_info = processed_log.get(file_path)
+        if file_info and file_info.get('mtime') == file_mtime and file_info.get('status') == 'processed':
+            logging.debug(f"scan_company_data_folder: File '{file_path}' is unchanged and already processed. Skipping.")
+            continue
+        files_to_process.append(file_path)
+    files_to_remove = []
+    for file_path, file_info in processed_log.items():
+        # Handles absolute paths and relative paths, whichever way they were stored
+        if file_path.startswith(os.path.abspath(COMPANY_DATA_FOLDER) + os.sep) or file_path.startswith(COMPANY_DATA_FOLDER + os.sep):
+            if file_path not in current_file_paths_in_folder and file_info.get('status') == 'processed':
+                files_to_remove.append(file_path)
+    return files_to_process, files_to_remove
+
+@timed('company_data_scan')
+def scan_company_data_folder(vector_store: object, embeddings: object, changes=None):
+    logging.info(f"Starting scan of company data folder: {COMPANY_DATA_FOLDER}")
+    if not vector_store or not embeddings:
+        logging.error("scan_company_data_folder: Vector store or embeddings not initialized. Aborting scan.")
+        return
+    changes = changes or find_company_data_changes()
+    if changes is None:
+        return
+    files_to_process, files_to_remove = changes
+    for file_path in files_to_process:
+        try:
+            logging.info(f"scan_company_data_folder: Processing new or modified file: {file_path}")
+            process_document(file_path, vector_store, embeddings)
+        except FileNotFoundError:
+            logging.warning(f"scan_company_data_folder: File '{file_path}' found during scan but disappeared before processing. Skipping.")
+        except Exception as e:
+            logging.error(f"scan_company_data_folder: Error processing file '{file_path}': {e}", exc_info=True)
+    for file_path in files_to_remove:
+        logging.info(f"scan_company_data_folder: File '{file_path}' appears to be removed from source folder.")
+        remove_document_from_store(file_path, vector_store)
+    logging.info(f"Scan of company data folder: {COMPANY_DATA_FOLDER} complete.")
+
+
+# --- Google Drive Documents ---
+@timed('document_sync')
+def sync_google_document(document_id: str, vector_store, embeddings) -> bool:
+    """
+    Fetches a Google Doc or Sheet based on its MIME type and replaces its chunks in the vector store.
+    Returns False if the document could not be fetched or indexed (the job should be retried).
+    """
+    # Get MIME type of the Google Drive file
+    with span('drive_mime_type', document_id=document_id):
+        mime_type = get_google_drive_file_mime_type(document_id)
+    if mime_type is None:
+        logging.error(f"Sync for {document_id}: Failed to fetch MIME type, or file not found/accessible. Aborting RAG update.")
+        return False
+
+    text_content = None
+    # Fetch content based on MIME type
+    if mime_type == 'application/vnd.google-apps.document':
+        logging.info(f"Document ID {document_id} is a Google Doc. Fetching content...")
+        with span('drive_fetch', document_id=document_id, mime_type='document'):
+            text_content = get_google_doc_content(document_id)
+    elif mime_type == 'application/vnd.google-apps.spreadsheet':
+        logging.info(f"Document ID {document_id} is a Google Sheet. Fetching content...")
+        with span('drive_fetch', document_id=document_id, mime_type='spreadsheet'):
+            text_content = get_google_sheet_content(document_id)
+    else:
+        logging.warning(f"Unsupported MIME type '{mime_type}' for document ID {document_id}. Skipping RAG processing.")
+        return True # Nothing to index; retrying would not help
+
+    # Process content if it was successfully fetched
+    if text_content is None:
+        # This case implies get_google_doc_content or get_google_sheet_content returned None
+        logging.error(f"Failed to fetch content for document ID {document_id} (MIME type: {mime_type}). RAG store not updated.")
+        return False
+
+    logging.info(f"Successfully fetched content for {document_id}. Length: {len(text_content)}. Processing for RAG...")
+    success = process_google_document_text(document_id, text_content, vector_store, embeddings)
+    if success:
+        logging.info(f"Successfully processed and updated RAG store for document ID {document_id}.")
+    else:
+        logging.error(f"Failed to process document ID {document_id} for RAG store.")
+    return success
+
+
+# --- Indexer Process ---
+class Indexer:
+    """
+    The single writer of faiss_index/. Holds the writable store, applies queued jobs one at a time,
+    and each save publishes a new snapshot generation for the web workers.
+    """
+    def __init__(self, queue: JobQueue = None):
+        self.queue = queue or JobQueue()
+        self.vector_store = None
+        self._stopping = False
+
+    def stop(self, *_):
+        logging.info("Indexer stopping after the current job.")
+        self._stopping = True
+
+    def start(self) -> bool:
+        self.vector_store = initialize_vector_store()
+        if not self.vector_store:
+            logging.critical("Indexer could not load or create the vector store.")
+            return False
+        self.queue.recover()
+        return True
+
+    def run_job(self, kind: str, payload: dict) -> bool:
+        embeddings = self.vector_store.embedding_function
+        if kind == JOB_GOOGLE_DOCUMENT:
+            return sync_google_document(payload['document_id'], self.vector_store, embeddings)
+        if kind == JOB_COMPANY_DATA_SCAN:
+            scan_company_data_folder(self.vector_store, embeddings)
+            return True
+        if kind == JOB_IMAGE_INDEX:
+            return refresh_image_index()
+        logging.error(f"Unknown index job kind '{kind}'. Dropping it.")
+        return True
+
+    def run_once(self) -> bool:
+        """
+        Runs the next due job, if any. Returns True if a job was run.
+        """
+        job = self.queue.claim_next()
+        if not job:
+            return False
+        job_id, kind, payload, attempts = job
+        start = time.perf_counter()
+        try:
+            succeeded = self.run_job(kind, payload)
+        except Exception as e:
+            logging.error(f"Index job {job_id} ({kind}) raised: {e}", exc_info=True)
+            self.queue.fail(job_id, attempts, str(e))
+            return True
+        if succeeded:
+            self.queue.complete(job_id)
+            logging.info(f"Index job {job_id} ({kind}) finished in {time.perf_counter() - start:.1f}s.")
+        else:
+            self.queue.fail(job_id, attempts, "Job reported failure; see indexer log.")
+        return True
+
+    def run_forever(self):
+        while not self._stopping:
+            if not self.run_once():
+                time.sleep(INDEXER_POLL_SECONDS)
+
+
+def acquire_indexer_lock():
+    """
+    Ensures only one indexer runs against faiss_index/. Returns the open lock file, or None if held.
+    """
+    os.makedirs(VECTOR_STORE_PATH, exist_ok=True)
+    lock_file = open(INDEXER_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Single-writer indexing process: applies queued document updates to faiss_index/ and publishes snapshots.")
+    parser.add_argument('--once', action='store_true', help="Run the jobs that are due now, then exit")
+    parser.add_argument('--no-scan', action='store_true', help="Do not queue a company_data scan at startup")
+    args = parser.parse_args()
+
+    if not RAG_SHARED_INDEX:
+        logging.critical("The indexer publishes snapshots for the web workers; set RAG_SHARED_INDEX=true.")
+        sys.exit(1)
+    lock = acquire_indexer_lock()
+    if lock is None:
+        logging.critical(f"Another indexer holds {INDEXER_LOCK_FILE}. Exiting.")
+        sys.exit(1)
+
+    indexer = Indexer()
+    if not indexer.start():
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, indexer.stop)
+    signal.signal(signal.SIGINT, indexer.stop)
+    if not args.no_scan:
+        enqueue_job(JOB_COMPANY_DATA_SCAN, {}, dedupe_key=JOB_COMPANY_DATA_SCAN)
+
+    if args.once:
+        while indexer.run_once():
+            pass
+    else:
+        logging.info(f"Indexer running (queue: {indexer.queue.depth()}).")
+        indexer.run_forever()
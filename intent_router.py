@@ -0,0 +1,143 @@
+import re
+from datetime_extractor import normalize, MONTHS, WEEKDAYS, RELATIVE_DAYS
+
+INTENT_COMMAND = 'command'
+INTENT_SCHEDULING = 'scheduling'
+INTENT_PROPERTY_SEARCH = 'property_search'
+INTENT_SMALLTALK = 'smalltalk'
+
+# --- Bot Commands ---
+# Case-insensitive, on the stripped body: "bot pause all" wins over "bot pause <target>", and a command
+# without its argument is not a command. Arguments keep their case (Google Sheet IDs are case-sensitive).
+COMMAND_PATTERN = re.compile(
+    r"bot (?:(?P<pause_all>pause all)$|(?P<resume_all>resume all)$|pause (?P<pause>.*)|resume (?P<resume>.*)"
+    r"|(?P<start_outreach>start outreach)(?:$| (?P<sheet>.*)))",
+    re.DOTALL | re.IGNORECASE
+)
+
+# --- Keyword Vocabulary (normalized spellings) ---
+SIGNAL_SCHEDULING = 'scheduling'
+SIGNAL_PROPERTY = 'property'
+SIGNAL_TIME = 'time'
+SIGNAL_DATE = 'date'
+
+SCHEDULING_WORDS = [
+    'appointment', 'appointments', 'schedule', 'scheduling', 'book', 'booking', 'meeting', 'consultation',
+    'reserve', 'reservation', 'visit', 'viewing', 'session', 'call', 'meet',
+]
+TIME_WORDS = ['morning', 'afternoon', 'evening', "o'clock", 'time'] + [day for day in WEEKDAYS if day.isascii() and len(day) > 3]
+PROPERTY_WORDS = [
+    'bedroom', 'bedrooms', 'bed', 'beds', 'br', 'bhk', 'villa', 'villas', 'apartment', 'apartments', 'flat', 'flats',
+    'townhouse', 'townhouses', 'penthouse', 'penthouses', 'studio', 'studios', 'duplex', 'property', 'properties',
+    'listing', 'listings', 'aed', 'dirham', 'dirhams', 'million', 'budget', 'price', 'sqft',
+]
+DATE_WORDS = [month for month in MONTHS if month.isascii() and len(month) > 3] # "may", "mar" etc. are too ambiguous
+PHRASES = { # Multi-word entries, found by substring search
+    'next week': SIGNAL_TIME, 'for sale': SIGNAL_PROPERTY, 'for rent': SIGNAL_PROPERTY,
+    'sq ft': SIGNAL_PROPERTY, 'تاون هاوس': SIGNAL_PROPERTY,
+}
+# Arabic attaches و/ب/ل/ال to the front of words and pronouns or dual/plural endings to the end, so an
+# Arabic token matches when, after an optional prefix, it starts with one of these stems.
+ARABIC_STEMS = {
+    SIGNAL_SCHEDULING: ['موعد', 'مواعيد', 'احجز', 'حجز', 'معاينه', 'زياره', 'اجتماع', 'مقابله'],
+    SIGNAL_PROPERTY: ['شقه', 'شقق', 'شقت', 'فيلا', 'فلل', 'فله', 'بنتهاوس', 'استوديو', 'غرفه', 'غرف', 'غرفت',
+                      'درهم', 'مليون', 'ميزانيه', 'سعر', 'بيع', 'ايجار', 'عقار'],
+    SIGNAL_TIME: [day for day in WEEKDAYS if not day.isascii()] + ['الساعه', 'ساعه'],
+    SIGNAL_DATE: [month for month in MONTHS if not month.isascii()],
+}
+ARABIC_PREFIXES = ('وال', 'بال', 'لل', 'ال', 'و', 'ب', 'ل')
+
+WORD_SIGNALS = {}
+for _signal, _words in ((SIGNAL_SCHEDULING, SCHEDULING_WORDS), (SIGNAL_TIME, TIME_WORDS), (SIGNAL_PROPERTY, PROPERTY_WORDS), (SIGNAL_DATE, DATE_WORDS)):
+    WORD_SIGNALS.update(dict.fromkeys(_words, _signal))
+for _phrase, _days in RELATIVE_DAYS: # today, tomorrow, بكره, "day after tomorrow"...
+    if ' ' in _phrase:
+        PHRASES[_phrase] = SIGNAL_TIME
+    else:
+        WORD_SIGNALS[_phrase] = SIGNAL_TIME
+VOCABULARY = frozenset(WORD_SIGNALS)
+# One pass over the whole message finds every word starting with an optional prefix and a stem; the
+# group that matched is the signal. Looking each word up by its leading characters was slower.
+ARABIC_PATTERN = re.compile(
+    r"(?<!\S)(?:" + "|".join(ARABIC_PREFIXES) + r")?(?:"
+    + "|".join(f"(?P<{signal}>{'|'.join(sorted(stems, key=len, reverse=True))})" for signal, stems in ARABIC_STEMS.items())
+    + ")"
+)
+
+# Punctuation that may touch a word; it becomes a space so str.split() yields bare words. The apostrophe
+# stays for "o'clock". str.translate is slow on non-ASCII text, so ASCII text goes through bytes.translate
+# and the rest through a regex.
+PUNCTUATION_CHARACTERS = '.?!,;:/()"[]{}<>*~`-'
+PUNCTUATION = re.compile(f"[{re.escape(PUNCTUATION_CHARACTERS + '؟،؛')}]")
+ASCII_PUNCTUATION = bytes.maketrans(PUNCTUATION_CHARACTERS.encode(), b' ' * len(PUNCTUATION_CHARACTERS))
+# Times, dates and bedroom counts at the start of a word ("3 pm" and "2 br" span two words). The pattern
+# starts with the digit and checks the word boundary behind it, so the scan skips ahead to digits in C.
+NUMERIC_PATTERN = re.compile(
+    r"[0-9](?<!\S[0-9])[0-9]?(?:(?P<time>(?::[0-9]{2})? ?(?:am|pm|a\.m|p\.m)|:[0-9]{2})"
+    r"|(?P<date>/[0-9]{1,2}(?:/[0-9]{2,4})?|-[0-9]{1,2}-[0-9]{2,4}|st|nd|rd|th)" # Dashes only with a year: "2-3 bedrooms" is not a date
+    r"|(?P<property> ?(?:br|bed|beds|bedroom|bedrooms|bhk)))(?![\w])"
+)
+DIGIT_PATTERN = re.compile(r"[0-9]")
+SMALLTALK_PHRASES = [
+    'hi', 'hii', 'hello', 'hey', 'hey there', 'hello there', 'good morning', 'good afternoon', 'good evening',
+    'thanks', 'thank you', 'thank you so much', 'thanks a lot', 'thx', 'ok', 'okay', 'ok thanks', 'okay thanks',
+    'great', 'perfect', 'cool', 'bye', 'goodbye', 'see you',
+    'مرحبا', 'اهلا', 'هلا', 'السلام عليكم', 'سلام', 'صباح الخير', 'مساء الخير', 'شكرا', 'شكرا جزيلا', 'مشكور', 'تمام', 'اوكي', 'مع السلامه',
+]
+SMALLTALK = set(SMALLTALK_PHRASES)
+SMALLTALK_MAX_LENGTH = 40 # Longer messages are never just a greeting, so they skip the check
+
+
+# --- Routing ---
+def match_command(text: str):
+    """
+    The bot command in text as {'intent': 'command', 'command': ..., 'argument': ...}, or None.
+    Commands are pause_all, resume_all, pause, resume (argument: target) and start_outreach
+    (argument: sheet ID or URL, None when omitted).
+    """
+    match = COMMAND_PATTERN.match(text.strip())
+    if not match:
+        return None
+    command = match.lastgroup if match.lastgroup != 'sheet' else 'start_outreach'
+    target = match.group('pause') or match.group('resume')
+    argument = target.lower() if target else match.group('sheet') # Pause targets are matched lowercased, as before
+    return {'intent': INTENT_COMMAND, 'command': command, 'argument': argument.strip() if argument else None}
+
+def keyword_signals(text: str) -> set:
+    """
+    Which of scheduling, property, time and date vocabulary occurs in text (normalized). Words are
+    looked up in one set intersection, so the vocabulary size does not affect speed.
+    """
+    is_ascii = text.isascii()
+    spaced = text.encode().translate(ASCII_PUNCTUATION).decode() if is_ascii else PUNCTUATION.sub(' ', text)
+    words = spaced.split()
+    signals = {WORD_SIGNALS[word] for word in VOCABULARY.intersection(words)}
+    for phrase, signal in PHRASES.items():
+        if signal not in signals and phrase in text:
+            signals.add(signal)
+    if DIGIT_PATTERN.search(text):
+        signals.update(match.lastgroup for match in NUMERIC_PATTERN.finditer(text))
+    if not is_ascii:
+        signals.update(match.lastgroup for match in ARABIC_PATTERN.finditer(spaced))
+    return signals
+
+def route_message(text: str) -> dict:
+    """
+    Pre-classifies an incoming message without the LLM. 'intent' is 'command' (with 'command' and
+    'argument'), 'property_search' (property vocabulary wins over scheduling words), 'scheduling',
+    'smalltalk', or None when nothing obvious matched and the LLM analysis should decide.
+    """
+    command = match_command(text)
+    if command:
+        return command
+    normalized = normalize(text)
+    signals = keyword_signals(normalized)
+    if 'property' in signals: # "Book a viewing of a 3 bedroom villa" still needs the property search
+        intent = INTENT_PROPERTY_SEARCH
+    elif 'scheduling' in signals or ('time' in signals and 'date' in signals):
+        intent = INTENT_SCHEDULING
+    elif len(normalized) <= SMALLTALK_MAX_LENGTH and " ".join(PUNCTUATION.sub(' ', normalized).split()) in SMALLTALK: # "Thanks!!", "ok." too
+        intent = INTENT_SMALLTALK
+    else:
+        intent = None
+    return {'intent': intent, 'signals': signals}
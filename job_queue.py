@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# --- Configuration ---
+INDEX_JOB_QUEUE_PATH = os.getenv('INDEX_JOB_QUEUE_PATH', os.path.join("faiss_index", "index_jobs.sqlite3"))
+# Failed jobs are retried until they have been attempted this many times.
+INDEX_JOB_MAX_ATTEMPTS = int(os.getenv('INDEX_JOB_MAX_ATTEMPTS', 3))
+# Delay before a failed job is retried, multiplied by the number of attempts so far.
+INDEX_JOB_RETRY_DELAY_SECONDS = float(os.getenv('INDEX_JOB_RETRY_DELAY_SECONDS', 30))
+# Finished jobs older than this are deleted when the indexer starts.
+INDEX_JOB_RETENTION_SECONDS = int(os.getenv('INDEX_JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_GOOGLE_DOCUMENT = 'google_document'
+JOB_COMPANY_DATA_SCAN = 'company_data_scan'
+JOB_IMAGE_INDEX = 'image_index'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    dedupe_key TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    not_before REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_dedupe_key ON jobs (dedupe_key, status);
+"""
+
+
+# Queue files whose schema this process has already created, and the cached connections that
+# pending_job_count reads through (one per file, shared by threads under its lock).
+_initialized_paths = set()
+_read_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _connect(path: str = None) -> sqlite3.Connection:
+    path = path or INDEX_JOB_QUEUE_PATH
+    # Autocommit mode; write transactions are opened explicitly with BEGIN IMMEDIATE.
+    with _connections_lock:
+        if path in _initialized_paths:
+            return sqlite3.connect(path, timeout=30, isolation_level=None)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL") # Persistent, so only set when the schema is created
+        conn.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+        return conn
+
+
+def _read_connection(path: str = None):
+    """
+    A cached query-only connection to the queue file, and the lock that serializes its use across threads.
+    """
+    path = path or INDEX_JOB_QUEUE_PATH
+    entry = _read_connections.get(path)
+    if entry is None:
+        _connect(path).close() # Creates the file and schema on first use
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+        with _connections_lock:
+            entry = _read_connections.setdefault(path, (conn, threading.Lock()))
+        if entry[0] is not conn:
+            conn.close() # Another thread cached one first
+    return entry
+
+
+def enqueue_job(kind: str, payload: dict, dedupe_key: str = None, path: str = None):
+    """
+    Adds a job for the indexer. If a job with the same dedupe_key is still pending, no new job is added
+    (repeated saves of one Drive document collapse into one re-index). Returns the job ID.
+    """
+    conn = _connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if dedupe_key:
+            row = conn.execute("SELECT id FROM jobs WHERE dedupe_key = ? AND status = ?", (dedupe_key, JOB_PENDING)).fetchone()
+            if row:
+                conn.execute("COMMIT")
+                logging.info(f"Index job for '{dedupe_key}' is already pending (job {row[0]}).")
+                return row[0]
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO jobs (kind, payload, dedupe_key, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), dedupe_key, JOB_PENDING, now, now),
+        )
+        conn.execute("COMMIT")
+        logging.info(f"Queued index job {cursor.lastrowid} ({kind}).")
+        return cursor.lastrowid
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def pending_job_count(path: str = None) -> int:
+    """
+    Number of jobs waiting for the indexer (exported as a queue depth on /metrics).
+    """
+    conn, lock = _read_connection(path)
+    with lock:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (JOB_PENDING,)).fetchone()[0]
+
+
+class JobQueue:
+    """
+    Consumer side of the index job queue. Only the indexer process uses this.
+    """
+    def __init__(self, path: str = None):
+        self.conn = _connect(path)
+
+    def recover(self):
+        """
+        Returns jobs left running by a crashed indexer to the queue and deletes old finished jobs.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        recovered = self.conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?", (JOB_PENDING, now, JOB_RUNNING)).rowcount
+        self.conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (JOB_DONE, JOB_FAILED, now - INDEX_JOB_RETENTION_SECONDS))
+        self.conn.execute("COMMIT")
+        if recovered:
+            logging.warning(f"Re-queued {recovered} index jobs left running by a previous indexer.")
+
+    def claim_next(self):
+        """
+        Marks the oldest pending job as running and returns (id, kind, payload, attempts), or None.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status = ? AND not_before <= ? ORDER BY id LIMIT 1", (JOB_PENDING, time.time())).fetchone()
+            if not row:
+                self.conn.execute("COMMIT")
+                return None
+            self.conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?", (JOB_RUNNING, time.time(), row[0]))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+    def complete(self, job_id: int):
+        self.conn.execute("UPDATE jobs SET status = ?, error = NULL, updated_at = ? WHERE id = ?", (JOB_DONE, time.time(), job_id))
+
+    def fail(self, job_id: int, attempts: int, error: str):
+        """
+        Puts a failed job back in the queue after a backoff, or marks it failed once INDEX_JOB_MAX_ATTEMPTS is reached.
+        """
+        now = time.time()
+        status = JOB_PENDING if attempts < INDEX_JOB_MAX_ATTEMPTS else JOB_FAILED
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, not_before = ?, updated_at = ? WHERE id = ?",
+            (status, error, now + INDEX_JOB_RETRY_DELAY_SECONDS * attempts, now, job_id),
+        )
+        logging.error(f"Index job {job_id} failed (attempt {attempts}/{INDEX_JOB_MAX_ATTEMPTS}): {error}")
+
+    def depth(self) -> dict:
+        """
+        Number of jobs per status.
+        """
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
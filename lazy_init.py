@@ -0,0 +1,135 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# --- Configuration ---
+# How long a request waits for a component that is still initializing before carrying on without it.
+LAZY_INIT_WAIT_SECONDS = float(os.getenv('LAZY_INIT_WAIT_SECONDS', 30))
+
+STATUS_PENDING = 'pending'
+STATUS_INITIALIZING = 'initializing'
+STATUS_READY = 'ready'
+STATUS_UNAVAILABLE = 'unavailable' # Initializer returned None (e.g. credentials not configured)
+STATUS_FAILED = 'failed'
+
+
+class Component:
+    """
+    A named piece of startup work (client, index, service). Its initializer runs once, in a background
+    thread, after the components it depends on have settled; the result is published through a future.
+    """
+    def __init__(self, name: str, initializer, depends_on=(), required: bool = True, eager: bool = True):
+        self.name = name
+        self.initializer = initializer
+        self.depends_on = tuple(depends_on)
+        self.required = required
+        self.eager = eager
+        self.future = Future()
+        self.status = STATUS_PENDING
+        self.error = None
+        self.started_at = None
+        self.duration = None
+        self._started = False
+
+
+class ComponentRegistry:
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, initializer, depends_on=(), required: bool = True, eager: bool = True) -> Component:
+        """
+        Registers an initializer. Components whose failure should not mark the app as not ready
+        (optional integrations, background scans) are registered with required=False. Components
+        registered with eager=False are only initialized when first requested.
+        """
+        with self._lock:
+            if name in self._components:
+                raise ValueError(f"Component '{name}' is already registered.")
+            component = Component(name, initializer, depends_on, required, eager)
+            self._components[name] = component
+            return component
+
+    def start(self, name: str = None):
+        """
+        Starts initializing one component (and its dependencies), or every eager component.
+        Never blocks; safe to call repeatedly.
+        """
+        names = [name] if name else [n for n, c in self._components.items() if c.eager]
+        for component_name in names:
+            component = self._components[component_name]
+            with self._lock:
+                if component._started:
+                    continue
+                component._started = True
+            for dependency in component.depends_on:
+                self.start(dependency)
+            threading.Thread(target=self._run, args=(component,), name=f"init-{component_name}", daemon=True).start()
+
+    def _run(self, component: Component):
+        for dependency in component.depends_on:
+            try:
+                self._components[dependency].future.result()
+            except Exception:
+                pass # The dependent's initializer decides what to do with a missing dependency
+        component.status = STATUS_INITIALIZING
+        component.started_at = time.time()
+        start = time.perf_counter()
+        logging.info(f"Initializing component '{component.name}'...")
+        try:
+            value = component.initializer()
+        except Exception as e:
+            component.duration = time.perf_counter() - start
+            component.status = STATUS_FAILED
+            component.error = str(e)
+            logging.error(f"Component '{component.name}' failed to initialize after {component.duration:.2f}s: {e}", exc_info=True)
+            component.future.set_result(None)
+            return
+        component.duration = time.perf_counter() - start
+        component.status = STATUS_READY if value is not None else STATUS_UNAVAILABLE
+        logging.info(f"Component '{component.name}' {component.status} in {component.duration:.2f}s.")
+        component.future.set_result(value)
+
+    def get(self, name: str, timeout: float = None):
+        """
+        Returns the component's value, starting it if needed and waiting up to timeout seconds
+        (LAZY_INIT_WAIT_SECONDS by default). Returns None if it is unavailable, failed or still initializing.
+        """
+        component = self._components[name]
+        self.start(name)
+        try:
+            return component.future.result(timeout=LAZY_INIT_WAIT_SECONDS if timeout is None else timeout)
+        except FutureTimeoutError:
+            logging.warning(f"Component '{name}' is still initializing after {LAZY_INIT_WAIT_SECONDS if timeout is None else timeout}s; continuing without it.")
+            return None
+
+    def peek(self, name: str):
+        """
+        Returns the component's value if it has finished initializing, without waiting or starting it.
+        """
+        component = self._components[name]
+        return component.future.result() if component.future.done() else None
+
+    def is_ready(self) -> bool:
+        return all(c.status == STATUS_READY for c in self._components.values() if c.required and c.eager)
+
+    def status_report(self) -> dict:
+        report = {}
+        for name, component in self._components.items():
+            entry = {'status': component.status, 'required': component.required}
+            if component.duration is not None:
+                entry['init_seconds'] = round(component.duration, 3)
+            elif component.started_at is not None:
+                entry['elapsed_seconds'] = round(time.time() - component.started_at, 3)
+            if component.depends_on:
+                entry['depends_on'] = list(component.depends_on)
+            if component.error:
+                entry['error'] = component.error
+            report[name] = entry
+        return report
+
+
+# Process-wide registry used by script.py
+components = ComponentRegistry()
@@ -0,0 +1,56 @@
+"""
+Boots script.app for a load test. OpenAI and WaSender are pointed at the fakes through their
+normal environment variables (set by loadtest.run); Google API traffic (Sheets, Docs, Drive,
+Calendar, Gemini embeddings, OAuth tokens) has no endpoint setting, so its HTTPS requests are
+rewritten here to http://<fake>/<host>/<path> before script.py is imported.
+
+Run by loadtest.run, either directly or as `gunicorn loadtest.app_under_test:app`.
+"""
+import os
+import sys
+import functools
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadtest.fake_services import GOOGLE_HOSTS
+
+FAKE_SERVICES_URL = os.environ['LOADTEST_FAKE_SERVICES_URL']
+
+
+def rewrite_url(url):
+    if not isinstance(url, str):
+        return url
+    parts = urlsplit(url)
+    if parts.hostname not in GOOGLE_HOSTS:
+        return url
+    return f"{FAKE_SERVICES_URL}/{parts.hostname}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+
+def install_redirects():
+    import requests
+    import httplib2
+    import langchain_google_genai
+
+    # requests: gspread, google-auth token refresh, Gemini REST transport
+    original_session_request = requests.Session.request
+    def session_request(self, method, url, *args, **kwargs):
+        return original_session_request(self, method, rewrite_url(url), *args, **kwargs)
+    requests.Session.request = session_request
+
+    # httplib2: googleapiclient (Calendar, Docs, Drive, Sheets v4) and oauth2client
+    original_http_request = httplib2.Http.request
+    def http_request(self, uri, *args, **kwargs):
+        return original_http_request(self, rewrite_url(uri), *args, **kwargs)
+    httplib2.Http.request = http_request
+
+    # Gemini embeddings default to gRPC, which cannot be rewritten; REST goes through requests.
+    langchain_google_genai.GoogleGenerativeAIEmbeddings = functools.partial(langchain_google_genai.GoogleGenerativeAIEmbeddings, transport='rest')
+
+
+install_redirects()
+
+from script import app # noqa: E402  (must follow install_redirects)
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=int(os.environ['PORT']), debug=False, threaded=True)
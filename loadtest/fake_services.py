@@ -0,0 +1,517 @@
+import re
+import ssl
+import json
+import time
+import array
+import base64
+import random
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+
+# --- Service Names ---
+# Latency and error injection are configured per service, e.g. {'openai': 0.8} or {'sheets': 0.05}.
+SERVICE_OPENAI = 'openai'
+SERVICE_WASENDER = 'wasender'
+SERVICE_MEDIA = 'media'
+SERVICE_OAUTH = 'oauth'
+SERVICE_SHEETS = 'sheets'
+SERVICE_DOCS = 'docs'
+SERVICE_DRIVE = 'drive'
+SERVICE_CALENDAR = 'calendar'
+SERVICE_GEMINI = 'gemini'
+SERVICE_SMTP = 'smtp'
+SERVICES = (SERVICE_OPENAI, SERVICE_WASENDER, SERVICE_MEDIA, SERVICE_OAUTH, SERVICE_SHEETS, SERVICE_DOCS,
+            SERVICE_DRIVE, SERVICE_CALENDAR, SERVICE_GEMINI, SERVICE_SMTP)
+
+# Google hosts whose HTTPS traffic app_under_test.py rewrites to http://<fake>/<host>/<path>.
+GOOGLE_HOSTS = {
+    'oauth2.googleapis.com': SERVICE_OAUTH,
+    'accounts.google.com': SERVICE_OAUTH,
+    'sheets.googleapis.com': SERVICE_SHEETS,
+    'docs.googleapis.com': SERVICE_DOCS,
+    'generativelanguage.googleapis.com': SERVICE_GEMINI,
+    'www.googleapis.com': None, # Calendar or Drive, decided by path
+}
+
+OPENAI_EMBEDDING_DIMENSIONS = 1536
+GEMINI_EMBEDDING_DIMENSIONS = 768
+STREAM_TOKEN_DELAY_SECONDS = 0.01
+
+PROPERTY_KEYWORDS = ('bedroom', 'bed ', 'villa', 'apartment', 'flat', 'aed', 'price', 'budget', 'townhouse', 'penthouse', 'studio',
+                     'غرف', 'غرفة', 'شقة', 'فيلا', 'درهم')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Configuration and Stats ---
+class FaultConfig:
+    """
+    Per-service injected latency (seconds, +/- jitter) and error rate (0..1).
+    """
+    def __init__(self, latency: dict = None, error_rate: dict = None, jitter: float = 0.2, seed: int = None):
+        self.latency = dict(latency or {})
+        self.error_rate = dict(error_rate or {})
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, service: str) -> float:
+        base = self.latency.get(service, 0.0)
+        if not base:
+            return 0.0
+        with self._lock:
+            return max(0.0, base * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self, service: str) -> bool:
+        rate = self.error_rate.get(service, 0.0)
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+
+class ServiceStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+
+    def record(self, service: str, failed: bool):
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            if failed:
+                self.errors[service] = self.errors.get(service, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {service: {'calls': count, 'errors': self.errors.get(service, 0)} for service, count in sorted(self.calls.items())}
+
+
+# --- Deterministic Fake Content ---
+def fake_embedding(text: str, dimensions: int) -> list:
+    """
+    A unit vector derived from the text, so equal texts embed identically.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+    rng = random.Random(seed)
+    values = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+def _analysis_reply(prompt: str) -> str:
+    match = re.search(r"Analyze the user's request: '(.*?)'\n", prompt, re.S)
+    request_text = (match.group(1) if match else prompt).lower()
+    if not any(keyword in request_text for keyword in PROPERTY_KEYWORDS):
+        return json.dumps({'intent': 'general_question', 'filters': None})
+    filters = {}
+    bedrooms = re.search(r'(\d+)\s*(?:bed|br|غرف)', request_text)
+    if bedrooms:
+        filters['Bedrooms'] = {'operator': '=', 'value': int(bedrooms.group(1))}
+    price = re.search(r'(\d+(?:\.\d+)?)\s*(million|m\b|k\b)', request_text)
+    if price:
+        multiplier = 1_000_000 if price.group(2).startswith('m') else 1_000
+        filters['Price_AED'] = {'operator': '<', 'value': int(float(price.group(1)) * multiplier)}
+    for city in ('dubai', 'abu dhabi', 'sharjah'):
+        if city in request_text:
+            filters['city'] = {'operator': '=', 'value': city}
+    return "```json\n" + json.dumps({'intent': 'property_search', 'filters': filters or None}) + "\n```"
+
+def chat_reply(messages: list) -> str:
+    """
+    Picks a plausible reply for the prompt shapes script.py sends.
+    """
+    last = messages[-1].get('content', '') if messages else ''
+    if isinstance(last, list): # Multimodal content parts
+        last = " ".join(part.get('text', '') for part in last if isinstance(part, dict))
+    if "Analyze the user's request:" in last:
+        return _analysis_reply(last)
+    if "Extract date and time information" in last:
+        return json.dumps({'has_datetime': True, 'date': time.strftime('%Y-%m-%d', time.localtime(time.time() + 86400)),
+                           'time': '15:00', 'duration_minutes': 60, 'service_type': 'Property Viewing', 'confidence': 0.9})
+    if "sent this photo on WhatsApp" in last:
+        return json.dumps({'description': 'A high-rise residential tower with a pool deck, seen from the street.',
+                           'is_property': True, 'property_type': 'apartment', 'location': 'Dubai Marina',
+                           'building': None, 'visible_text': None})
+    if "Given the following conversation snippet" in last:
+        return json.dumps({'name': 'Load Test', 'preferred_datetime': 'tomorrow at 3pm', 'service_reason': 'Property viewing'})
+    if "Relevant Information Found" in last and "Price:" in last:
+        return "I found a few listings that match. Would you like to arrange a viewing of any of them?"
+    return "Thanks for your message! Let me know your budget and preferred area and I will share some options."
+
+def _usage(prompt_text: str, completion_text: str) -> dict:
+    prompt_tokens = max(1, len(prompt_text) // 4)
+    completion_tokens = max(1, len(completion_text) // 4)
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+def property_rows(count: int, seed: int = 7) -> list:
+    """
+    Synthetic listings with the columns property_handler.EXPECTED_COLUMNS expects (header row first).
+    """
+    rng = random.Random(seed)
+    header = ['PropertyID', 'Title', 'Description', 'Price_AED', 'Bedrooms', 'emirate', 'city', 'area',
+              'video1', 'video2', 'img1', 'img2', 'img3', 'developer', 'building name']
+    areas = [('Dubai', 'Dubai', 'Dubai Marina'), ('Dubai', 'Dubai', 'Downtown'), ('Dubai', 'Dubai', 'JVC'),
+             ('Abu Dhabi', 'Abu Dhabi', 'Al Reem Island'), ('Sharjah', 'Sharjah', 'Al Majaz')]
+    kinds = ['Apartment', 'Villa', 'Townhouse', 'Penthouse', 'Studio']
+    rows = [header]
+    for i in range(count):
+        emirate, city, area = rng.choice(areas)
+        kind = rng.choice(kinds)
+        bedrooms = 0 if kind == 'Studio' else rng.randint(1, 6)
+        rows.append([
+            f"P{i:06d}", f"{bedrooms} Bedroom {kind} in {area}", f"Bright {kind.lower()} close to amenities in {area}.",
+            str(rng.randrange(400_000, 15_000_000, 10_000)), str(bedrooms), emirate, city, area, '', '',
+            f"https://images.example.com/{i}/1.jpg", f"https://images.example.com/{i}/2.jpg" if rng.random() < 0.5 else '', '',
+            rng.choice(['Emaar', 'Damac', 'Nakheel', 'Aldar']), f"Tower {rng.randint(1, 40)}",
+        ])
+    return rows
+
+
+# --- HTTP Fakes ---
+class _FakeHandler(BaseHTTPRequestHandler):
+    server_version = "FakeServices/1.0"
+
+    def log_message(self, format, *args):
+        pass # Per-request logging would dominate a load test
+
+    # --- plumbing ---
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _json_body(self, raw: bytes) -> dict:
+        try:
+            return json.loads(raw or b'{}')
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, payload, status: int = 200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, body: bytes, content_type: str = 'application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _service_for(self, path: str) -> str:
+        first, _, rest = path.lstrip('/').partition('/')
+        if first in (SERVICE_OPENAI, SERVICE_WASENDER, SERVICE_MEDIA):
+            return first
+        if first == 'www.googleapis.com':
+            return SERVICE_DRIVE if rest.startswith('drive/') else SERVICE_CALENDAR
+        return GOOGLE_HOSTS.get(first)
+
+    def _handle(self, method: str):
+        raw = self._read_body() if method in ('POST', 'PUT', 'PATCH') else b''
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        service = self._service_for(path)
+        if service is None:
+            self._send_json({'error': f"No fake for {path}"}, 404)
+            return
+        time.sleep(self.server.faults.delay(service))
+        if self.server.faults.should_fail(service):
+            self.server.stats.record(service, True)
+            self._send_json({'error': {'message': f"Injected {service} failure", 'code': 503}}, 503)
+            return
+        self.server.stats.record(service, False)
+        handler = getattr(self, f"_{service}")
+        handler(method, path.lstrip('/').partition('/')[2], parse_qs(parts.query), raw)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    # --- OpenAI ---
+    def _openai(self, method, path, query, raw):
+        if path.endswith('chat/completions'):
+            self._chat_completions(self._json_body(raw))
+        elif path.endswith('embeddings'):
+            self._openai_embeddings(self._json_body(raw))
+        elif path.endswith('audio/transcriptions'):
+            self._send_json({'text': self.server.transcript})
+        else:
+            self._send_json({'error': {'message': f"Unknown OpenAI path {path}"}}, 404)
+
+    def _chat_completions(self, request_body: dict):
+        messages = request_body.get('messages', [])
+        reply = chat_reply(messages)
+        prompt_text = "".join(str(message.get('content', '')) for message in messages)
+        usage = _usage(prompt_text, reply)
+        model = request_body.get('model', 'gpt-4o')
+        created = int(time.time())
+        if not request_body.get('stream'):
+            self._send_json({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+        # Server-sent events, closed by the connection ending (HTTP/1.0).
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        def event(payload):
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        base = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+        event(dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]))
+        for piece in re.findall(r'\S+\s*', reply):
+            time.sleep(STREAM_TOKEN_DELAY_SECONDS)
+            event(dict(base, choices=[{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]))
+        event(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if (request_body.get('stream_options') or {}).get('include_usage'):
+            event(dict(base, choices=[], usage=usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _openai_embeddings(self, request_body: dict):
+        inputs = request_body.get('input', [])
+        if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, item in enumerate(inputs):
+            vector = fake_embedding(item if isinstance(item, str) else json.dumps(item), OPENAI_EMBEDDING_DIMENSIONS)
+            if request_body.get('encoding_format') == 'base64':
+                vector = base64.b64encode(array.array('f', vector).tobytes()).decode('ascii')
+            data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+        self._send_json({'object': 'list', 'data': data, 'model': request_body.get('model'), 'usage': {'prompt_tokens': 8 * len(inputs), 'total_tokens': 8 * len(inputs)}})
+
+    # --- WaSender ---
+    def _wasender(self, method, path, query, raw):
+        request_body = self._json_body(raw)
+        self._send_json({'success': True, 'message': 'Message sent successfully', 'data': {'to': request_body.get('to'), 'msgId': random.getrandbits(32)}})
+
+    # --- WhatsApp media CDN ---
+    def _media(self, method, path, query, raw):
+        content = self.server.media.get(path)
+        if content is None:
+            self._send_json({'error': 'not found'}, 404)
+            return
+        self._send_bytes(content)
+
+    # --- Google ---
+    def _oauth(self, method, path, query, raw):
+        self._send_json({'access_token': 'fake-access-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    def _sheets(self, method, path, query, raw):
+        # v4/spreadsheets/{id}[/values/{range}]
+        segments = path.split('/')
+        spreadsheet_id = segments[2] if len(segments) > 2 else ''
+        rows = self.server.sheet_rows
+        if '/values' in path:
+            value_range = unquote(segments[4]) if len(segments) > 4 else 'Properties'
+            self._send_json({'range': value_range, 'majorDimension': 'ROWS', 'values': rows})
+            return
+        self._send_json({
+            'spreadsheetId': spreadsheet_id,
+            'properties': {'title': 'Load Test Listings', 'locale': 'en_US', 'timeZone': 'Asia/Dubai'},
+            'sheets': [{'properties': {'sheetId': 0, 'title': 'Properties', 'index': 0, 'sheetType': 'GRID',
+                                       'gridProperties': {'rowCount': len(rows), 'columnCount': len(rows[0]) if rows else 0}}}],
+        })
+
+    def _docs(self, method, path, query, raw):
+        text = "Load test document.\nViewings are available daily from 9am to 9pm Dubai time.\n"
+        self._send_json({'documentId': path.rsplit('/', 1)[-1], 'title': 'Load Test Doc',
+                         'body': {'content': [{'paragraph': {'elements': [{'textRun': {'content': text}}]}}]}})
+
+    def _drive(self, method, path, query, raw):
+        self._send_json({'mimeType': 'application/vnd.google-apps.document'})
+
+    def _calendar(self, method, path, query, raw):
+        events = self.server.calendar_events
+        if method == 'POST':
+            event = self._json_body(raw)
+            event_id = f"fake{random.getrandbits(48):012x}"
+            event.update(id=event_id, status='confirmed', htmlLink=f"https://calendar.example.com/event?eid={event_id}")
+            events[event_id] = event
+            self._send_json(event)
+            return
+        tail = path.rstrip('/').rsplit('/', 1)[-1]
+        if tail != 'events' and tail in events:
+            self._send_json(events[tail])
+        elif tail != 'events':
+            self._send_json({'error': {'code': 404, 'message': 'Not Found'}}, 404)
+        else:
+            # Sync tokens are the number of events already seen, so an incremental sync returns only newer ones.
+            seen = int(query.get('syncToken', ['0'])[0])
+            self._send_json({'kind': 'calendar#events', 'timeZone': 'America/New_York',
+                             'items': list(events.values())[seen:], 'nextSyncToken': str(len(events))})
+
+    def _gemini(self, method, path, query, raw):
+        request_body = self._json_body(raw)
+        def text_of(content):
+            return " ".join(part.get('text', '') for part in (content or {}).get('parts', []))
+        if path.endswith(':batchEmbedContents'):
+            self._send_json({'embeddings': [{'values': fake_embedding(text_of(r.get('content')), GEMINI_EMBEDDING_DIMENSIONS)} for r in request_body.get('requests', [])]})
+        else:
+            self._send_json({'embedding': {'values': fake_embedding(text_of(request_body.get('content')), GEMINI_EMBEDDING_DIMENSIONS)}})
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, faults: FaultConfig, stats: ServiceStats, sheet_rows: list, transcript: str):
+        super().__init__(address, _FakeHandler)
+        self.faults = faults
+        self.stats = stats
+        self.sheet_rows = sheet_rows
+        self.transcript = transcript
+        self.media = {}
+        self.calendar_events = {}
+
+
+# --- SMTP Fake ---
+def _self_signed_certificate(directory: str):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import datetime
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+                   .sign(key, hashes.SHA256()))
+    cert_path, key_path = f"{directory}/smtp-cert.pem", f"{directory}/smtp-key.pem"
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib: EHLO, STARTTLS, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, QUIT.
+    """
+    def _reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self._reply("220 fake-smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                extensions = ["250-fake-smtp", "250-AUTH PLAIN LOGIN"]
+                if not isinstance(self.connection, ssl.SSLSocket):
+                    extensions.append("250-STARTTLS")
+                for extension in extensions:
+                    self.wfile.write((extension + "\r\n").encode('ascii'))
+                self._reply("250 8BITMIME")
+            elif verb == 'STARTTLS':
+                self._reply("220 ready to start TLS")
+                self.connection = server.tls_context.wrap_socket(self.connection, server_side=True)
+                self.rfile = self.connection.makefile('rb')
+                self.wfile = self.connection.makefile('wb')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    self._reply("334 VXNlcm5hbWU6")
+                    self.rfile.readline()
+                    self._reply("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                self._reply("235 authentication succeeded")
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._reply("250 OK")
+            elif verb == 'DATA':
+                time.sleep(server.faults.delay(SERVICE_SMTP))
+                self._reply("354 end data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                failed = server.faults.should_fail(SERVICE_SMTP)
+                server.stats.record(SERVICE_SMTP, failed)
+                self._reply("451 injected failure" if failed else "250 queued")
+            elif verb == 'QUIT':
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("502 command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, faults: FaultConfig, stats: ServiceStats, certificate_dir: str):
+        super().__init__(address, _SMTPHandler)
+        self.faults = faults
+        self.stats = stats
+        self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.tls_context.load_cert_chain(*_self_signed_certificate(certificate_dir))
+
+
+# --- Lifecycle ---
+class FakeServices:
+    """
+    Starts the HTTP fakes (OpenAI, WaSender, media CDN, Google APIs) and the SMTP fake on free local ports.
+    """
+    def __init__(self, faults: FaultConfig = None, property_count: int = 1000, transcript: str = None):
+        self.faults = faults or FaultConfig()
+        self.stats = ServiceStats()
+        self._certificate_dir = tempfile.mkdtemp(prefix="fake-smtp-")
+        self.http = FakeHTTPServer(('127.0.0.1', 0), self.faults, self.stats, property_rows(property_count),
+                                   transcript or "I am looking for a two bedroom apartment in Dubai Marina under 2 million")
+        self.smtp = FakeSMTPServer(('127.0.0.1', 0), self.faults, self.stats, self._certificate_dir)
+        self._threads = []
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.http.server_address[1]}"
+
+    @property
+    def smtp_port(self) -> int:
+        return self.smtp.server_address[1]
+
+    def add_media(self, name: str, encrypted: bytes) -> str:
+        """
+        Serves encrypted media bytes and returns their download URL.
+        """
+        self.http.media[name] = encrypted
+        return f"{self.base_url}/{SERVICE_MEDIA}/{name}"
+
+    def start(self):
+        for server in (self.http, self.smtp):
+            thread = threading.Thread(target=server.serve_forever, name=f"fake-{type(server).__name__}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Fake services listening on {self.base_url} (SMTP on port {self.smtp_port}).")
+        return self
+
+    def stop(self):
+        for server in (self.http, self.smtp):
+            server.shutdown()
+            server.server_close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,123 @@
+import os
+import hmac
+import uuid
+import base64
+import random
+import hashlib
+import time
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Mirrors media_handler.get_decryption_keys.
+MEDIA_KEY_INFO = {
+    'image': b'WhatsApp Image Keys',
+    'video': b'WhatsApp Video Keys',
+    'audio': b'WhatsApp Audio Keys',
+    'document': b'WhatsApp Document Keys',
+}
+
+TEXT_MESSAGES = [
+    "Hi, do you have 2 bedroom apartments in Dubai Marina?",
+    "show me villas below 5 million aed in dubai",
+    "I'm looking for a 3 bed townhouse in JVC, budget 2.5m",
+    "What is your commission?",
+    "Can I book a viewing tomorrow at 3pm?",
+    "Do you handle off-plan properties from Emaar?",
+    "what documents do I need to buy as a foreigner?",
+    "studio for rent near the metro please",
+    "أبحث عن شقة بغرفتين في دبي",
+    "هل لديكم فلل في أبوظبي بسعر أقل من 3 مليون درهم؟",
+    "ما هي رسوم التسجيل؟",
+    "Thanks!",
+]
+IMAGE_CAPTIONS = ["Is this one available?", "Something like this", ""]
+MESSAGE_KINDS = ('text', 'audio', 'image')
+
+
+# --- WhatsApp Media Encryption ---
+def encrypt_media(plaintext: bytes, media_type: str):
+    """
+    Encrypts media the way WhatsApp does (HKDF-SHA256 keys, AES-256-CBC, 10-byte HMAC tail), so
+    media_handler.decrypt_media runs its real code path. Returns (encrypted, media_key_b64).
+    """
+    media_key = os.urandom(32)
+    keys = HKDF(algorithm=hashes.SHA256(), length=112, salt=None, info=MEDIA_KEY_INFO[media_type]).derive(media_key)
+    iv, cipher_key, mac_key = keys[:16], keys[16:48], keys[48:80]
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(plaintext) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv)).encryptor()
+    ciphertext = encryptor.update(padded) + encryptor.finalize()
+    mac = hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()[:10]
+    return ciphertext + mac, base64.b64encode(media_key).decode('ascii')
+
+
+class MediaLibrary:
+    """
+    A few encrypted audio and image files registered with the fake media CDN, reused across messages.
+    """
+    def __init__(self, services, audio_bytes: int = 48 * 1024, image_bytes: int = 160 * 1024, variants: int = 4):
+        self.items = {'audio': [], 'image': []}
+        for media_type, size in (('audio', audio_bytes), ('image', image_bytes)):
+            for i in range(variants):
+                plaintext = os.urandom(size)
+                encrypted, media_key_b64 = encrypt_media(plaintext, media_type)
+                url = services.add_media(f"{media_type}-{i}.enc", encrypted)
+                self.items[media_type].append({
+                    'url': url,
+                    'mediaKey': media_key_b64,
+                    'fileLength': str(len(plaintext)),
+                    'fileSha256': base64.b64encode(hashlib.sha256(plaintext).digest()).decode('ascii'),
+                    'fileEncSha256': base64.b64encode(hashlib.sha256(encrypted).digest()).decode('ascii'),
+                })
+
+    def pick(self, media_type: str, rng: random.Random) -> dict:
+        return dict(rng.choice(self.items[media_type]))
+
+
+# --- messages.upsert Payloads ---
+def _envelope(sender: str, message: dict) -> dict:
+    return {
+        'event': 'messages.upsert',
+        'data': {'messages': {
+            'key': {'id': f"LT{uuid.uuid4().hex[:18].upper()}", 'fromMe': False, 'remoteJid': sender},
+            'messageTimestamp': int(time.time()),
+            'pushName': 'Load Test',
+            'message': message,
+        }},
+    }
+
+def text_payload(sender: str, rng: random.Random) -> dict:
+    return _envelope(sender, {'conversation': rng.choice(TEXT_MESSAGES)})
+
+def audio_payload(sender: str, rng: random.Random, media: MediaLibrary) -> dict:
+    audio = media.pick('audio', rng)
+    audio.update(mimetype='audio/ogg; codecs=opus', seconds=rng.randint(3, 20), ptt=True)
+    return _envelope(sender, {'audioMessage': audio})
+
+def image_payload(sender: str, rng: random.Random, media: MediaLibrary) -> dict:
+    image = media.pick('image', rng)
+    image.update(mimetype='image/jpeg', height=1280, width=960, caption=rng.choice(IMAGE_CAPTIONS))
+    return _envelope(sender, {'imageMessage': image})
+
+
+class PayloadGenerator:
+    """
+    Produces a reproducible stream of (kind, payload) with the requested text/audio/image mix,
+    spread over a pool of simulated senders so histories grow realistically.
+    """
+    def __init__(self, media: MediaLibrary, mix: dict, users: int = 50, seed: int = 1):
+        self.media = media
+        self.rng = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.senders = [f"97150{i:07d}@s.whatsapp.net" for i in range(users)]
+
+    def next(self):
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        sender = self.rng.choice(self.senders)
+        if kind == 'audio':
+            return kind, audio_payload(sender, self.rng, self.media)
+        if kind == 'image':
+            return kind, image_payload(sender, self.rng, self.media)
+        return kind, text_payload(sender, self.rng)
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from loadtest.fake_services import FakeServices, FaultConfig, SERVICES, free_port
+from loadtest.payloads import MESSAGE_KINDS, MediaLibrary, PayloadGenerator
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stages with fewer samples than this are not compared against the baseline (too noisy).
+MIN_SAMPLES_FOR_COMPARISON = 20
+
+COMPANY_DATA_DOCUMENTS = {
+    'faq.txt': "Our agency charges a 2% commission on sales. Viewings can be booked seven days a week.\n"
+               "Foreign buyers need a passport copy and proof of funds. Registration fees are 4% of the price.",
+    'areas.txt': "Dubai Marina offers waterfront apartments. JVC is popular with families for townhouses.\n"
+                 "Downtown Dubai is close to the Burj Khalifa and Dubai Mall.",
+}
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Helpers ---
+def _parse_map(spec: str, allowed) -> dict:
+    result = {}
+    for item in filter(None, (spec or "").split(',')):
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name not in allowed:
+            raise argparse.ArgumentTypeError(f"Unknown name '{name}'. Expected one of: {', '.join(allowed)}")
+        result[name] = float(value)
+    return result
+
+def parse_service_map(spec: str) -> dict:
+    """
+    'openai=0.8,wasender=0.1' -> {'openai': 0.8, 'wasender': 0.1}
+    """
+    return _parse_map(spec, SERVICES)
+
+def parse_mix(spec: str) -> dict:
+    return _parse_map(spec, MESSAGE_KINDS)
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(values_ms: list) -> dict:
+    values = sorted(values_ms)
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.50), 1),
+        'p95': round(percentile(values, 0.95), 1),
+        'p99': round(percentile(values, 0.99), 1),
+        'max': round(values[-1], 1) if values else 0.0,
+    }
+
+def fake_service_account() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode('ascii')
+    return json.dumps({
+        'type': 'service_account', 'project_id': 'load-test', 'private_key_id': 'load-test', 'private_key': pem,
+        'client_email': 'load-test@load-test.iam.gserviceaccount.com', 'client_id': '1',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    })
+
+
+# --- Memory Sampling ---
+def _process_tree(pid: int) -> list:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids.extend(_process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+def rss_mb(pid: int) -> float:
+    """
+    Resident memory of a process and its children (gunicorn workers), in MB. Linux only.
+    """
+    total_kb = 0
+    for process_id in _process_tree(pid):
+        try:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.samples.append(rss_mb(self.pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> dict:
+        self._stop_event.set()
+        self.join()
+        if not self.samples:
+            return {}
+        return {'start_mb': round(self.samples[0], 1), 'peak_mb': round(max(self.samples), 1), 'end_mb': round(self.samples[-1], 1)}
+
+
+# --- App Under Test ---
+def prepare_workdir(workdir: str):
+    shutil.copy(os.path.join(REPO_ROOT, 'persona.json'), workdir)
+    company_data = os.path.join(workdir, 'company_data')
+    os.makedirs(company_data, exist_ok=True)
+    for name, text in COMPANY_DATA_DOCUMENTS.items():
+        with open(os.path.join(company_data, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+def app_environment(services: FakeServices, workdir: str, port: int, workers: int) -> dict:
+    service_account = fake_service_account()
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': REPO_ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+        'PORT': str(port),
+        'LOADTEST_FAKE_SERVICES_URL': services.base_url,
+        'OPENAI_API_KEY': 'sk-load-test',
+        'OPENAI_BASE_URL': f"{services.base_url}/openai/v1",
+        'OPENAI_API_BASE': f"{services.base_url}/openai/v1",
+        'WASENDER_API_URL': f"{services.base_url}/wasender/api/send-message",
+        'WASENDER_API_TOKEN': 'load-test',
+        'GEMINI_API_KEY': 'load-test',
+        'PROPERTY_SHEET_ID': 'load-test-sheet',
+        'GOOGLE_SHEETS_CREDENTIALS': service_account,
+        'GOOGLE_CALENDAR_CREDENTIALS': service_account,
+        'GOOGLE_APPLICATION_CREDENTIALS_JSON': service_account,
+        'APPOINTMENT_EMAIL_SENDER': 'bot@example.com',
+        'APPOINTMENT_EMAIL_PASSWORD': 'load-test',
+        'APPOINTMENT_EMAIL_RECEIVER': 'agent@example.com',
+        'APPOINTMENT_SMTP_SERVER': '127.0.0.1',
+        'APPOINTMENT_SMTP_PORT': str(services.smtp_port),
+        'FLASK_SECRET_TOKEN': 'load-test',
+        'TRACE_EXPORT': 'jsonl',
+        'TRACE_FILE_PATH': os.path.join(workdir, 'traces.jsonl'),
+    })
+    if workers > 1:
+        env['METRICS_MULTIPROC_DIR'] = os.path.join(workdir, 'metrics')
+    return env
+
+def start_app(workdir: str, env: dict, port: int, workers: int, threads: int, log_file):
+    if workers:
+        command = [sys.executable, '-m', 'gunicorn', 'loadtest.app_under_test:app', '--bind', f"127.0.0.1:{port}",
+                   '--workers', str(workers), '--threads', str(threads), '--timeout', '120']
+    else:
+        command = [sys.executable, '-m', 'loadtest.app_under_test']
+    logging.info(f"Starting app under test: {' '.join(command)} (cwd {workdir})")
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+def wait_until_ready(base_url: str, process, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup with code {process.returncode}; see app.log in the work directory.")
+        try:
+            if requests.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"App was not ready after {timeout:.0f}s; see app.log in the work directory.")
+
+def stop_app(process):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+# --- Load Generation ---
+def replay(base_url: str, generator: PayloadGenerator, rate: float, duration: float, concurrency: int) -> list:
+    """
+    Open-loop replay: message i is due at start + i/rate whether or not earlier ones have finished.
+    Latency is measured from the due time, so queueing inside the harness counts against the app.
+    """
+    results = []
+    results_lock = threading.Lock()
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+
+    def send(kind, payload, due):
+        try:
+            resp = session.post(f"{base_url}/webhook", json=payload, timeout=300)
+            status = resp.status_code
+        except requests.exceptions.RequestException as e:
+            status = f"error: {type(e).__name__}"
+        finished = time.perf_counter()
+        with results_lock:
+            results.append({'kind': kind, 'status': status, 'latency_ms': (finished - due) * 1000, 'finished': finished})
+
+    total = int(rate * duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            due = start + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind, payload = generator.next()
+            pool.submit(send, kind, payload, due)
+    return results
+
+def stage_latencies(trace_path: str) -> dict:
+    durations = {}
+    if not os.path.exists(trace_path):
+        return {}
+    with open(trace_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            durations.setdefault(record['name'], []).append((record['end_ns'] - record['start_ns']) / 1e6)
+    return {name: summarize(values) for name, values in sorted(durations.items())}
+
+
+# --- Reporting ---
+def build_report(args, results: list, elapsed: float, stages: dict, memory: dict, service_calls: dict) -> dict:
+    ok = [r for r in results if r['status'] == 200]
+    by_kind = {}
+    for result in results:
+        by_kind.setdefault(result['kind'], []).append(result['latency_ms'])
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+    return {
+        'config': {'rate': args.rate, 'duration': args.duration, 'mix': args.mix, 'users': args.users, 'workers': args.workers,
+                   'threads': args.threads, 'properties': args.properties, 'latency': args.latency, 'errors': args.errors},
+        'messages': len(results),
+        'statuses': statuses,
+        'throughput_per_second': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': summarize([r['latency_ms'] for r in results]),
+        'latency_by_kind_ms': {kind: summarize(values) for kind, values in sorted(by_kind.items())},
+        'stages_ms': stages,
+        'memory': memory,
+        'service_calls': service_calls,
+    }
+
+def format_report(report: dict) -> str:
+    config = report['config']
+    latency = report['latency_ms']
+    lines = [
+        f"Replayed {report['messages']} messages at {config['rate']}/s for {config['duration']}s "
+        f"(mix {config['mix']}, {config['users']} users, {config['workers'] or 'flask'} worker(s)).",
+        f"Throughput: {report['throughput_per_second']} msg/s; statuses: {report['statuses']}",
+        f"End-to-end latency (ms): p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}",
+    ]
+    for kind, summary in report['latency_by_kind_ms'].items():
+        lines.append(f"  {kind:<6} n={summary['count']:<5} p50 {summary['p50']}  p95 {summary['p95']}  p99 {summary['p99']}")
+    lines.append(f"{'Stage':<26}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, summary in report['stages_ms'].items():
+        lines.append(f"{name:<26}{summary['count']:>7}{summary['p50']:>10}{summary['p95']:>10}{summary['p99']:>10}")
+    if report['memory']:
+        memory = report['memory']
+        lines.append(f"Memory (RSS MB): start {memory['start_mb']}, peak {memory['peak_mb']}, end {memory['end_mb']}")
+    lines.append("Fake service calls: " + ", ".join(f"{name} {calls['calls']} ({calls['errors']} errors)" for name, calls in report['service_calls'].items()))
+    return "\n".join(lines)
+
+def compare_to_baseline(report: dict, baseline: dict, max_regression: float) -> list:
+    """
+    Returns descriptions of p95 latencies, throughput or peak memory that got worse than the baseline
+    by more than max_regression (a fraction).
+    """
+    regressions = []
+    def check(label, current, previous, higher_is_worse=True):
+        if not previous:
+            return
+        change = (current - previous) / previous if higher_is_worse else (previous - current) / previous
+        if change > max_regression:
+            regressions.append(f"{label}: {previous} -> {current} ({change:+.0%})")
+
+    check('end-to-end p95 ms', report['latency_ms']['p95'], baseline.get('latency_ms', {}).get('p95'))
+    check('throughput msg/s', report['throughput_per_second'], baseline.get('throughput_per_second'), higher_is_worse=False)
+    for name, summary in report['stages_ms'].items():
+        previous = baseline.get('stages_ms', {}).get(name)
+        if previous and min(summary['count'], previous['count']) >= MIN_SAMPLES_FOR_COMPARISON:
+            check(f"stage {name} p95 ms", summary['p95'], previous['p95'])
+    if report['memory'] and baseline.get('memory'):
+        check('peak RSS MB', report['memory']['peak_mb'], baseline['memory'].get('peak_mb'))
+    return regressions
+
+
+# --- CLI ---
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay WhatsApp webhook traffic against the app with every external service faked locally.")
+    parser.add_argument('--rate', type=float, default=2.0, help="Messages per second.")
+    parser.add_argument('--duration', type=float, default=60.0, help="Seconds of traffic to replay.")
+    parser.add_argument('--mix', type=parse_mix, default={'text': 0.8, 'audio': 0.1, 'image': 0.1}, help="Message mix, e.g. text=0.8,audio=0.1,image=0.1")
+    parser.add_argument('--users', type=int, default=50, help="Number of simulated senders.")
+    parser.add_argument('--concurrency', type=int, default=64, help="Maximum in-flight webhook requests.")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers (0 runs the Flask server in one process).")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per worker.")
+    parser.add_argument('--properties', type=int, default=1000, help="Rows in the fake property sheet.")
+    parser.add_argument('--latency', type=parse_service_map, default={'openai': 0.6, 'wasender': 0.15, 'sheets': 0.3, 'media': 0.1, 'gemini': 0.1},
+                        help="Injected latency in seconds per service, e.g. openai=0.8,wasender=0.1")
+    parser.add_argument('--errors', type=parse_service_map, default={}, help="Injected error rate per service, e.g. wasender=0.05")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-timeout', type=float, default=180.0)
+    parser.add_argument('--json', dest='json_path', help="Write the report as JSON to this file (usable as a baseline).")
+    parser.add_argument('--baseline', help="JSON report from an earlier run to compare against.")
+    parser.add_argument('--max-regression', type=float, default=0.2, help="Allowed worsening versus the baseline (fraction).")
+    parser.add_argument('--keep-workdir', action='store_true', help="Keep the app's working directory (logs, traces, index).")
+    args = parser.parse_args(argv)
+
+    services = FakeServices(FaultConfig(args.latency, args.errors, seed=args.seed), property_count=args.properties).start()
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    prepare_workdir(workdir)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    log_file = open(os.path.join(workdir, 'app.log'), 'w')
+    process = start_app(workdir, app_environment(services, workdir, port, args.workers), port, args.workers, args.threads, log_file)
+    try:
+        wait_until_ready(base_url, process, args.startup_timeout)
+        generator = PayloadGenerator(MediaLibrary(services), args.mix, users=args.users, seed=args.seed)
+        sampler = MemorySampler(process.pid)
+        sampler.start()
+        start = time.perf_counter()
+        results = replay(base_url, generator, args.rate, args.duration, args.concurrency)
+        elapsed = time.perf_counter() - start
+        memory = sampler.stop()
+        time.sleep(1.0) # Let the trace exporters flush
+        report = build_report(args, results, elapsed, stage_latencies(os.path.join(workdir, 'traces.jsonl')), memory, services.stats.snapshot())
+    finally:
+        stop_app(process)
+        log_file.close()
+        services.stop()
+        if args.keep_workdir:
+            logging.info(f"Work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.max_regression)
+        if regressions:
+            print(f"Regressions beyond {args.max_regression:.0%} of baseline:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"No regressions beyond {args.max_regression:.0%} of baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
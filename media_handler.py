@@ -70,11 +70,26 @@ def decrypt_media(encrypted_data, media_key_b64, media_type):
     decrypted_data = decryptor.update(ciphertext) + decryptor.finalize()
     return decrypted_data
 
-def download_and_decrypt_media(media_url, media_key_b64, media_type):
+def download_and_decrypt_media(media_url, media_key_b64, media_type, max_bytes=None):
+    """
+    Downloads and decrypts a WhatsApp media file. With max_bytes, the download is streamed and
+    abandoned once the encrypted file exceeds it, whatever the payload claimed its size was.
+    Returns None on failure.
+    """
     try:
-        response = requests.get(media_url, timeout=20)
-        response.raise_for_status()
-        encrypted_data = response.content
+        with requests.get(media_url, timeout=20, stream=max_bytes is not None) as response:
+            response.raise_for_status()
+            if max_bytes is None:
+                encrypted_data = response.content
+            else:
+                chunks, received = [], 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        logging.error(f"Media download exceeded {max_bytes} bytes; abandoning it.")
+                        return None
+                    chunks.append(chunk)
+                encrypted_data = b"".join(chunks)
         logging.info(f"Successfully downloaded {len(encrypted_data)} bytes of encrypted media.")
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to download media file: {e}")
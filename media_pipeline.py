@@ -0,0 +1,144 @@
+import os
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from media_handler import download_and_decrypt_media
+from metrics import timed, count_event, register_queue_depth
+
+# --- Configuration ---
+# Media types whose content the bot uses, and which are therefore downloaded: audio is transcribed
+# and photos are described (image_analysis.py). Videos only get a placeholder, so they are not fetched.
+MEDIA_FETCH_TYPES = {t.strip() for t in os.getenv('MEDIA_FETCH_TYPES', 'audio,image').lower().split(',') if t.strip()}
+# Largest file accepted per type, in bytes, judged by the payload's fileLength before anything is
+# fetched. Whisper takes at most 25 MB.
+MEDIA_MAX_BYTES = {
+    'audio': int(os.getenv('MEDIA_MAX_AUDIO_BYTES', 16 * 1024 * 1024)),
+    'image': int(os.getenv('MEDIA_MAX_IMAGE_BYTES', 8 * 1024 * 1024)),
+    'video': int(os.getenv('MEDIA_MAX_VIDEO_BYTES', 16 * 1024 * 1024)),
+}
+# Concurrent downloads, and downloads allowed to wait for a worker. Beyond both, new media is refused,
+# so a burst of large files cannot hold more than (workers + queue) files in memory.
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 2))
+MEDIA_QUEUE_MAX_SIZE = int(os.getenv('MEDIA_QUEUE_MAX_SIZE', 8))
+# How long a webhook waits for its download before replying without the media.
+MEDIA_WAIT_SECONDS = float(os.getenv('MEDIA_WAIT_SECONDS', 60))
+# The encrypted file is the plaintext padded to the AES block plus a 10-byte MAC.
+ENCRYPTION_OVERHEAD_BYTES = 16 + 10
+
+# Outcomes of fetch_media
+MEDIA_OK = 'ok'
+MEDIA_SKIPPED = 'skipped' # Not a type whose content is used
+MEDIA_INVALID = 'invalid' # No URL or media key
+MEDIA_TOO_LARGE = 'too_large'
+MEDIA_BUSY = 'busy' # Every worker and queue slot is taken
+MEDIA_FAILED = 'failed'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def file_length(media_info: dict):
+    """
+    The plaintext size from a media message's fileLength, or None if absent. WaSender sends it as a
+    number or string; protobuf clients may send a Long as {'low', 'high'}.
+    """
+    value = media_info.get('fileLength')
+    if isinstance(value, dict):
+        return (int(value.get('high', 0)) << 32) + (int(value.get('low', 0)) & 0xFFFFFFFF)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def plan_media(media_type: str, media_info: dict) -> str:
+    """
+    Decides from the payload alone whether a media message is downloaded: MEDIA_OK to fetch it, or
+    why not (MEDIA_SKIPPED, MEDIA_INVALID, MEDIA_TOO_LARGE).
+    """
+    if media_type not in MEDIA_FETCH_TYPES:
+        return MEDIA_SKIPPED
+    if not media_info.get('url') or not media_info.get('mediaKey'):
+        return MEDIA_INVALID
+    size = file_length(media_info)
+    limit = MEDIA_MAX_BYTES.get(media_type)
+    if size is not None and limit is not None and size > limit:
+        return MEDIA_TOO_LARGE
+    return MEDIA_OK
+
+
+# --- Worker Pool ---
+class MediaPool:
+    """
+    A fixed number of download threads behind a bounded queue. submit() returns None instead of
+    queueing once workers + queue_size downloads are in flight.
+    """
+    def __init__(self, workers: int = MEDIA_WORKERS, queue_size: int = MEDIA_QUEUE_MAX_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            return None
+        with self._lock:
+            self._in_flight += 1
+        # Run in the caller's context, so the download is traced as part of its message.
+        future = self._executor.submit(contextvars.copy_context().run, function, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def depth(self) -> int:
+        return self._in_flight
+
+
+def get_media_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = MediaPool()
+            register_queue_depth('media_downloads', _pool.depth)
+        return _pool
+
+
+def _download(media_type: str, media_info: dict):
+    limit = MEDIA_MAX_BYTES.get(media_type)
+    with timed('media_download'):
+        return download_and_decrypt_media(media_info['url'], media_info['mediaKey'], media_type,
+                                          max_bytes=limit + ENCRYPTION_OVERHEAD_BYTES if limit else None)
+
+
+def fetch_media(media_type: str, media_info: dict):
+    """
+    Returns (outcome, decrypted bytes or None). Only MEDIA_OK comes with content; the download runs
+    on the shared pool and the caller waits for it up to MEDIA_WAIT_SECONDS.
+    """
+    outcome = plan_media(media_type, media_info)
+    if outcome != MEDIA_OK:
+        if outcome in (MEDIA_TOO_LARGE, MEDIA_INVALID):
+            logging.warning(f"Not downloading {media_type}: {outcome} (fileLength {media_info.get('fileLength')}).")
+            count_event(f"media_{outcome}")
+        return outcome, None
+    future = get_media_pool().submit(_download, media_type, media_info)
+    if future is None:
+        logging.warning(f"Media pool is full; refusing {media_type} download.")
+        count_event('media_busy')
+        return MEDIA_BUSY, None
+    try:
+        content = future.result(timeout=MEDIA_WAIT_SECONDS)
+    except FutureTimeoutError:
+        logging.error(f"{media_type.capitalize()} download did not finish within {MEDIA_WAIT_SECONDS}s.")
+        return MEDIA_FAILED, None
+    except Exception as e: # Unsupported media type for decryption and the like
+        logging.error(f"{media_type.capitalize()} download failed: {e}", exc_info=True)
+        return MEDIA_FAILED, None
+    return (MEDIA_OK, content) if content else (MEDIA_FAILED, None)
@@ -0,0 +1,302 @@
+import os
+import glob
+import json
+import time
+import bisect
+import logging
+import threading
+import functools
+from tracing import span, annotate
+
+# --- Configuration ---
+# With several gunicorn workers, set this to a shared directory: every worker periodically writes
+# its samples there and /metrics merges them, so a scrape sees the whole service, not one worker.
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+METRICS_PREFIX = "whatsapp_bot_"
+
+# Seconds; spans fast local work (FAISS, filters) up to slow LLM calls and retried sends.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Metric Types ---
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(labels), value if not isinstance(value, list) else list(value)] for labels, value in self._values.items()]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value sampled at scrape time from a callback (e.g. a queue size), per label set.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._callbacks = {}
+
+    def set_function(self, function, *labelvalues):
+        with self._lock:
+            self._callbacks[labelvalues] = function
+
+    def snapshot(self) -> list:
+        with self._lock:
+            callbacks = list(self._callbacks.items())
+        samples = []
+        for labels, function in callbacks:
+            try:
+                samples.append([list(labels), float(function())])
+            except Exception as e:
+                logging.debug(f"Gauge {self.name}{labels} callback failed: {e}")
+        return samples
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labelvalues):
+        # Stored as per-bucket (non-cumulative) counts followed by [sum, count]; cumulated when rendered.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = [0] * (len(self.buckets) + 1) + [0.0, 0]
+                self._values[labelvalues] = state
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def snapshot(self) -> dict:
+        return {
+            metric.name: {
+                'type': metric.metric_type,
+                'help': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.snapshot(),
+            }
+            for metric in self._metrics
+        }
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = Histogram('stage_duration_seconds', "Latency of each pipeline stage.", ['stage'])
+STAGE_ERRORS = Counter('stage_errors_total', "Stage executions that raised or reported failure.", ['stage'])
+EVENTS = Counter('events_total', "Notable webhook outcomes (ignored, duplicate, paused, ...).", ['event'])
+CACHE_LOOKUPS = Counter('cache_lookups_total', "Cache lookups by cache and result (hit/miss).", ['cache', 'result'])
+LLM_TOKENS = Counter('llm_tokens_total', "LLM tokens used, by call purpose and kind (prompt/completion).", ['purpose', 'kind'])
+QUEUE_DEPTH = Gauge('queue_depth', "Items waiting in background queues.", ['queue'])
+DATETIME_EXTRACTIONS = Counter('datetime_extractions_total', "Scheduling date/time extractions by the tier that resolved them (rules/dateparser/llm/unresolved).", ['tier'])
+DATETIME_SECONDS_SAVED = Counter('datetime_llm_seconds_saved_total', "Estimated LLM latency avoided by resolving date/times locally, by tier.", ['tier'])
+STRUCTURED_OUTPUTS = Counter('llm_structured_outputs_total', "Structured LLM replies by prompt and outcome (ok/repaired/retried/failed).", ['purpose', 'result'])
+
+
+# --- Instrumentation API ---
+class timed:
+    """
+    Records the duration of a stage in STAGE_DURATION and counts exceptions in STAGE_ERRORS.
+    Use as `with timed('vector_search'):` or as a decorator `@timed('whatsapp_send_text')`.
+    Each stage is also recorded as a tracing span of the same name.
+    """
+    __slots__ = ('stage', '_start', '_span')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._start = None
+        self._span = None
+
+    def __enter__(self):
+        self._span = span(self.stage)
+        self._span.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_DURATION.observe(time.perf_counter() - self._start, self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(self.stage)
+        self._span.__exit__(exc_type, exc, tb)
+        return False
+
+    def __call__(self, function):
+        stage = self.stage
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def record_error(stage: str):
+    """For stages that report failure by return value rather than by raising."""
+    STAGE_ERRORS.inc(stage)
+    annotate(failed=True)
+
+def count_event(event: str):
+    EVENTS.inc(event)
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.inc(cache, 'hit' if hit else 'miss')
+
+def record_llm_usage(purpose: str, message):
+    """
+    Adds the token usage reported on a LangChain AI message (or the final streamed chunk).
+    """
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        prompt_tokens, completion_tokens = usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+    else:
+        token_usage = (getattr(message, 'response_metadata', None) or {}).get('token_usage') or {}
+        prompt_tokens, completion_tokens = token_usage.get('prompt_tokens', 0), token_usage.get('completion_tokens', 0)
+    if prompt_tokens:
+        LLM_TOKENS.inc(purpose, 'prompt', amount=prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.inc(purpose, 'completion', amount=completion_tokens)
+
+def record_structured_output(purpose: str, result: str):
+    STRUCTURED_OUTPUTS.inc(purpose, result)
+
+def record_datetime_extraction(tier: str, seconds_saved: float):
+    DATETIME_EXTRACTIONS.inc(tier)
+    if seconds_saved:
+        DATETIME_SECONDS_SAVED.inc(tier, amount=seconds_saved)
+
+def register_queue_depth(queue: str, function):
+    """
+    Samples function() at scrape time, e.g. lambda: executor._work_queue.qsize().
+    """
+    QUEUE_DEPTH.set_function(function, queue)
+
+
+# --- Multi-process Aggregation ---
+def _process_file(pid: int) -> str:
+    return os.path.join(METRICS_MULTIPROC_DIR, f"metrics-{pid}.json")
+
+def flush_process_metrics():
+    """
+    Writes this process's samples to METRICS_MULTIPROC_DIR (atomically).
+    """
+    path = _process_file(os.getpid())
+    try:
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(REGISTRY.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.error(f"Failed to write metrics to {path}: {e}")
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush_process_metrics()
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def _merge(into: dict, snapshot: dict, include_gauges: bool):
+    for name, metric in snapshot.items():
+        if metric['type'] == 'gauge' and not include_gauges:
+            continue # Gauges of exited workers are stale; their counters and histograms still count
+        merged = into.setdefault(name, dict(metric, samples=[]))
+        by_labels = {tuple(labels): value for labels, value in merged['samples']}
+        for labels, value in metric['samples']:
+            key = tuple(labels)
+            if key not in by_labels:
+                by_labels[key] = value
+            elif isinstance(value, list):
+                by_labels[key] = [a + b for a, b in zip(by_labels[key], value)]
+            else:
+                by_labels[key] = by_labels[key] + value
+        merged['samples'] = [[list(labels), value] for labels, value in by_labels.items()]
+
+def collect() -> dict:
+    if not METRICS_MULTIPROC_DIR:
+        return REGISTRY.snapshot()
+    flush_process_metrics()
+    merged = {}
+    for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, "metrics-*.json")):
+        try:
+            pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (ValueError, OSError, json.JSONDecodeError):
+            continue
+        _merge(merged, snapshot, include_gauges=_pid_alive(pid))
+    return merged
+
+
+# --- Exposition ---
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labelvalues, extra=()) -> str:
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def render_metrics() -> str:
+    """
+    Prometheus text exposition format (version 0.0.4).
+    """
+    lines = []
+    for name, metric in sorted(collect().items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric['labelnames']
+        for labels, value in sorted(metric['samples'], key=lambda sample: sample[0]):
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], value[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labelnames, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labelnames, labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+if METRICS_MULTIPROC_DIR:
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
@@ -1,12 +1,20 @@
 import os
+import re
 import json
 import gspread
 import pandas as pd
 import logging
 from oauth2client.service_account import ServiceAccountCredentials
+from metrics import record_cache_lookup
 
 # --- Configuration ---
 SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# Properties rendered into the prompt per search result page ("show me more" returns the next page).
+PROPERTY_PAGE_SIZE = int(os.getenv('PROPERTY_PAGE_SIZE', 5))
+# How long a user's search results stay available for "show me more".
+PROPERTY_CURSOR_TTL_SECONDS = int(os.getenv('PROPERTY_CURSOR_TTL_SECONDS', 3600))
+# Matches kept per cursor; a larger match set is truncated, and the user is asked to narrow the search.
+PROPERTY_CURSOR_MAX_MATCHES = int(os.getenv('PROPERTY_CURSOR_MAX_MATCHES', 50))
 
 # Expected columns in the Google Sheet
 EXPECTED_COLUMNS = [
@@ -14,6 +22,24 @@ EXPECTED_COLUMNS = [
     'city', 'area', 'video1', 'video2', 'img1', 'img2', 'img3', 
     'developer', 'building name'
 ]
+# Columns used by build_property_context, and therefore the only ones a result cursor stores.
+CONTEXT_COLUMNS = ['Title', 'area', 'city', 'emirate', 'Price_AED', 'Bedrooms', 'Description', 'img1', 'img2', 'img3']
+IMAGE_COLUMNS = ['img1', 'img2', 'img3']
+# Filter columns compared as numbers; the others are matched as text.
+NUMERIC_FILTER_COLUMNS = ['Price_AED', 'Bedrooms']
+# One property in the search context; filled from TEMPLATE_COLUMNS in order.
+TEMPLATE_COLUMNS = ['Title', 'area', 'city', 'emirate', 'Price_AED', 'Bedrooms', 'Description']
+PROPERTY_TEMPLATE = "Title: {0}\nLocation: {1}, {2}, {3}\nPrice: {4} AED\nBedrooms: {5}\nDescription: {6}\n"
+
+# Short follow-ups asking for further results of the previous search (English and Arabic).
+MORE_REQUEST_PATTERN = re.compile(
+    r"^(?:(?:please |pls |ok |okay )?(?:(?:show|send|give|list)(?: me)? |any |got any |do you have any )?"
+    r"(?:some |a few )?(?:more|others|other ones|another(?: one)?|the rest|next(?: ones| page)?)"
+    r"(?: (?:please|pls|options|properties|listings|units|results))?"
+    r"|المزيد|كمان|غيرها|التالي|(?:عطني|ابي|أبي|اريد|أريد|ارسل|أرسل|في|فيه)(?: لي)? (?:المزيد|غيرها|كمان|غيرهم))"
+    r"(?: (?:please|pls|لو سمحت|من فضلك))?[\s.!?؟]*$",
+    re.IGNORECASE,
+)
 
 def get_sheet_data():
     """
@@ -46,17 +72,7 @@ def get_sheet_data():
             logging.warning(f"No data found in Google Sheet '{sheet_name}' with ID: {sheet_id}")
             return pd.DataFrame()
 
-        df = pd.DataFrame(records)
-
-        # --- Data Cleaning and Type Conversion ---
-        df['Price_AED'] = pd.to_numeric(df['Price_AED'], errors='coerce')
-        df['Bedrooms'] = pd.to_numeric(df['Bedrooms'], errors='coerce')
-
-        for col in EXPECTED_COLUMNS:
-            if col not in df.columns:
-                df[col] = ''
-
-        df.fillna('', inplace=True)
+        df = records_to_dataframe(records)
 
         logging.info(f"Successfully loaded {len(df)} properties from sheet '{sheet_name}'.")
         return df
@@ -68,6 +84,23 @@ def get_sheet_data():
         logging.error(f"Error accessing Google Sheet: {e}", exc_info=True)
         return pd.DataFrame()
 
+def records_to_dataframe(records):
+    """
+    Builds the property DataFrame from sheet records (dicts keyed by column header).
+    """
+    df = pd.DataFrame(records)
+
+    # --- Data Cleaning and Type Conversion ---
+    df['Price_AED'] = pd.to_numeric(df['Price_AED'], errors='coerce')
+    df['Bedrooms'] = pd.to_numeric(df['Bedrooms'], errors='coerce')
+
+    for col in EXPECTED_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+
+    df.fillna('', inplace=True)
+    return df
+
 def filter_properties(df, filters):
     """
     Filters the property DataFrame based on criteria extracted by the LLM.
@@ -86,7 +119,7 @@ def filter_properties(df, filters):
             operator = details.get('operator')
             value = details.get('value')
 
-            if key in ['Price_AED', 'Bedrooms']:
+            if key in NUMERIC_FILTER_COLUMNS:
                 value = float(value)
                 if operator == '<':
                     filtered_df = filtered_df[filtered_df[key] <= value]
@@ -103,4 +136,127 @@ def filter_properties(df, filters):
             continue
 
     logging.info(f"Filtering completed. Found {len(filtered_df)} matching properties.")
-    return filtered_df 
\ No newline at end of file
+    return filtered_df 
+
+
+def build_property_context(filtered_df, limit=5, offset=0, total=None):
+    """
+    Renders matching properties offset..offset+limit as the 'Relevant Information Found' context for the
+    final LLM prompt, including an image action line for each image URL. The page's columns are taken
+    out once as plain lists and filled into PROPERTY_TEMPLATE, which gives the same text as formatting
+    each row (missing values read "nan" or "None") whatever the column dtypes, without pandas' per-row
+    or per-column overhead. When `total` says more matches follow, a note tells the LLM the client can
+    ask for more.
+    """
+    page = filtered_df.iloc[offset:offset + limit]
+    context_str = "Relevant Information Found:\n"
+    if page.empty:
+        return context_str
+
+    columns = [page[column].tolist() for column in TEMPLATE_COLUMNS + IMAGE_COLUMNS]
+    blocks = []
+    for row in zip(*columns):
+        blocks.append(PROPERTY_TEMPLATE.format(*row))
+        # URLs are checked per cell, not by column dtype: string columns are `str` (not object) under
+        # pandas 3, and an object column may hold numbers only.
+        for url in row[len(TEMPLATE_COLUMNS):]:
+            if isinstance(url, str) and url.startswith('http'):
+                blocks.append(f"[ACTION_SEND_IMAGE_VIA_URL]\n{url}\n{row[0]}\n")
+        blocks.append("---\n")
+    context_str += "".join(blocks)
+    context_str += _more_note(offset, offset + len(page), total)
+    return context_str
+
+def _more_note(offset, shown_until, total):
+    if total is None or total <= shown_until:
+        return ""
+    return f"(Showing properties {offset + 1}-{shown_until} of {total}. The client can ask to see more.)\n"
+
+
+# --- Result Cursors ("show me more") ---
+def is_more_request(text):
+    """
+    True for short follow-ups such as "show me more", "next" or "المزيد" that ask for further results
+    of the previous search rather than starting a new one.
+    """
+    if not text or len(text) > 60:
+        return False
+    return MORE_REQUEST_PATTERN.match(" ".join(text.strip().lower().split())) is not None
+
+
+class PropertyResultCursors:
+    """
+    Keeps each user's latest property matches (only the columns needed for rendering, at most
+    max_matches rows) and how far they have been shown. The cursor lives in shared state, so any worker
+    can serve the next page without re-running query analysis, the sheet fetch or the filtering.
+    """
+    def __init__(self, state=None, page_size=PROPERTY_PAGE_SIZE, ttl=PROPERTY_CURSOR_TTL_SECONDS, max_matches=PROPERTY_CURSOR_MAX_MATCHES):
+        self._state = state
+        self.page_size = page_size
+        self.ttl = ttl
+        self.max_matches = max_matches
+
+    @property
+    def state(self):
+        if self._state is None:
+            from shared_state import get_shared_state
+            self._state = get_shared_state()
+        return self._state
+
+    def _key(self, user_id):
+        return f"property_cursor:{user_id}"
+
+    def _save(self, user_id, cursor):
+        try:
+            self.state.put_value(self._key(user_id), json.dumps(cursor, ensure_ascii=False), self.ttl)
+        except Exception as e:
+            logging.error(f"Failed to store property result cursor for {user_id}: {e}")
+
+    def start(self, user_id, filtered_df):
+        """
+        Stores a new match set for the user (replacing any previous one) and returns its first page.
+        """
+        total = len(filtered_df)
+        matches = filtered_df[CONTEXT_COLUMNS].head(self.max_matches)
+        context_str = build_property_context(matches, self.page_size, 0, len(matches))
+        if total > len(matches):
+            context_str += f"({total} properties matched in total; only the first {len(matches)} can be paged through, so suggest narrowing the search.)\n"
+        if len(matches) > self.page_size:
+            self._save(user_id, {'rows': json.loads(matches.to_json(orient='records')), 'offset': self.page_size})
+        else:
+            self.clear(user_id) # Everything was shown; a later "more" starts a fresh search
+        return context_str
+
+    def next_page(self, user_id):
+        """
+        Returns the context for the user's next page of cached matches, or None if there is no cursor
+        (expired, never created, or exhausted), in which case the caller searches normally.
+        """
+        try:
+            raw = self.state.get_value(self._key(user_id))
+        except Exception as e:
+            logging.error(f"Failed to read property result cursor for {user_id}: {e}")
+            raw = None
+        record_cache_lookup('property_cursor', raw is not None)
+        if raw is None:
+            return None
+
+        cursor = json.loads(raw)
+        rows, offset = cursor['rows'], cursor['offset']
+        page_df = pd.DataFrame.from_records(rows[offset:offset + self.page_size], columns=CONTEXT_COLUMNS).fillna('')
+        shown_until = offset + len(page_df)
+        context_str = build_property_context(page_df, self.page_size) + _more_note(offset, shown_until, len(rows))
+        if shown_until < len(rows):
+            cursor['offset'] = shown_until
+            self._save(user_id, cursor)
+        else:
+            context_str += f"(These are the last of the {len(rows)} properties from the previous search.)\n"
+            self.clear(user_id)
+        logging.info(f"Served property results {offset + 1}-{shown_until} of {len(rows)} from the cursor for {user_id}.")
+        return context_str
+
+    def clear(self, user_id):
+        try:
+            self.state.delete_value(self._key(user_id))
+        except Exception as e:
+            logging.error(f"Failed to clear property result cursor for {user_id}: {e}")
@@ -1,27 +1,57 @@
 import os
+import re
+import math
+import heapq
+import bisect
 import logging
 import json
 import shutil
+import threading
+import numpy as np
+import faiss
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.document_loaders import TextLoader
 from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from index_builder import RAG_INDEX_FACTORY, INDEX_FACTORY_FILE, create_index, apply_search_params, delete_from_store, save_index_factory
+from shared_index import RAG_SHARED_INDEX, SharedIndexReader, publish_snapshot, read_current_generation
+from metrics import record_cache_lookup
 
 # --- Global Constants ---
 VECTOR_STORE_PATH = "faiss_index"
 EMBEDDING_MODEL_NAME = "models/embedding-001" # Gemini embedding model
 PROCESSED_FILES_LOG_PATH = os.path.join(VECTOR_STORE_PATH, "processed_files.log")
+# source (file path or Google document ID) -> docstore IDs of its chunks, saved next to the index.
+SOURCE_INDEX_PATH = os.path.join(VECTOR_STORE_PATH, "source_index.json")
+# Text of the placeholder document used to create an empty FAISS index. Never returned by queries.
+INIT_PLACEHOLDER_TEXT = "init"
+
+# --- Hybrid Retrieval Configuration ---
+# Candidates fetched from each retriever (vector and keyword) before fusion.
+RAG_FETCH_K = int(os.getenv('RAG_FETCH_K', 20))
+# Reciprocal-rank-fusion constant (standard value from the RRF paper).
+RAG_RRF_K = int(os.getenv('RAG_RRF_K', 60))
+# Keyword hits whose BM25 score is below this fraction of the best BM25 score are dropped before fusion.
+# (Fused RRF scores only reflect rank, so they are never thresholded.)
+RAG_MIN_RELATIVE_SCORE = float(os.getenv('RAG_MIN_RELATIVE_SCORE', 0.5))
+# Optional absolute cutoff on the FAISS distance of vector hits (unset = no cutoff).
+RAG_MAX_VECTOR_DISTANCE = float(os.getenv('RAG_MAX_VECTOR_DISTANCE')) if os.getenv('RAG_MAX_VECTOR_DISTANCE') else None
+# MMR trade-off between relevance (1.0) and novelty (0.0).
+RAG_MMR_LAMBDA = float(os.getenv('RAG_MMR_LAMBDA', 0.7))
+# Candidates whose token overlap with an already selected chunk reaches this are treated as duplicates.
+RAG_DUPLICATE_OVERLAP = float(os.getenv('RAG_DUPLICATE_OVERLAP', 0.8))
 
 
 # Set up basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def initialize_vector_store():
+def create_embeddings_object():
     """
-    Initializes or loads a FAISS vector store using Google Generative AI Embeddings.
+    Creates the Google Generative AI embeddings used by the vector store, or None if unavailable.
     """
     # Using "GEMINI_API_KEY" as specified by the user's environment variable on Render
     gemini_api_key_local = os.getenv('GEMINI_API_KEY')
@@ -30,11 +60,19 @@ def initialize_vector_store():
         return None
 
     try:
-        embeddings_object = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL_NAME, google_api_key=gemini_api_key_local)
+        return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL_NAME, google_api_key=gemini_api_key_local)
     except Exception as e:
         logging.error(f"Failed to initialize GoogleGenerativeAIEmbeddings: {e}", exc_info=True)
         return None
 
+def initialize_vector_store():
+    """
+    Initializes or loads a FAISS vector store using Google Generative AI Embeddings.
+    """
+    embeddings_object = create_embeddings_object()
+    if not embeddings_object:
+        return None
+
     force_reindex = os.getenv('FORCE_REINDEX', 'false').lower() == 'true'
     if force_reindex:
         if os.path.exists(VECTOR_STORE_PATH):
@@ -60,16 +98,17 @@ def initialize_vector_store():
         try:
             logging.info(f"Attempting to load existing FAISS index from {VECTOR_STORE_PATH}")
             faiss_store = FAISS.load_local(VECTOR_STORE_PATH, embeddings_object, allow_dangerous_deserialization=True)
-            logging.info("FAISS index loaded successfully.")
+            apply_search_params(faiss_store.index)
+            logging.info(f"FAISS index loaded successfully ({type(faiss_store.index).__name__}, {faiss_store.index.ntotal} vectors).")
         except Exception as e:
             logging.error(f"Failed to load existing FAISS index from {VECTOR_STORE_PATH}: {e}. Attempting to create a new one.", exc_info=True)
             faiss_store = None
 
     if not faiss_store:
         try:
-            logging.info(f"Creating new FAISS index at {VECTOR_STORE_PATH}")
-            faiss_store = FAISS.from_texts(["init"], embeddings_object)
-            faiss_store.save_local(VECTOR_STORE_PATH)
+            logging.info(f"Creating new FAISS index at {VECTOR_STORE_PATH} (factory: '{RAG_INDEX_FACTORY}')")
+            faiss_store = create_empty_store(embeddings_object)
+            save_vector_store(faiss_store)
             logging.info("New FAISS index created and saved successfully.")
         except Exception as e:
             logging.error(f"Error creating or saving new FAISS index at {VECTOR_STORE_PATH}: {e}", exc_info=True)
@@ -77,6 +116,48 @@ def initialize_vector_store():
 
     return faiss_store
 
+def initialize_shared_vector_store():
+    """
+    Opens the latest published read-only snapshot for this worker (RAG_SHARED_INDEX mode).
+    If nothing has been published yet, the writable store is loaded (or created) once and published.
+    Returns a SharedIndexReader; call .current() for the store to query.
+    """
+    embeddings_object = create_embeddings_object()
+    if not embeddings_object:
+        return None
+
+    if read_current_generation(VECTOR_STORE_PATH) is None:
+        logging.info(f"No index snapshot published under {VECTOR_STORE_PATH} yet. Publishing the current store.")
+        writable_store = initialize_vector_store()
+        if not writable_store:
+            return None
+        publish_vector_store_snapshot(writable_store)
+
+    reader = SharedIndexReader(VECTOR_STORE_PATH, embeddings_object, on_swap=forget_store)
+    if not reader.refresh():
+        logging.error(f"Failed to load an index snapshot from {VECTOR_STORE_PATH}.")
+        return None
+    return reader
+
+def create_empty_store(embeddings_object) -> FAISS:
+    """
+    Creates a store holding only the placeholder document, using RAG_INDEX_FACTORY when the index type
+    can be built empty (Flat, HNSW). Types that need training (IVF, PQ) start flat and are migrated
+    once there is data with: python index_builder.py rebuild --factory "<factory>"
+    """
+    dimension = len(embeddings_object.embed_query(INIT_PLACEHOLDER_TEXT))
+    index = create_index(dimension)
+    factory = RAG_INDEX_FACTORY
+    if not index.is_trained:
+        logging.warning(f"Index factory '{RAG_INDEX_FACTORY}' requires training; starting with a flat index. Run index_builder.py rebuild once documents are loaded.")
+        index = create_index(dimension, 'Flat')
+        factory = 'Flat'
+    faiss_store = FAISS(embedding_function=embeddings_object, index=apply_search_params(index), docstore=InMemoryDocstore(), index_to_docstore_id={})
+    faiss_store.add_texts([INIT_PLACEHOLDER_TEXT])
+    os.makedirs(VECTOR_STORE_PATH, exist_ok=True)
+    save_index_factory(VECTOR_STORE_PATH, factory)
+    return faiss_store
+
 # --- Processed Files Log Management ---
 def get_processed_files_log() -> dict:
     """
@@ -148,9 +229,12 @@ def process_document(file_path: str, vector_store: FAISS, embeddings: GoogleGene
         return False
 
     try:
+        # A modified file replaces its previous chunks instead of adding duplicates.
+        delete_document_from_vector_store(file_path, vector_store)
         logging.info(f"process_document: Adding {len(texts)} chunks from {file_path} to the vector store.")
-        vector_store.add_documents(texts)
-        vector_store.save_local(VECTOR_STORE_PATH)
+        added_ids = vector_store.add_documents(texts)
+        index_added_chunks(vector_store, added_ids, texts)
+        save_vector_store(vector_store)
         logging.info(f"process_document: Successfully processed '{file_path}' and saved index.")
 
         try:
@@ -167,10 +251,12 @@ def process_document(file_path: str, vector_store: FAISS, embeddings: GoogleGene
 
 def remove_document_from_store(file_path: str, vector_store: FAISS) -> bool:
     """
-    Logs the removal of a document. Actual vector removal from FAISS is not implemented here.
+    Deletes the chunks of a file removed from the company data folder and marks it in the processed files log.
     """
     logging.info(f"remove_document_from_store: File '{file_path}' detected as removed.")
-    logging.warning("Automated removal from FAISS is not implemented. Re-index for complete removal.")
+
+    if vector_store and delete_document_from_vector_store(file_path, vector_store):
+        save_vector_store(vector_store)
 
     try:
         processed_logs = get_processed_files_log()
@@ -186,7 +272,9 @@ def remove_document_from_store(file_path: str, vector_store: FAISS) -> bool:
 # --- Google Drive Document Processing ---
 def delete_document_from_vector_store(document_id: str, vector_store: FAISS) -> bool:
     """
-    Deletes all vectors associated with a given document_id from the FAISS vector store.
+    Deletes all vectors associated with a given source (Google document ID or local file path)
+    from the FAISS vector store. Chunk IDs come from the source index, not a docstore scan.
+    Does not save; callers save once after their full update.
     """
     logging.info(f"Attempting to delete document with ID '{document_id}' from vector store.")
     if not all([vector_store, vector_store.index, vector_store.docstore, hasattr(vector_store.docstore, '_dict')]):
@@ -194,15 +282,13 @@ def delete_document_from_vector_store(document_id: str, vector_store: FAISS) ->
         return False
 
     try:
-        ids_to_remove = [
-            doc_uuid for doc_uuid, doc in vector_store.docstore._dict.items()
-            if doc.metadata.get('source') == document_id
-        ]
+        ids_to_remove = get_source_index(vector_store).get(document_id)
         if not ids_to_remove:
             logging.info(f"No document chunks found with source ID '{document_id}'. Nothing to delete.")
             return False
 
-        vector_store.delete(ids_to_remove)
+        delete_from_store(vector_store, ids_to_remove)
+        index_removed_chunks(vector_store, ids_to_remove)
         logging.info(f"Successfully deleted {len(ids_to_remove)} chunks for document ID '{document_id}'.")
         return True
     except Exception as e:
@@ -225,7 +311,7 @@ def process_google_document_text(document_id: str, text_content: str, vector_sto
         # If new content is empty, we are done after deletion.
         if not text_content or not text_content.strip():
             logging.warning(f"Text content for document ID '{document_id}' is empty. Ensured no entries exist.")
-            vector_store.save_local(VECTOR_STORE_PATH)
+            save_vector_store(vector_store)
             return True
 
         # Step 2: Split new text and create Document objects
@@ -233,14 +319,15 @@ def process_google_document_text(document_id: str, text_content: str, vector_sto
         chunks = text_splitter.split_text(text_content)
         if not chunks:
             logging.warning(f"No text chunks generated for document ID '{document_id}'.")
-            vector_store.save_local(VECTOR_STORE_PATH) # Save after potential deletion
+            save_vector_store(vector_store) # Save after potential deletion
             return True # Not an error, just nothing to add
 
         docs = [Document(page_content=chunk, metadata={'source': document_id}) for chunk in chunks]
         
         # Step 3: Add new documents and save
-        vector_store.add_documents(docs)
-        vector_store.save_local(VECTOR_STORE_PATH)
+        added_ids = vector_store.add_documents(docs)
+        index_added_chunks(vector_store, added_ids, docs)
+        save_vector_store(vector_store)
         logging.info(f"Successfully added {len(docs)} new chunks for document ID '{document_id}' and saved index.")
         return True
 
@@ -248,10 +335,400 @@ def process_google_document_text(document_id: str, text_content: str, vector_sto
         logging.error(f"Error processing Google document text for ID '{document_id}': {e}", exc_info=True)
         return False
 
+# --- Source -> Chunk-ID Index ---
+class SourceIndex:
+    """
+    Maps each source to the docstore IDs of its chunks (and each ID back to its source) so a document
+    can be deleted without scanning the docstore. Persisted as source_index.json alongside the FAISS files.
+    """
+    def __init__(self, mapping: dict = None):
+        self._source_to_ids = {}
+        self._id_to_source = {}
+        self._lock = threading.Lock()
+        for source, doc_ids in (mapping or {}).items():
+            self.add(source, doc_ids)
+
+    @classmethod
+    def from_docstore(cls, vector_store: FAISS):
+        source_index = cls()
+        for doc_id, doc in vector_store.docstore._dict.items():
+            source = doc.metadata.get('source')
+            if source:
+                source_index.add(source, [doc_id])
+        return source_index
+
+    def get(self, source: str) -> list:
+        with self._lock:
+            return list(self._source_to_ids.get(source, ()))
+
+    def add(self, source: str, doc_ids: list):
+        with self._lock:
+            ids = self._source_to_ids.setdefault(source, {}) # dict as an insertion-ordered set
+            for doc_id in doc_ids:
+                ids[doc_id] = None
+                self._id_to_source[doc_id] = source
+
+    def remove_ids(self, doc_ids: list):
+        with self._lock:
+            for doc_id in doc_ids:
+                source = self._id_to_source.pop(doc_id, None)
+                if source is None:
+                    continue
+                ids = self._source_to_ids[source]
+                ids.pop(doc_id, None)
+                if not ids:
+                    del self._source_to_ids[source]
+
+    def chunk_count(self) -> int:
+        with self._lock:
+            return len(self._id_to_source)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {source: list(ids) for source, ids in self._source_to_ids.items()}
+
+
+_source_indexes = {}
+_source_indexes_lock = threading.Lock()
+
+def _load_source_index(vector_store: FAISS):
+    # A snapshot store carries the copy published with it.
+    snapshot_dir = getattr(vector_store.docstore, 'snapshot_dir', None)
+    path = os.path.join(snapshot_dir, os.path.basename(SOURCE_INDEX_PATH)) if snapshot_dir else SOURCE_INDEX_PATH
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            source_index = SourceIndex(json.load(f))
+    except (IOError, json.JSONDecodeError) as e:
+        logging.error(f"Error reading source index at {path}: {e}")
+        return None
+    if snapshot_dir:
+        return source_index # Published together with the docstore, so it matches it
+    # The file is only trusted if it matches the docstore it was saved with.
+    sourced_chunks = sum(1 for doc in vector_store.docstore._dict.values() if doc.metadata.get('source'))
+    if source_index.chunk_count() != sourced_chunks:
+        logging.warning(f"Source index at {SOURCE_INDEX_PATH} is out of date ({source_index.chunk_count()} vs {sourced_chunks} chunks).")
+        return None
+    return source_index
+
+def get_source_index(vector_store: FAISS) -> SourceIndex:
+    """
+    Returns the source index for a vector store: loaded from disk, or rebuilt from the docstore when
+    missing or stale.
+    """
+    key = id(vector_store)
+    with _source_indexes_lock:
+        entry = _source_indexes.get(key)
+        if entry and entry[0] is vector_store:
+            return entry[1]
+        source_index = _load_source_index(vector_store)
+        if source_index is None:
+            source_index = SourceIndex.from_docstore(vector_store)
+            logging.info(f"Rebuilt source index from docstore: {len(source_index.to_dict())} sources, {source_index.chunk_count()} chunks.")
+        _source_indexes[key] = (vector_store, source_index)
+        return source_index
+
+def save_source_index(vector_store: FAISS):
+    """
+    Writes the source index atomically next to the FAISS files.
+    """
+    source_index = get_source_index(vector_store)
+    tmp_path = f"{SOURCE_INDEX_PATH}.tmp"
+    try:
+        os.makedirs(os.path.dirname(SOURCE_INDEX_PATH), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(source_index.to_dict(), f)
+        os.replace(tmp_path, SOURCE_INDEX_PATH)
+    except IOError as e:
+        logging.error(f"Error writing source index to {SOURCE_INDEX_PATH}: {e}", exc_info=True)
+
+def save_vector_store(vector_store: FAISS):
+    """
+    Saves the FAISS index and docstore together with the source index. In RAG_SHARED_INDEX mode
+    the saved state is also published as a new snapshot generation for the web workers.
+    """
+    vector_store.save_local(VECTOR_STORE_PATH)
+    save_source_index(vector_store)
+    if RAG_SHARED_INDEX:
+        publish_vector_store_snapshot(vector_store)
+
+def publish_vector_store_snapshot(vector_store: FAISS) -> int:
+    return publish_snapshot(vector_store, VECTOR_STORE_PATH, extra_files=(SOURCE_INDEX_PATH, os.path.join(VECTOR_STORE_PATH, INDEX_FACTORY_FILE)),
+                            keyword_index=get_keyword_index(vector_store))
+
+def forget_store(vector_store: FAISS):
+    """
+    Drops the derived indexes kept for a store that has been replaced (e.g. by a newer snapshot).
+    """
+    with _source_indexes_lock:
+        _source_indexes.pop(id(vector_store), None)
+    with _keyword_indexes_lock:
+        _keyword_indexes.pop(id(vector_store), None)
+
+# --- Keyword (BM25) Index ---
+_TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text: str) -> list:
+    """
+    Lowercased word tokens. Keeps numbers (unit numbers, prices) and non-Latin scripts such as Arabic.
+    """
+    return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class KeywordIndex:
+    """
+    In-process BM25 inverted index over the chunks of a FAISS docstore, keyed by docstore ID.
+    Catches exact matches (building names, unit numbers) that embeddings handle poorly.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}     # term -> {doc_id: term frequency}
+        self._doc_lengths = {}  # doc_id -> number of tokens
+        self._doc_terms = {}    # doc_id -> distinct terms, so removal only touches its own postings
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._doc_lengths)
+
+    def add(self, doc_id: str, text: str):
+        tokens = tokenize(text)
+        term_counts = {}
+        for token in tokens:
+            term_counts[token] = term_counts.get(token, 0) + 1
+        with self._lock:
+            if doc_id in self._doc_lengths:
+                self._remove_locked(doc_id)
+            for term, count in term_counts.items():
+                self._postings.setdefault(term, {})[doc_id] = count
+            self._doc_terms[doc_id] = list(term_counts)
+            self._doc_lengths[doc_id] = len(tokens)
+            self._total_length += len(tokens)
+
+    def remove(self, doc_id: str):
+        with self._lock:
+            self._remove_locked(doc_id)
+
+    def _remove_locked(self, doc_id: str):
+        length = self._doc_lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._doc_terms.pop(doc_id, []):
+            doc_counts = self._postings.get(term)
+            if doc_counts is not None:
+                doc_counts.pop(doc_id, None)
+                if not doc_counts:
+                    del self._postings[term]
+
+    def search(self, query_text: str, k: int) -> list:
+        """
+        Returns up to k (doc_id, bm25_score) pairs, best first.
+        """
+        query_terms = set(tokenize(query_text))
+        with self._lock:
+            doc_count = len(self._doc_lengths)
+            if not doc_count or not query_terms:
+                return []
+            avg_length = self._total_length / doc_count or 1.0
+            scores = {}
+            for term in query_terms:
+                doc_counts = self._postings.get(term)
+                if not doc_counts:
+                    continue
+                idf = math.log(1 + (doc_count - len(doc_counts) + 0.5) / (len(doc_counts) + 0.5))
+                for doc_id, tf in doc_counts.items():
+                    norm = tf + self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def to_arrays(self, ids: list) -> dict:
+        """
+        The index as flat arrays over docstore positions (ids[i] is position i), for publishing in a
+        snapshot: sorted terms, each term's range in postings/frequencies, per-position document
+        lengths, and totals = [document count, total length].
+        """
+        positions = {doc_id: position for position, doc_id in enumerate(ids)}
+        with self._lock:
+            terms = sorted(self._postings)
+            term_offsets = [0]
+            postings, frequencies = [], []
+            for term in terms:
+                for doc_id, tf in self._postings[term].items():
+                    postings.append(positions[doc_id])
+                    frequencies.append(tf)
+                term_offsets.append(len(postings))
+            doc_lengths = np.zeros(len(ids), dtype=np.int32)
+            for doc_id, length in self._doc_lengths.items():
+                doc_lengths[positions[doc_id]] = length
+            totals = np.array([len(self._doc_lengths), self._total_length], dtype=np.int64)
+        return {
+            'terms': terms,
+            'term_offsets': np.array(term_offsets, dtype=np.int64),
+            'postings': np.array(postings, dtype=np.int32),
+            'frequencies': np.array(frequencies, dtype=np.int32),
+            'doc_lengths': doc_lengths,
+            'totals': totals,
+        }
+
+
+class MappedKeywordIndex:
+    """
+    Read-only BM25 search over a keyword index published in a snapshot (KeywordIndex.to_arrays).
+    The arrays are memory-mapped, so workers share one copy through the page cache. Scores are
+    the same as KeywordIndex's.
+    """
+    def __init__(self, arrays: dict, ids: list, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._ids = ids
+        self._terms = arrays['terms']
+        self._term_offsets = arrays['term_offsets']
+        self._postings = arrays['postings']
+        self._frequencies = arrays['frequencies']
+        self._doc_lengths = arrays['doc_lengths']
+        self._doc_count, self._total_length = (int(value) for value in arrays['totals'])
+
+    def __len__(self):
+        return self._doc_count
+
+    def _term_range(self, term: str):
+        i = bisect.bisect_left(self._terms, term)
+        if i < len(self._terms) and self._terms[i] == term:
+            return int(self._term_offsets[i]), int(self._term_offsets[i + 1])
+        return None
+
+    def search(self, query_text: str, k: int) -> list:
+        """
+        Returns up to k (doc_id, bm25_score) pairs, best first.
+        """
+        query_terms = set(tokenize(query_text))
+        if not self._doc_count or not query_terms or k <= 0:
+            return []
+        avg_length = self._total_length / self._doc_count or 1.0
+        term_positions, term_scores = [], []
+        for term in query_terms:
+            term_range = self._term_range(term)
+            if term_range is None:
+                continue
+            positions = np.asarray(self._postings[term_range[0]:term_range[1]])
+            tf = self._frequencies[term_range[0]:term_range[1]].astype(np.float64)
+            idf = math.log(1 + (self._doc_count - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = tf + self.k1 * (1 - self.b + self.b * self._doc_lengths[positions] / avg_length)
+            term_positions.append(positions)
+            term_scores.append(idf * tf * (self.k1 + 1) / norm)
+        if not term_positions:
+            return []
+        positions, scores = np.concatenate(term_positions), np.concatenate(term_scores)
+        if len(term_positions) > 1: # Sum each chunk's scores over the query terms
+            positions, inverse = np.unique(positions, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self._ids[int(positions[i])], float(scores[i])) for i in top]
+
+
+# Keyword indexes are kept per vector store object: mapped from the snapshot for snapshot stores,
+# otherwise built lazily from the docstore.
+_keyword_indexes = {}
+_keyword_indexes_lock = threading.Lock()
+
+def _is_placeholder(doc) -> bool:
+    return doc.page_content == INIT_PLACEHOLDER_TEXT and not doc.metadata.get('source')
+
+def get_keyword_index(vector_store: FAISS):
+    """
+    Returns the keyword index for a vector store: the one published in its snapshot, or else one
+    built from the docstore on first use.
+    """
+    key = id(vector_store)
+    with _keyword_indexes_lock:
+        entry = _keyword_indexes.get(key)
+        if entry and entry[0] is vector_store:
+            record_cache_lookup('keyword_index', True)
+            return entry[1]
+        record_cache_lookup('keyword_index', False)
+        keyword_arrays = getattr(vector_store.docstore, 'keyword_arrays', None)
+        if keyword_arrays is not None:
+            keyword_index = MappedKeywordIndex(keyword_arrays, vector_store.docstore.ids)
+            _keyword_indexes[key] = (vector_store, keyword_index)
+            return keyword_index
+        keyword_index = KeywordIndex()
+        for doc_id, doc in vector_store.docstore._dict.items():
+            if not _is_placeholder(doc):
+                keyword_index.add(doc_id, doc.page_content)
+        _keyword_indexes[key] = (vector_store, keyword_index)
+        logging.info(f"Built keyword index with {len(keyword_index)} chunks.")
+        return keyword_index
+
+def index_added_chunks(vector_store: FAISS, doc_ids: list, docs: list):
+    """
+    Keeps the source and keyword indexes in step with chunks just added to the vector store.
+    """
+    source_index = get_source_index(vector_store)
+    for doc_id, doc in zip(doc_ids or [], docs):
+        if doc.metadata.get('source'):
+            source_index.add(doc.metadata['source'], [doc_id])
+    entry = _keyword_indexes.get(id(vector_store))
+    if not entry or entry[0] is not vector_store:
+        return # Not built yet; it will be built from the docstore on first query.
+    for doc_id, doc in zip(doc_ids or [], docs):
+        entry[1].add(doc_id, doc.page_content)
+
+def index_removed_chunks(vector_store: FAISS, doc_ids: list):
+    """
+    Keeps the source and keyword indexes in step with chunks just deleted from the vector store.
+    """
+    get_source_index(vector_store).remove_ids(doc_ids)
+    entry = _keyword_indexes.get(id(vector_store))
+    if not entry or entry[0] is not vector_store:
+        return
+    for doc_id in doc_ids:
+        entry[1].remove(doc_id)
+
+
 # --- Querying ---
+def _vector_search(query_text: str, vector_store: FAISS, k: int) -> list:
+    """
+    Dense search returning (doc_id, distance) pairs so hits can be fused with keyword hits by ID.
+    Tombstoned positions (deleted chunks of non-removable indexes) are skipped; while they leave
+    fewer than k hits, the search is repeated with a larger k.
+    """
+    embedding_function = vector_store.embedding_function
+    if hasattr(embedding_function, 'embed_query'):
+        query_embedding = embedding_function.embed_query(query_text)
+    else:
+        query_embedding = embedding_function(query_text)
+    query_vector = np.array([query_embedding], dtype=np.float32)
+    if getattr(vector_store, '_normalize_L2', False):
+        faiss.normalize_L2(query_vector)
+    search_k = k
+    while True:
+        distances, positions = vector_store.index.search(query_vector, search_k)
+        results = []
+        for distance, position in zip(distances[0], positions[0]):
+            if position == -1:
+                continue
+            doc_id = vector_store.index_to_docstore_id.get(int(position))
+            if doc_id is not None:
+                results.append((doc_id, float(distance)))
+        # -1 means the index (at its nprobe/efSearch) has nothing more to return
+        if len(results) >= k or search_k >= vector_store.index.ntotal or (positions[0] == -1).any():
+            return results[:k]
+        search_k = min(search_k * 2, vector_store.index.ntotal)
+
+def _token_overlap(tokens_a: set, tokens_b: set) -> float:
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
 def query_vector_store(query_text: str, vector_store: FAISS, k: int = 4):
     """
-    Queries the vector store for similar documents.
+    Hybrid retrieval: weak hits are cut off per retriever (BM25 score, optional vector distance), the
+    rest are combined with reciprocal-rank fusion, and MMR drops near-duplicate (overlapping) chunks.
+    Returns at most k documents; never returns the 'init' placeholder.
     """
     if not vector_store:
         logging.warning("query_vector_store: Vector store not initialized.")
@@ -259,15 +736,60 @@ def query_vector_store(query_text: str, vector_store: FAISS, k: int = 4):
 
     if not hasattr(vector_store, 'index_to_docstore_id') or len(vector_store.index_to_docstore_id) <= 1:
         logging.warning("query_vector_store: Vector store may be empty or contain only the 'init' document.")
-        # Allow query to proceed, may return the 'init' doc.
 
     try:
-        logging.info(f"Performing similarity search for query: '{query_text}' with k={k}")
-        results = vector_store.similarity_search(query_text, k=k)
-        logging.info(f"Found {len(results)} results.")
-        return results
+        fetch_k = max(RAG_FETCH_K, k)
+        vector_hits = _vector_search(query_text, vector_store, fetch_k)
+        if RAG_MAX_VECTOR_DISTANCE is not None:
+            vector_hits = [(doc_id, distance) for doc_id, distance in vector_hits if distance <= RAG_MAX_VECTOR_DISTANCE]
+        keyword_hits = get_keyword_index(vector_store).search(query_text, fetch_k)
+        if keyword_hits:
+            best_keyword_score = max(score for _, score in keyword_hits)
+            keyword_hits = [(doc_id, score) for doc_id, score in keyword_hits if score >= best_keyword_score * RAG_MIN_RELATIVE_SCORE]
+
+        fused_scores = {}
+        for hits in (vector_hits, keyword_hits):
+            for rank, (doc_id, _) in enumerate(hits, start=1):
+                fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + 1.0 / (RAG_RRF_K + rank)
+
+        candidates = []
+        for doc_id, fused_score in sorted(fused_scores.items(), key=lambda item: item[1], reverse=True):
+            doc = vector_store.docstore.search(doc_id)
+            if not hasattr(doc, 'page_content') or _is_placeholder(doc):
+                continue
+            candidates.append((doc, fused_score))
+        if not candidates:
+            logging.info(f"No results for query: '{query_text}'.")
+            return []
+
+        best_score = candidates[0][1]
+        candidates = [(doc, score / best_score) for doc, score in candidates]
+
+        # Maximal marginal relevance over token sets: overlapping chunks from the splitter
+        # (chunk_overlap=200) share most of their tokens and are pushed out in favour of new content.
+        candidate_tokens = [set(tokenize(doc.page_content)) for doc, _ in candidates]
+        selected = []
+        selected_tokens = []
+        remaining = list(range(len(candidates)))
+        while remaining and len(selected) < k:
+            best_index, best_mmr = None, None
+            for i in remaining:
+                redundancy = max((_token_overlap(candidate_tokens[i], tokens) for tokens in selected_tokens), default=0.0)
+                if redundancy >= RAG_DUPLICATE_OVERLAP:
+                    continue
+                mmr_score = RAG_MMR_LAMBDA * candidates[i][1] - (1 - RAG_MMR_LAMBDA) * redundancy
+                if best_mmr is None or mmr_score > best_mmr:
+                    best_index, best_mmr = i, mmr_score
+            if best_index is None:
+                break
+            selected.append(candidates[best_index][0])
+            selected_tokens.append(candidate_tokens[best_index])
+            remaining.remove(best_index)
+
+        logging.info(f"Hybrid search for '{query_text}': {len(vector_hits)} vector hits, {len(keyword_hits)} keyword hits, {len(candidates)} candidates, {len(selected)} returned.")
+        return selected
     except Exception as e:
-        logging.error(f"Error during similarity search: {e}", exc_info=True)
+        logging.error(f"Error during hybrid search: {e}", exc_info=True)
         return []
 
 # --- Main Test Block ---
@@ -316,9 +838,7 @@ if __name__ == '__main__':
         query_results = query_vector_store("Gemini performance", vs)
         if query_results:
             for i, doc in enumerate(query_results):
-                # Filter out the 'init' document from results
-                if "init" not in doc.page_content:
-                    logging.info(f"Query Result {i+1}: {doc.page_content[:100]}... (Source: {doc.metadata.get('source')})")
+                logging.info(f"Query Result {i+1}: {doc.page_content[:100]}... (Source: {doc.metadata.get('source')})")
         else:
             logging.info("No relevant results found for 'Gemini performance'.")
     else:
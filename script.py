@@ -7,43 +7,66 @@ import requests
 import pandas as pd
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.schema import SystemMessage, HumanMessage, AIMessage
-from flask import Flask, request, jsonify, current_app
+from flask import Flask, request, jsonify, current_app, send_from_directory
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
 import re
 import tempfile
 from openai import OpenAI
-from media_handler import download_and_decrypt_media
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
 import pytz
-import smtplib
-from email.mime.text import MIMEText
 import property_handler
 
 # Ensure rag_handler.py is in the same directory or accessible via PYTHONPATH
 from rag_handler import (
     initialize_vector_store,
-    process_document,
     query_vector_store,
-    get_processed_files_log,
-    remove_document_from_store,
-    process_google_document_text # Added for Google Drive document processing
+    initialize_shared_vector_store
 )
-from google_drive_handler import ( # Added for Google Drive document processing
-    get_google_drive_file_mime_type,
-    get_google_doc_content,
-    get_google_sheet_content
+from shared_index import RAG_SHARED_INDEX, SharedIndexReader
+from indexer import ( # Document ingestion shared with the standalone indexer process
+    COMPANY_DATA_FOLDER,
+    RAG_INDEXER_MODE,
+    find_company_data_changes,
+    scan_company_data_folder,
+    sync_google_document
 )
+from job_queue import enqueue_job, pending_job_count, JOB_GOOGLE_DOCUMENT, JOB_IMAGE_INDEX
 from outreach_handler import process_outreach_campaign # For outreach feature
 from whatsapp_utils import send_whatsapp_message, send_whatsapp_image_message # For sending WhatsApp messages
+from summary_handler import load_summary, schedule_summary_update # Rolling summaries of evicted history
+from lazy_init import components # Background startup of clients, vector store and Google services
+from shared_state import get_shared_state # Pause flags, dedupe keys and job locks shared across workers
+from summary_handler import summary_executor
+from metrics import timed, record_error, count_event, record_llm_usage, register_queue_depth, render_metrics
+from tracing import span, annotate, set_trace_message_id
+from structured_output import invoke_structured, conform, StructuredOutputError # JSON-mode calls with local repair and schema validation
+from calendar_client import get_calendar_client, GOOGLE_CALENDAR_ID # Pooled Calendar services shared with calendar_handler.py
+from calendar_cache import FreeBusyCache, event_bounds # Local free/busy copy of the booking calendar
+from slot_finder import find_alternative_slots, SLOT_SEARCH_DAYS # Nearest free slots when a requested time is taken
+from datetime_extractor import DateTimeExtractor # Local date/time rules before the LLM
+from email_dispatcher import send_email # Queued SMTP delivery on a background thread
+from intent_router import route_message, INTENT_SCHEDULING, INTENT_SMALLTALK # Compiled keyword pre-router
+from media_pipeline import fetch_media, MEDIA_OK, MEDIA_SKIPPED, MEDIA_INVALID, MEDIA_TOO_LARGE, MEDIA_BUSY # Size-limited downloads on a bounded pool
+from image_analysis import IMAGE_ANALYSIS_ENABLED, cached_image_analysis, analyze_image, describe_image_message # Vision descriptions of inbound photos
+from image_index import match_listing_photos, refresh_from_sheet as refresh_image_index # Catalogue photo lookup by PropertyID
+from image_preflight import IMAGE_PREFLIGHT_ENABLED, IMAGE_THUMBNAIL_DIR, get_image_preflight, refresh_catalogue_preflight # Checked catalogue image URLs
 
 # ─── Data Ingestion Configuration ──────────────────────────────────────────────
-COMPANY_DATA_FOLDER = 'company_data'
+# Upper bound on retrieved chunks put in the prompt; the hybrid retriever often returns fewer.
+RAG_MAX_CONTEXT_CHUNKS = int(os.getenv('RAG_MAX_CONTEXT_CHUNKS', 5))
 
 # ─── Google Calendar Configuration ─────────────────────────────────────────────
-SCOPES = ['https://www.googleapis.com/auth/calendar']
+# GOOGLE_CALENDAR_ID and the credentials are read by calendar_client.py.
+# When enabled, messages the router classifies as scheduling (without property vocabulary) are booked
+# directly by handle_appointment_scheduling (checks, alternative slots, calendar insert) instead of the LLM.
+APPOINTMENT_DIRECT_BOOKING = os.getenv('APPOINTMENT_DIRECT_BOOKING', 'false').lower() == 'true'
+# Answer availability checks from a local copy of the calendar kept current with incremental sync.
+# Every worker then syncs at boot and polls the Calendar API, so it defaults to on only with direct booking,
+# the only consumer.
+CALENDAR_FREEBUSY_CACHE = os.getenv('CALENDAR_FREEBUSY_CACHE', str(APPOINTMENT_DIRECT_BOOKING)).lower() == 'true'
+# Re-read each created event by ID as a diagnostic (one extra API call per booking).
+CALENDAR_READBACK_AFTER_INSERT = os.getenv('CALENDAR_READBACK_AFTER_INSERT', 'false').lower() == 'true'
 
 # === NEW TIMEZONE STRATEGY ===
 # Timezone for user interaction, AI interpretation, and display
@@ -58,6 +81,9 @@ TIMEZONE = EVENT_STORAGE_TIMEZONE # This is now New York
 OPERATIONAL_START_HOUR_DUBAI = 20 # 8 PM
 OPERATIONAL_END_HOUR_DUBAI = 8    # 8 AM
 DUBAI_TIMEZONE = pytz.timezone('Asia/Dubai') # This is the same as TARGET_DISPLAY_TIMEZONE, defined for clarity here
+# Hours (Dubai time) in which alternative appointment slots are offered; default to the operational hours.
+APPOINTMENT_START_HOUR_DUBAI = int(os.getenv('APPOINTMENT_START_HOUR_DUBAI', OPERATIONAL_START_HOUR_DUBAI))
+APPOINTMENT_END_HOUR_DUBAI = int(os.getenv('APPOINTMENT_END_HOUR_DUBAI', OPERATIONAL_END_HOUR_DUBAI))
 
 # ─── Load environment and configure AI ─────────────────────────────────────────
 load_dotenv()
@@ -68,9 +94,13 @@ PROPERTY_SHEET_ID   = os.getenv('PROPERTY_SHEET_ID')
 PROPERTY_SHEET_NAME = os.getenv('PROPERTY_SHEET_NAME', 'Properties')
 
 # --- Global Pause Feature ---
-# These variables are in-memory and will be reset if the Flask app restarts or is redeployed.
-is_globally_paused = False
-paused_conversations = set()
+# Pause flags live in the shared state backend (see shared_state.py), so every gunicorn worker
+# honours them and they survive restarts. Lookups are answered from a local cache.
+shared_state = get_shared_state()
+# Each user's latest property matches, so "show me more" pages through them without searching again.
+property_results = property_handler.PropertyResultCursors(shared_state)
+# Upper bound on an outreach campaign's per-sheet lock, in case a worker dies mid-campaign.
+OUTREACH_LOCK_TTL_SECONDS = int(os.getenv('OUTREACH_LOCK_TTL_SECONDS', 6 * 3600))
 
 # ─── Persona loading ───────────────────────────────────────────────────────────
 PERSONA_FILE    = 'persona.json'
@@ -103,16 +133,23 @@ except Exception as e:
     logging.warning(f"Could not load {PERSONA_FILE} or parse 'name': {e}. Using default name '{PERSONA_NAME}'. System prompt is controlled by script.py's BASE_PROMPT.")
 
 # ─── AI Model and API Client Initialization ────────────────────────────────────
-AI_MODEL = None
-if OPENAI_API_KEY:
-    AI_MODEL = ChatOpenAI(model_name='gpt-4o', openai_api_key=OPENAI_API_KEY, temperature=0)
-else:
-    logging.error("OPENAI_API_KEY not found; AI responses will fail.")
+# Clients are created by background initializers (see "Component Registration" below),
+# so importing this module and booting a gunicorn worker never block on them.
+def init_ai_model():
+    if not OPENAI_API_KEY:
+        logging.error("OPENAI_API_KEY not found; AI responses will fail.")
+        return None
+    # stream_usage reports token counts on streamed answers too (for /metrics)
+    return ChatOpenAI(model_name='gpt-4o', openai_api_key=OPENAI_API_KEY, temperature=0, stream_usage=True)
 
-if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-else:
-    openai_client = None
+def init_openai_client():
+    return OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+
+def get_ai_model():
+    return components.get('ai_model')
+
+def get_openai_client():
+    return components.get('openai_client')
 
 # HTTP_SESSION for WaSender is now managed in whatsapp_utils.py
 # HTTP_SESSION = requests.Session() # Removed
@@ -126,57 +163,28 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # For I/O bound tasks like calling external APIs (which RAG processing might do),
 # a higher number of workers might be beneficial. Let's start with 2.
 executor = ThreadPoolExecutor(max_workers=2)
-
-# ─── Google Calendar Setup ─────────────────────────────────────────────────────
-def get_calendar_service():
-    """Get Google Calendar service object using service account credentials."""
-    try:
-        credentials_json = os.getenv('GOOGLE_CALENDAR_CREDENTIALS')
-        if not credentials_json:
-            logging.error("GOOGLE_CALENDAR_CREDENTIALS environment variable not found")
-            return None
-
-        credentials_info = json.loads(credentials_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info,
-            scopes=SCOPES
-        )
-        service = build('calendar', 'v3', credentials=credentials)
-        return service
-
-    except Exception as e:
-        logging.error(f"Error initializing calendar service: {e}")
-        return None
+register_queue_depth('background_tasks', lambda: executor._work_queue.qsize())
+register_queue_depth('summary_updates', lambda: summary_executor._work_queue.qsize())
 
 # ─── Appointment Intent Detection and Extraction ───────────────────────────────
 def detect_scheduling_intent(message):
-    """Detect if the message contains scheduling intent."""
-    scheduling_keywords = [
-        'appointment', 'schedule', 'book', 'booking', 'meeting', 'consultation',
-        'reserve', 'reservation', 'visit', 'session', 'call', 'meet'
-    ]
-
-    time_indicators = [
-        'today', 'tomorrow', 'next week', 'monday', 'tuesday', 'wednesday', 'thursday',
-        'friday', 'saturday', 'sunday', 'am', 'pm', 'morning', 'afternoon', 'evening',
-        'at', 'on', 'o\'clock', ':', 'time'
-    ]
-
-    message_lower = message.lower()
-
-    has_scheduling_keyword = any(keyword in message_lower for keyword in scheduling_keywords)
-    has_time_indicator = any(indicator in message_lower for indicator in time_indicators)
-
-    date_patterns = [
-        r'\d{1,2}[/-]\d{1,2}',
-        r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}',
-        r'\b\d{1,2}(st|nd|rd|th)\b',
-    ]
-
-    has_date_pattern = any(re.search(pattern, message_lower) for pattern in date_patterns)
-    return has_scheduling_keyword or (has_time_indicator and has_date_pattern)
+    """Detect if the message contains scheduling intent (a scheduling word, or both a time and a date)."""
+    return route_message(message)['intent'] == INTENT_SCHEDULING
 
 # === DATETIME EXTRACTION FUNCTION (extract_datetime_with_ai) ===
+DATETIME_SCHEMA = {
+    'type': 'object',
+    'required': ['has_datetime'],
+    'properties': {
+        'has_datetime': {'type': 'boolean'},
+        'date': {'type': ['string', 'null'], 'pattern': r'^\d{4}-\d{2}-\d{2}$', 'default': None},
+        'time': {'type': ['string', 'null'], 'pattern': r'^\d{1,2}:\d{2}$', 'default': None},
+        'duration_minutes': {'type': 'integer', 'minimum': 1, 'default': 60},
+        'service_type': {'type': 'string', 'default': 'General Consultation'},
+        'confidence': {'type': 'number', 'minimum': 0, 'maximum': 1, 'default': 0.5},
+    },
+}
+
 def extract_datetime_with_ai(message):
     """Use AI to extract and normalize datetime information from natural language, assuming Dubai time."""
     current_display_time = datetime.now(TARGET_DISPLAY_TIMEZONE) 
@@ -208,29 +216,25 @@ def extract_datetime_with_ai(message):
     """
 
     try:
-        if not AI_MODEL:
+        ai_model = get_ai_model()
+        if not ai_model:
             logging.error("AI_MODEL not initialized in extract_datetime_with_ai")
             return None
 
-        response = AI_MODEL.invoke(extraction_prompt)
-        response_text = response.content.strip()
-
-        if '```json' in response_text:
-            response_text = response_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in response_text:
-            response_text = response_text.split('```')[1].split('```')[0].strip()
-
-        result = json.loads(response_text)
+        result = invoke_structured(ai_model, extraction_prompt, DATETIME_SCHEMA, 'datetime_extraction', stage='llm_datetime_extraction')
         logging.info(f"AI extracted datetime (interpreted as Dubai time): {result}")
         return result
 
     except Exception as e:
         logging.error(f"Error extracting datetime with AI: {e}")
         return None
+
+# Scheduling messages are parsed locally first (rules, then dateparser); only low-confidence ones reach the LLM.
+datetime_extractor = DateTimeExtractor(extract_datetime_with_ai, TARGET_DISPLAY_TIMEZONE)
 # === END OF DATETIME EXTRACTION FUNCTION ===
 
 # === CALENDAR EVENT CREATION FUNCTION (create_calendar_event) ===
-def create_calendar_event(gcal_service, title, start_datetime_naive_event_tz, end_datetime_naive_event_tz, description="", attendee_email=None):
+def create_calendar_event(calendar_client, title, start_datetime_naive_event_tz, end_datetime_naive_event_tz, description="", attendee_email=None):
     """
     Create a Google Calendar event.
     Receives naive datetimes assumed to be in EVENT_STORAGE_TIMEZONE (e.g., New York).
@@ -238,7 +242,7 @@ def create_calendar_event(gcal_service, title, start_datetime_naive_event_tz, en
     """
     logging.info("CALENDAR_DEBUG: create_calendar_event called with title: %s, start_naive_event_tz: %s", title, start_datetime_naive_event_tz)
     try:
-        if gcal_service is None:
+        if calendar_client is None:
             logging.error("Google Calendar service is not initialized. Cannot create event.")
             return None
 
@@ -280,26 +284,32 @@ def create_calendar_event(gcal_service, title, start_datetime_naive_event_tz, en
         if attendee_email:
             event_body['attendees'] = [{'email': attendee_email}]
 
-        logging.info(f"Creating calendar event with payload: {json.dumps(event_body, indent=2)}")
-        # Assuming 'mohomer12@gmail.com' is the target calendar ID
-        created_event_response = gcal_service.events().insert(calendarId='mohomer12@gmail.com', body=event_body).execute()
+        logging.debug(f"Creating calendar event with payload: {json.dumps(event_body, indent=2)}")
+        created_event_response = calendar_client.insert_event(event_body)
         
         if created_event_response and created_event_response.get('id'):
             logging.info(f"CALENDAR_DEBUG: Event insertion successful. Event ID: {created_event_response.get('id')}, HTML Link: {created_event_response.get('htmlLink')}")
         else:
             logging.error(f"CALENDAR_DEBUG: Event insertion FAILED or returned unexpected response. Response: {created_event_response}")
 
-        logging.info(f"Event supposedly created. Raw Google API response: {json.dumps(created_event_response, indent=2)}")
+        logging.debug(f"Event supposedly created. Raw Google API response: {json.dumps(created_event_response, indent=2)}")
+
+        calendar_cache = components.peek('calendar_cache')
+        if calendar_cache and created_event_response and created_event_response.get('id'):
+            calendar_cache.add_event(created_event_response)
+
+        if not CALENDAR_READBACK_AFTER_INSERT:
+            return created_event_response
 
         if created_event_response and created_event_response.get('id'):
             event_id_to_check = created_event_response.get('id')
-            logging.info(f"DIAGNOSTIC: Attempting to retrieve event with ID '{event_id_to_check}' from calendar 'mohomer12@gmail.com' immediately.")
+            logging.info(f"DIAGNOSTIC: Attempting to retrieve event with ID '{event_id_to_check}' from calendar '{GOOGLE_CALENDAR_ID}' immediately.")
             try:
-                retrieved_event_check = gcal_service.events().get(calendarId='mohomer12@gmail.com', eventId=event_id_to_check).execute()
+                retrieved_event_check = calendar_client.get_event(event_id_to_check)
                 logging.info(f"DIAGNOSTIC SUCCESS: Successfully retrieved event by ID. Summary: '{retrieved_event_check.get('summary')}', Link: '{retrieved_event_check.get('htmlLink')}'")
-                logging.info(f"DIAGNOSTIC SUCCESS: Retrieved event details: {json.dumps(retrieved_event_check, indent=2)}")
+                logging.debug(f"DIAGNOSTIC SUCCESS: Retrieved event details: {json.dumps(retrieved_event_check, indent=2)}")
             except Exception as e_get:
-                logging.error(f"DIAGNOSTIC CRITICAL: FAILED to retrieve event by ID '{event_id_to_check}' from calendar 'mohomer12@gmail.com' immediately after creation. Error: {e_get}")
+                logging.error(f"DIAGNOSTIC CRITICAL: FAILED to retrieve event by ID '{event_id_to_check}' from calendar '{GOOGLE_CALENDAR_ID}' immediately after creation. Error: {e_get}")
         else:
             logging.warning("DIAGNOSTIC: Created event object is missing or does not have an ID. Cannot attempt to retrieve by ID.")
 
@@ -311,14 +321,15 @@ def create_calendar_event(gcal_service, title, start_datetime_naive_event_tz, en
 # === END OF CALENDAR EVENT CREATION FUNCTION ===
 
 # === CALENDAR AVAILABILITY CHECK FUNCTION (check_availability) ===
-def check_availability(gcal_service, start_datetime_naive_event_tz, end_datetime_naive_event_tz):
+def check_availability(calendar_client, start_datetime_naive_event_tz, end_datetime_naive_event_tz):
     """
     Check if the requested time slot is available.
     Receives naive datetimes assumed to be in EVENT_STORAGE_TIMEZONE (e.g., New York).
-    Localizes them, then converts to UTC for the API call.
+    Localizes them, then converts to UTC. Answered from the free/busy cache when it is
+    fresh, otherwise with an API call.
     """
     try:
-        if gcal_service is None:
+        if calendar_client is None:
             logging.error("Google Calendar service is not initialized. Cannot check availability.")
             return False # Assume not available if service is down
 
@@ -335,16 +346,21 @@ def check_availability(gcal_service, start_datetime_naive_event_tz, end_datetime
         start_utc = start_datetime_event_tz_aware.astimezone(pytz.UTC)
         end_utc = end_datetime_event_tz_aware.astimezone(pytz.UTC)
 
+        calendar_cache = components.peek('calendar_cache')
+        is_free = calendar_cache.is_free(start_utc, end_utc) if calendar_cache else None
+        if is_free is not None:
+            logging.info(f"Availability from free/busy cache for {start_utc.isoformat()} to {end_utc.isoformat()}: {'free' if is_free else 'busy'}")
+            return is_free
+
         logging.info(f"Checking availability - {TIMEZONE.zone} times: {start_datetime_event_tz_aware} to {end_datetime_event_tz_aware}")
         logging.info(f"Checking availability - UTC times for API: {start_utc.isoformat()} to {end_utc.isoformat()}")
 
-        events_result = gcal_service.events().list(
-            calendarId='mohomer12@gmail.com', # Assuming 'mohomer12@gmail.com'
+        events_result = calendar_client.list_events(
             timeMin=start_utc.isoformat(),
             timeMax=end_utc.isoformat(),
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
+        )
 
         events = events_result.get('items', [])
         logging.info(f"Found {len(events)} existing events in the time slot (checked using {TIMEZONE.zone} converted to UTC)")
@@ -353,113 +369,178 @@ def check_availability(gcal_service, start_datetime_naive_event_tz, end_datetime
     except Exception as e:
         logging.error(f"Error checking availability: {e}", exc_info=True)
         return False
-# === END OF CALENDAR AVAILABILITY CHECK FUNCTION ===
 
-# ─── Data Ingestion Function ───────────────────────────────────────────────────
-def scan_company_data_folder(vector_store: object, embeddings: object):
-    logging.info(f"Starting scan of company data folder: {COMPANY_DATA_FOLDER}")
-    if not vector_store or not embeddings:
-        logging.error("scan_company_data_folder: Vector store or embeddings not initialized. Aborting scan.")
-        return
-    if not os.path.exists(COMPANY_DATA_FOLDER) or not os.path.isdir(COMPANY_DATA_FOLDER):
-        logging.error(f"scan_company_data_folder: Company data folder '{COMPANY_DATA_FOLDER}' not found or is not a directory. Aborting scan.")
-        return
-    processed_log = get_processed_files_log()
-    current_file_paths_in_folder = []
+def confirm_slot_still_free(calendar_client, start_datetime_naive_event_tz, end_datetime_naive_event_tz):
+    """
+    Final conflict check right before inserting. With the free/busy cache, pulls the latest calendar
+    changes and checks locally; without it, check_availability has just queried the API, so no
+    further call is made.
+    """
+    calendar_cache = components.peek('calendar_cache')
+    if not calendar_cache:
+        return True
+    start_utc = TIMEZONE.localize(start_datetime_naive_event_tz).astimezone(pytz.UTC)
+    end_utc = TIMEZONE.localize(end_datetime_naive_event_tz).astimezone(pytz.UTC)
     try:
-        for filename in os.listdir(COMPANY_DATA_FOLDER):
-            full_path = os.path.join(COMPANY_DATA_FOLDER, filename)
-            if os.path.isfile(full_path):
-                if filename.endswith(('.txt', '.pdf')) and not filename.startswith('.'):
-                    current_file_paths_in_folder.append(full_path)
-                elif not filename.startswith('.'):
-                    logging.debug(f"scan_company_data_folder: Skipping unsupported file type or hidden file: {filename}")
+        return calendar_cache.confirm_free(start_utc, end_utc)
     except Exception as e:
-        logging.error(f"scan_company_data_folder: Error listing files in {COMPANY_DATA_FOLDER}: {e}", exc_info=True)
-        return
-    for file_path in current_file_paths_in_folder:
-        try:
-            file_mtime = os.path.getmtime(file_path)
-            file_info = processed_log.get(file_path)
-            if file_info and file_info.get('mtime') == file_mtime and file_info.get('status') == 'processed':
-                logging.debug(f"scan_company_data_folder: File '{file_path}' is unchanged and already processed. Skipping.")
-                continue
-            logging.info(f"scan_company_data_folder: Processing new or modified file: {file_path}")
-            process_document(file_path, vector_store, embeddings)
-        except FileNotFoundError:
-            logging.warning(f"scan_company_data_folder: File '{file_path}' found during scan but disappeared before processing. Skipping.")
-        except Exception as e:
-            logging.error(f"scan_company_data_folder: Error processing file '{file_path}': {e}", exc_info=True)
-    logged_file_paths = list(processed_log.keys())
-    for file_path in logged_file_paths:
-        if file_path.startswith(os.path.abspath(COMPANY_DATA_FOLDER) + os.sep):
-            if file_path not in current_file_paths_in_folder and processed_log.get(file_path, {}).get('status') == 'processed':
-                logging.info(f"scan_company_data_folder: File '{file_path}' appears to be removed from source folder.")
-                remove_document_from_store(file_path, vector_store)
-        elif file_path.startswith(COMPANY_DATA_FOLDER + os.sep): # Handle relative paths if stored that way
-             if file_path not in current_file_paths_in_folder and processed_log.get(file_path, {}).get('status') == 'processed':
-                logging.info(f"scan_company_data_folder: File '{file_path}' (relative) appears to be removed from source folder.")
-                remove_document_from_store(file_path, vector_store) # Assumes remove_document_from_store can handle relative path
-    logging.info(f"Scan of company data folder: {COMPANY_DATA_FOLDER} complete.")
+        logging.error(f"Calendar sync failed during the final conflict check; querying the API instead: {e}")
+        calendar_cache.synced_at = None # Not trustworthy until the next successful sync
+        return check_availability(calendar_client, start_datetime_naive_event_tz, end_datetime_naive_event_tz)
 
-# ─── RAG Initialization ────────────────────────────────────────────────────────
-logging.info("Initializing RAG components...")
-OPENAI_API_KEY_RAG = os.getenv('OPENAI_API_KEY_RAG', os.getenv('OPENAI_API_KEY'))
-embeddings_rag = None
-vector_store_rag = None
-if OPENAI_API_KEY_RAG:
+def get_busy_intervals(calendar_client, window_start, window_end):
+    """
+    Busy (start, end) UTC datetimes overlapping a window (aware datetimes): from the free/busy cache when it is fresh, otherwise
+    from a single events().list call covering the whole window.
+    """
+    calendar_cache = components.peek('calendar_cache')
+    if calendar_cache and calendar_cache.is_fresh():
+        return calendar_cache.busy_between(window_start, window_end)
+    events_result = calendar_client.list_events(
+        timeMin=window_start.isoformat(),
+        timeMax=window_end.isoformat(),
+        singleEvents=True,
+        maxResults=2500
+    )
+    calendar_timezone = pytz.timezone(events_result.get('timeZone', 'UTC'))
+    busy = []
+    for item in events_result.get('items', []):
+        bounds = event_bounds(item, calendar_timezone)
+        if bounds:
+            busy.append(tuple(datetime.fromtimestamp(t, pytz.UTC) for t in bounds))
+    return busy
+
+def suggest_alternative_slots(calendar_client, requested_start_dubai, duration_minutes):
+    """
+    The nearest free slots to a taken request (aware, Dubai time), within appointment hours.
+    Returns an empty list if they cannot be computed.
+    """
+    search_window = timedelta(days=SLOT_SEARCH_DAYS, minutes=duration_minutes)
     try:
-        embeddings_rag = OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY_RAG)
-        vector_store_rag = initialize_vector_store()
-        if 'app' in globals() and app: # Check if Flask app context exists
-            app.config['EMBEDDINGS'] = embeddings_rag
-            app.config['VECTOR_STORE'] = vector_store_rag
-        else:
-            logging.warning("Flask app context not available during RAG init. Storing embeddings/vector_store globally for now.")
-        if vector_store_rag and embeddings_rag:
-            logging.info("RAG components initialized successfully.")
-            scan_company_data_folder(vector_store_rag, embeddings_rag)
-        else:
-            logging.error("Failed to initialize RAG components (vector_store or embeddings). RAG functionality might be impaired.")
-            if 'app' in globals() and app:
-                app.config['EMBEDDINGS'] = None
-                app.config['VECTOR_STORE'] = None
+        busy = get_busy_intervals(calendar_client, requested_start_dubai - search_window, requested_start_dubai + search_window)
+        with timed('slot_search'):
+            return find_alternative_slots(requested_start_dubai, duration_minutes, busy, APPOINTMENT_START_HOUR_DUBAI, APPOINTMENT_END_HOUR_DUBAI)
     except Exception as e:
-        logging.error(f"Error initializing RAG components: {e}", exc_info=True)
-        if 'app' in globals() and app:
-            app.config['EMBEDDINGS'] = None
-            app.config['VECTOR_STORE'] = None
-else:
-    logging.error("OPENAI_API_KEY_RAG (or OPENAI_API_KEY) not found; RAG functionality will be disabled.")
-    if 'app' in globals() and app:
-        app.config['EMBEDDINGS'] = None
-        app.config['VECTOR_STORE'] = None
+        logging.error(f"Error finding alternative appointment slots: {e}", exc_info=True)
+        return []
+# === END OF CALENDAR AVAILABILITY CHECK FUNCTION ===
+
+# ─── RAG Initialization ────────────────────────────────────────────────────────
+OPENAI_API_KEY_RAG = os.getenv('OPENAI_API_KEY_RAG', os.getenv('OPENAI_API_KEY'))
+app.config['EMBEDDINGS'] = None
+app.config['VECTOR_STORE'] = None
+
+def init_embeddings():
+    if not OPENAI_API_KEY_RAG:
+        logging.error("OPENAI_API_KEY_RAG (or OPENAI_API_KEY) not found; RAG functionality will be disabled.")
+        return None
+    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY_RAG)
+    app.config['EMBEDDINGS'] = embeddings
+    return embeddings
+
+def init_vector_store():
+    """
+    The store queries run against: a SharedIndexReader over the published snapshots in
+    RAG_SHARED_INDEX mode, otherwise this worker's own writable store.
+    """
+    if not components.peek('embeddings'):
+        logging.error("Embeddings unavailable; RAG functionality will be disabled.")
+        return None
+    vector_store = initialize_shared_vector_store() if RAG_SHARED_INDEX else initialize_vector_store()
+    if not vector_store:
+        logging.error("Failed to initialize RAG vector store. RAG functionality might be impaired.")
+        return None
+    if not RAG_SHARED_INDEX:
+        app.config['VECTOR_STORE'] = vector_store
+    logging.info("RAG components initialized successfully.")
+    return vector_store
+
+def init_company_data_scan():
+    embeddings = components.peek('embeddings')
+    if not components.peek('vector_store') or not embeddings:
+        return None
+    changes = find_company_data_changes()
+    if changes is None:
+        return None
+    if not any(changes):
+        logging.info(f"Company data folder {COMPANY_DATA_FOLDER} is unchanged; no indexing needed.")
+        return True
+    scan_company_data_folder(get_writable_vector_store(timeout=600), embeddings, changes)
+    return True
+
+def get_vector_store():
+    vector_store = components.get('vector_store')
+    if isinstance(vector_store, SharedIndexReader):
+        return vector_store.current()
+    return vector_store
+
+def get_writable_vector_store(timeout=None):
+    """
+    The store that document updates are applied to (RAG_INDEXER_MODE=inline, so never a shared snapshot).
+    """
+    return components.get('vector_store', timeout=timeout)
 
 # ─── Initialize Google Calendar Service ────────────────────────────────────────
-CALENDAR_SERVICE = get_calendar_service()
-if CALENDAR_SERVICE:
-    logging.info("CALENDAR_CREDENTIAL_VERIFICATION: Google Calendar service initialized successfully using provided credentials.")
-else:
-    logging.error("CALENDAR_CREDENTIAL_VERIFICATION: FAILED to initialize Google Calendar service. Check credentials and API permissions.")
+def init_calendar_service():
+    # A pooled client rather than a single service: bookings, availability checks and the cache
+    # sync can run on different threads at once.
+    calendar_client = get_calendar_client()
+    if calendar_client:
+        logging.info("CALENDAR_CREDENTIAL_VERIFICATION: Google Calendar service initialized successfully using provided credentials.")
+    else:
+        logging.error("CALENDAR_CREDENTIAL_VERIFICATION: FAILED to initialize Google Calendar service. Check credentials and API permissions.")
+        logging.warning("Google Calendar service could not be initialized. Appointment scheduling will be disabled.")
+    return calendar_client
 
-if CALENDAR_SERVICE:
-    logging.info("Google Calendar service initialized successfully.")
+def get_calendar_service_component():
+    return components.get('calendar_service')
+
+def init_calendar_cache():
+    calendar_client = get_calendar_service_component()
+    if not CALENDAR_FREEBUSY_CACHE or not calendar_client:
+        return None
+    return FreeBusyCache(calendar_client).start()
+
+# ─── Component Registration ────────────────────────────────────────────────────
+# Initializers run in background threads as soon as the module is imported; request handlers
+# wait on the component they need (up to LAZY_INIT_WAIT_SECONDS). The company data scan may
+# embed documents, so it never gates readiness and queries use the store while it runs.
+components.register('ai_model', init_ai_model)
+components.register('openai_client', init_openai_client, required=False)
+components.register('embeddings', init_embeddings)
+components.register('vector_store', init_vector_store, depends_on=('embeddings',))
+if RAG_INDEXER_MODE == 'external' and not RAG_SHARED_INDEX:
+    # Workers would queue jobs but keep serving their own copy of the index, never the indexer's output.
+    logging.critical("RAG_INDEXER_MODE=external requires RAG_SHARED_INDEX=true; refusing to start.")
+    raise RuntimeError("RAG_INDEXER_MODE=external requires RAG_SHARED_INDEX=true.")
+if RAG_SHARED_INDEX and RAG_INDEXER_MODE != 'external':
+    # Each worker would apply updates to its own copy and publish it, dropping the other workers' updates.
+    logging.critical("RAG_SHARED_INDEX=true requires RAG_INDEXER_MODE=external (a single writer); refusing to start.")
+    raise RuntimeError("RAG_SHARED_INDEX=true requires RAG_INDEXER_MODE=external.")
+if RAG_INDEXER_MODE == 'external':
+    # indexer.py owns all writes (including the company data scan); workers only read snapshots.
+    logging.info("RAG_INDEXER_MODE=external: document updates are queued for the indexer process.")
+    register_queue_depth('index_jobs', pending_job_count)
 else:
-    logging.warning("Google Calendar service could not be initialized. Appointment scheduling will be disabled.")
+    components.register('company_data_scan', init_company_data_scan, depends_on=('vector_store',), required=False)
+components.register('calendar_service', init_calendar_service, required=False)
+components.register('calendar_cache', init_calendar_cache, depends_on=('calendar_service',), required=False)
+components.start()
 
 # ─── Email Sending Function for Appointment Requests ──────────────────────────
-def send_appointment_request_email(user_name, user_phone, preferred_datetime_str, service_reason_str):
-    """Sends an email with the collected appointment request details."""
-    sender_email = os.getenv('APPOINTMENT_EMAIL_SENDER')
-    sender_password = os.getenv('APPOINTMENT_EMAIL_PASSWORD')
-    receiver_email = 'mohomer12@gmail.com' 
-    smtp_server = os.getenv('APPOINTMENT_SMTP_SERVER', 'smtp.gmail.com')
-    smtp_port = int(os.getenv('APPOINTMENT_SMTP_PORT', 587))
-
-    if not all([sender_email, sender_password]):
-        logging.error("Sender email or password not configured for APPOINTMENT_EMAIL. Cannot send appointment request email.")
-        return False
+# Where appointment request emails are sent.
+APPOINTMENT_EMAIL_RECEIVER = os.getenv('APPOINTMENT_EMAIL_RECEIVER', 'mohomer12@gmail.com')
+# Most recent history messages (user and assistant) the request details are extracted from.
+APPOINTMENT_EMAIL_CONTEXT_MESSAGES = 10
+# When enabled, a reply carrying [ACTION_SEND_EMAIL_CONFIRMATION] emails the request details to
+# APPOINTMENT_EMAIL_RECEIVER (one extra extraction call per confirmation). Off by default: the token is only stripped.
+APPOINTMENT_EMAIL_CONFIRMATION_ENABLED = os.getenv('APPOINTMENT_EMAIL_CONFIRMATION_ENABLED', 'false').lower() == 'true'
 
+def send_appointment_request_email(user_name, user_phone, preferred_datetime_str, service_reason_str):
+    """
+    Queues an email with the collected appointment request details. Returns True once queued;
+    delivery (with retries) happens on the email dispatcher's thread.
+    """
     subject = f"New Appointment Request via Layla Bot: {user_name}"
     body = (
         f"A new appointment request has been received from Layla (the virtual assistant):\n\n"
@@ -469,29 +550,12 @@ def send_appointment_request_email(user_name, user_phone, preferred_datetime_str
         f"Service/Reason: {service_reason_str}\n\n"
         f"Please follow up with the client to confirm their appointment."
     )
-
-    msg = MIMEText(body, _charset='utf-8') # Ensure UTF-8 for non-English characters
-    msg['Subject'] = subject
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-
-    try:
-        logging.info(f"Attempting to send appointment request email from {sender_email} to {receiver_email} via {smtp_server}:{smtp_port}")
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, receiver_email, msg.as_string())
-        logging.info("Appointment request email sent successfully.")
-        return True
-    except smtplib.SMTPDataError as e_data:
-        logging.error(f"SMTPDataError sending email. This might be related to email content/formatting. Subject: '{subject}'. Body: '{body[:200]}...' Error: {e_data}", exc_info=True)
-        return False
-    except smtplib.SMTPServerDisconnected as e_disconnect:
-        logging.error(f"SMTPServerDisconnected sending email. This could be a network or server issue. Error: {e_disconnect}", exc_info=True)
-        return False
-    except Exception as e:
-        logging.error(f"Generic error sending appointment request email. Subject: '{subject}'. Error: {e}", exc_info=True)
-        return False
+    queued = send_email(subject, body, APPOINTMENT_EMAIL_RECEIVER)
+    if queued:
+        logging.info(f"Appointment request email for {user_phone} queued for {APPOINTMENT_EMAIL_RECEIVER}.")
+    else:
+        logging.error(f"Appointment request email for {user_phone} could not be queued.")
+    return queued
 
 # ─── Conversation history storage ─────────────────────────────────────────────
 CONV_DIR = 'conversations'
@@ -500,8 +564,11 @@ os.makedirs(CONV_DIR, exist_ok=True)
 # Define the maximum number of conversation turns to load.
 # A "turn" consists of one user message and one assistant message.
 # So, MAX_HISTORY_TURNS_TO_LOAD * 2 gives the total number of messages.
-# Set this to your desired value (e.g., 10 as in your main script's MAX_HISTORY_TURNS).
+# Turns older than this are not dropped: they are folded into a rolling per-user summary
+# (see summary_handler.py) in the background when they are evicted on save.
 MAX_HISTORY_TURNS_TO_LOAD = 6
+# Stored history is kept to the same window so nothing sits in the file unseen by the prompt.
+MAX_HISTORY_TURNS_TO_SAVE = MAX_HISTORY_TURNS_TO_LOAD
 
 def load_history(uid):
     path = os.path.join(CONV_DIR, f"{uid}.json")
@@ -570,12 +637,23 @@ def save_history(uid, history):
         logging.error(f"Error saving history for {uid}: {e}")
 
 # ─── Function to Extract Appointment Details for Email using LLM ──────────────
+EMAIL_DETAILS_SCHEMA = {
+    'type': 'object',
+    'required': ['name', 'preferred_datetime', 'service_reason'],
+    'properties': {
+        'name': {'type': ['string', 'null']},
+        'preferred_datetime': {'type': ['string', 'null']},
+        'service_reason': {'type': ['string', 'null']},
+    },
+}
+
 def extract_appointment_details_for_email(conversation_history_str):
     """
     Uses the LLM to extract appointment details (name, preferred time, reason)
     from a snippet of conversation history, which might be in any language.
     """
-    if not AI_MODEL:
+    ai_model = get_ai_model()
+    if not ai_model:
         logging.error("AI_MODEL not initialized in extract_appointment_details_for_email")
         return None
 
@@ -600,25 +678,94 @@ def extract_appointment_details_for_email(conversation_history_str):
         f"Focus on what the user explicitly stated for their appointment request. Look through the entire snippet for the details."
     )
     try:
-        response = AI_MODEL.invoke([HumanMessage(content=extraction_prompt)])
-        response_text = response.content.strip()
-
-        # Clean potential markdown code block fences
-        if response_text.startswith('```json'):
-            response_text = response_text[len('```json'):].strip()
-        if response_text.endswith('```'):
-            response_text = response_text[:-len('```')].strip()
-        
-        logging.info(f"LLM extracted for email: {response_text}")
-        details = json.loads(response_text)
+        details = invoke_structured(ai_model, extraction_prompt, EMAIL_DETAILS_SCHEMA, 'email_extraction', stage='llm_email_extraction')
+        logging.info(f"LLM extracted for email: {details}")
         return details
     except Exception as e:
         logging.error(f"Error extracting appointment details for email with AI: {e}", exc_info=True)
         return None
 
+def notify_appointment_request(sender, history):
+    """
+    Handles [ACTION_SEND_EMAIL_CONFIRMATION] after the reply has been sent: extracts the request
+    details from the recent conversation and queues the email to the team.
+    """
+    try:
+        snippet = "\n".join(
+            f"{'User' if item.get('role') == 'user' else 'Assistant'}: {item['parts'][0]}"
+            for item in history[-APPOINTMENT_EMAIL_CONTEXT_MESSAGES:] if item.get('parts')
+        )
+        details = extract_appointment_details_for_email(snippet) or {}
+        send_appointment_request_email(
+            details.get('name') or "Not provided",
+            sender.split('@')[0],
+            details.get('preferred_datetime') or "Not provided",
+            details.get('service_reason') or "Not provided"
+        )
+    except Exception as e:
+        logging.error(f"Error sending appointment request email for {sender}: {e}", exc_info=True)
+
 # ─── Generate response from LLM with RAG and Scheduling ─────────────────────
-def get_llm_response(text, sender_id, history_dicts=None, retries=3):
-    if not AI_MODEL: 
+# Filters are conformed one by one (conform_filters), so a single odd filter is dropped instead of
+# failing the whole analysis and costing a corrective LLM call.
+FILTER_SCHEMA = {
+    'type': 'object',
+    'required': ['operator', 'value'],
+    'properties': {
+        'operator': {'type': 'string'},
+        'value': {'type': ['number', 'string']},
+    },
+}
+ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'required': ['intent'],
+    'properties': {
+        'intent': {'type': 'string', 'enum': ['property_search', 'general_question']},
+        'filters': {'type': ['object', 'null'], 'default': None},
+    },
+}
+# Operator spellings the model uses, mapped to filter_properties' '<' (at most), '>' (at least) and '='.
+FILTER_OPERATORS = {
+    '<': '<', '<=': '<', '=<': '<', 'lt': '<', 'lte': '<', 'max': '<', 'under': '<', 'below': '<', 'less than': '<',
+    '>': '>', '>=': '>', '=>': '>', 'gt': '>', 'gte': '>', 'min': '>', 'over': '>', 'above': '>', 'more than': '>',
+    '=': '=', '==': '=', 'eq': '=', 'is': '=', 'equals': '=', 'contains': '=', 'like': '=', 'in': '=',
+}
+
+def conform_filters(filters):
+    """
+    Checks each analysis filter against FILTER_SCHEMA on its own and maps its operator through
+    FILTER_OPERATORS. Numeric columns get a number value. A filter that does not fit is dropped, as is
+    an unknown operator on a numeric column; text columns ignore the operator, so there it becomes '='.
+    """
+    if not isinstance(filters, dict):
+        return None
+    conformed = {}
+    for key, details in filters.items():
+        try:
+            details = conform(details, FILTER_SCHEMA, f"$.filters.{key}")
+            if key in property_handler.NUMERIC_FILTER_COLUMNS: # "2,000,000" -> 2000000.0
+                details['value'] = conform(details['value'], {'type': 'number'}, f"$.filters.{key}.value")
+        except StructuredOutputError as e:
+            logging.warning(f"Dropping query filter: {e}")
+            count_event('analysis_filter_dropped')
+            continue
+        operator = FILTER_OPERATORS.get(details['operator'].strip().lower())
+        if operator is None and key in property_handler.NUMERIC_FILTER_COLUMNS:
+            logging.warning(f"Dropping query filter on '{key}' with unknown operator {details['operator']!r}.")
+            count_event('analysis_filter_dropped')
+            continue
+        conformed[key] = {**details, 'operator': operator or '='}
+    return conformed
+
+# Messages the keyword pre-router classifies as scheduling or small talk skip the LLM query analysis
+# (they carry no property filters); small talk also skips retrieval.
+INTENT_ROUTER_SKIP_ANALYSIS = os.getenv('INTENT_ROUTER_SKIP_ANALYSIS', 'true').lower() == 'true'
+
+# Transient API errors are already retried inside the OpenAI client, so this loop mainly covers
+# empty or token-only answers.
+def get_llm_response(text, sender_id, history_dicts=None, retries=2, conversation_summary=None, on_chunk=None, routed_intent=None):
+    ai_model = get_ai_model()
+    if not ai_model: 
         return {'type': 'text', 'content': "AI Model not configured."}
 
     # --- Step 1: Intent and Filter Extraction ---
@@ -660,61 +807,59 @@ def get_llm_response(text, sender_id, history_dicts=None, retries=3):
     Respond with ONLY the JSON object.
     """
 
-    try:
-        analysis_response = AI_MODEL.invoke([HumanMessage(content=analysis_prompt)])
-        response_text = analysis_response.content.strip()
-        if response_text.startswith('```json'):
-            response_text = response_text[len('```json'):].strip()
-        if response_text.endswith('```'):
-            response_text = response_text[:-len('```')].strip()
-
-        analysis_json = json.loads(response_text)
-        intent = analysis_json.get("intent")
-        filters = analysis_json.get("filters")
-        logging.info(f"Query analysis complete. Intent: '{intent}', Filters: {filters}")
-    except Exception as e:
-        logging.error(f"Failed to analyze user query with LLM: {e}. Defaulting to general question.")
-        intent = "general_question"
-        filters = None
+    # A "show me more" follow-up pages through the previous search's cached matches instead.
+    paged_context = property_results.next_page(sender_id) if property_handler.is_more_request(text) else None
+    if paged_context is not None:
+        intent, filters = "property_more", None
+    elif INTENT_ROUTER_SKIP_ANALYSIS and routed_intent in (INTENT_SCHEDULING, INTENT_SMALLTALK):
+        intent, filters = routed_intent, None
+        logging.info(f"Query pre-routed as '{intent}'; skipping LLM query analysis.")
+    else:
+        try:
+            analysis_json = invoke_structured(ai_model, analysis_prompt, ANALYSIS_SCHEMA, 'analysis', stage='llm_analysis')
+        except Exception as e:
+            logging.error(f"Failed to analyze user query with LLM: {e}")
+            analysis_json = None
+        if analysis_json:
+            intent = analysis_json["intent"]
+            filters = conform_filters(analysis_json["filters"])
+            logging.info(f"Query analysis complete. Intent: '{intent}', Filters: {filters}")
+        else:
+            logging.error("No usable query analysis. Defaulting to general question.")
+            intent = "general_question"
+            filters = None
 
     # --- Step 2: Execute Logic Based on Intent ---
     context_str = ""
-    if intent == "property_search" and PROPERTY_SHEET_ID:
+    if paged_context is not None:
+        context_str = paged_context
+    elif intent == "property_search" and PROPERTY_SHEET_ID:
         # --- Structured Property Search Logic ---
-        all_properties_df = property_handler.get_sheet_data()
+        with timed('sheets_fetch'):
+            all_properties_df = property_handler.get_sheet_data()
         if not all_properties_df.empty:
-            filtered_df = property_handler.filter_properties(all_properties_df, filters)
+            with timed('property_filter'):
+                filtered_df = property_handler.filter_properties(all_properties_df, filters)
 
             if not filtered_df.empty:
-                context_str = "Relevant Information Found:\n"
-                for _, prop in filtered_df.head(5).iterrows():
-                    prop_details = (
-                        f"Title: {prop['Title']}\n"
-                        f"Location: {prop['area']}, {prop['city']}, {prop['emirate']}\n"
-                        f"Price: {prop['Price_AED']} AED\n"
-                        f"Bedrooms: {prop['Bedrooms']}\n"
-                        f"Description: {prop['Description']}\n"
-                    )
-                    context_str += prop_details
-                    for img_col in ['img1', 'img2', 'img3']:
-                        if prop[img_col] and isinstance(prop[img_col], str) and prop[img_col].startswith('http'):
-                            context_str += f"[ACTION_SEND_IMAGE_VIA_URL]\n{prop[img_col]}\n{prop['Title']}\n"
-                    context_str += "---\n"
+                context_str = property_results.start(sender_id, filtered_df)
             else:
                 context_str = "Relevant Information Found:\nNo properties found matching your specific criteria. I can search again if you adjust your filters."
         else:
              context_str = "Relevant Information Found:\nI was unable to access the property listings. Please try again shortly."
 
+    elif intent == INTENT_SMALLTALK:
+        logging.info("Small talk; no retrieval needed.")
+
     else:
         # --- Fallback to General RAG (Vector Search) Logic ---
         logging.info("Performing general RAG query using vector store.")
-    if 'current_app' in globals() and current_app: 
-        vector_store = current_app.config.get('VECTOR_STORE')
-    else: 
-        vector_store = vector_store_rag
+        vector_store = get_vector_store()
 
         if vector_store:
-            retrieved_docs = query_vector_store(text, vector_store, k=5)
+            # Hybrid (keyword + vector) retrieval; returns at most k deduplicated chunks.
+            with timed('vector_search'):
+                retrieved_docs = query_vector_store(text, vector_store, k=RAG_MAX_CONTEXT_CHUNKS)
             if retrieved_docs:
                 processed_docs_content = [re.sub(r'\*+\s*(.*?)\s*\*+', r'\1', doc.page_content) for doc in retrieved_docs]
                 context_str = "\n\nRelevant Information Found:\n" + "\n".join(processed_docs_content)
@@ -727,6 +872,8 @@ def get_llm_response(text, sender_id, history_dicts=None, retries=3):
     final_prompt_to_llm = context_str + f"\n\nUser Question: {text}" if context_str else text
 
     messages = [SystemMessage(content=BASE_PROMPT)]
+    if conversation_summary:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation with this client (do not ask again for details listed here):\n{conversation_summary}"))
     if history_dicts:
         for item in history_dicts:
             role = item.get('role')
@@ -740,40 +887,30 @@ def get_llm_response(text, sender_id, history_dicts=None, retries=3):
     
     for attempt in range(retries):
         try:
+            if on_chunk and STREAM_LLM_RESPONSES:
+                logging.info(f"Streaming LLM final response generation (Attempt {attempt+1})")
+                with timed('llm_final'):
+                    final_response_data = stream_final_response(messages, on_chunk)
+                if final_response_data:
+                    return final_response_data
+                logging.warning(f"LLM returned an empty or token-only response on attempt {attempt+1}")
+                continue
+
             logging.info(f"Sending to LLM for final response generation (Attempt {attempt+1})")
-            resp = AI_MODEL.invoke(messages)
-            raw_llm_output = resp.content.strip()
-
-            final_response_data = {'type': 'text', 'content': raw_llm_output} # Default to text
-
-            # Check for image action and try to parse
-            if "[ACTION_SEND_IMAGE_VIA_URL]" in raw_llm_output:
-                image_parts = []
-                for line in raw_llm_output.splitlines():
-                    # Collect image related lines only if they are formatted as expected
-                    if line.strip() == "[ACTION_SEND_IMAGE_VIA_URL]" or (image_parts and len(image_parts) < 3):
-                        image_parts.append(line)
-                
-                if len(image_parts) >= 3:
-                    image_url = image_parts[1].strip()
-                    image_caption = image_parts[2].strip()
-                    if image_url.startswith('http'): # Basic validation for URL
-                        final_response_data = {'type': 'image', 'url': image_url, 'caption': image_caption}
-                        # If an image is successfully parsed, we can return it immediately
-                        return final_response_data
-            
-            # If we reach here, it means either no image action was detected or it was malformed.
-            # Now process the raw_llm_output for text, stripping all action tokens.
-            response_text_for_display = raw_llm_output.replace("[ACTION_NOTIFY_UNANSWERED_QUERY]", "").replace("[ACTION_SEND_EMAIL_CONFIRMATION]", "").strip()
-            response_text_for_display = response_text_for_display.replace("[ACTION_SEND_IMAGE_VIA_URL]", "").strip() # Ensure image token is also removed from text output
-            
-            # If after stripping, there's still meaningful text, return it as a text message
-            if response_text_for_display: 
-                return {'type': 'text', 'content': response_text_for_display}
+            with timed('llm_final'):
+                resp = ai_model.invoke(messages)
+            record_llm_usage('final', resp)
+            final_response_data = parse_final_llm_output(resp.content)
+            if final_response_data:
+                return final_response_data
 
             # If nothing was returned (neither image nor text), log a warning
             logging.warning(f"LLM returned an empty or token-only response on attempt {attempt+1}")
         
+        except StreamInterruptedError as e:
+            # Part of the answer already reached the user; retrying would send it twice.
+            logging.error(f"LLM stream failed after {e.partial_response['streamed_chunks']} chunk(s) were delivered: {e}", exc_info=True)
+            return e.partial_response
         except Exception as e:
             logging.warning(f"LLM API error on attempt {attempt+1}/{retries}: {e}")
             if attempt + 1 == retries:
@@ -783,6 +920,140 @@ def get_llm_response(text, sender_id, history_dicts=None, retries=3):
             
     return {'type': 'text', 'content': "I could not generate a response after multiple attempts."}
 
+def parse_final_llm_output(raw_llm_output):
+    """
+    Turns the raw final LLM output into a response dict ({'type': 'image', ...} or
+    {'type': 'text', ...}). Returns None if the output is empty or token-only.
+    """
+    raw_llm_output = (raw_llm_output or "").strip()
+    send_email_confirmation = EMAIL_CONFIRMATION_TOKEN in raw_llm_output
+
+    # Check for image action and try to parse
+    if IMAGE_ACTION_TOKEN in raw_llm_output:
+        image_parts = []
+        for line in raw_llm_output.splitlines():
+            # Collect image related lines only if they are formatted as expected
+            if line.strip() == IMAGE_ACTION_TOKEN or (image_parts and len(image_parts) < 3):
+                image_parts.append(line)
+        
+        if len(image_parts) >= 3:
+            image_url = image_parts[1].strip()
+            image_caption = image_parts[2].strip()
+            if image_url.startswith('http'): # Basic validation for URL
+                return {'type': 'image', 'url': image_url, 'caption': image_caption, 'send_email_confirmation': send_email_confirmation}
+    
+    # If we reach here, it means either no image action was detected or it was malformed.
+    # Now process the raw_llm_output for text, stripping all action tokens.
+    response_text_for_display = raw_llm_output
+    for token in TEXT_ACTION_TOKENS:
+        response_text_for_display = response_text_for_display.replace(token, "")
+    response_text_for_display = response_text_for_display.strip()
+    response_text_for_display = response_text_for_display.replace(IMAGE_ACTION_TOKEN, "").strip() # Ensure image token is also removed from text output
+    
+    # If after stripping, there's still meaningful text, return it as a text message
+    if response_text_for_display: 
+        return {'type': 'text', 'content': response_text_for_display, 'send_email_confirmation': send_email_confirmation}
+    return None
+
+# ─── Streaming final response ─────────────────────────────────────────────────
+# When enabled, the final answer is consumed as a token stream and each WhatsApp
+# chunk is sent as soon as it is final, instead of after the whole answer is generated.
+STREAM_LLM_RESPONSES = os.getenv('STREAM_LLM_RESPONSES', 'true').lower() == 'true'
+
+IMAGE_ACTION_TOKEN = "[ACTION_SEND_IMAGE_VIA_URL]"
+EMAIL_CONFIRMATION_TOKEN = "[ACTION_SEND_EMAIL_CONFIRMATION]"
+TEXT_ACTION_TOKENS = ["[ACTION_NOTIFY_UNANSWERED_QUERY]", EMAIL_CONFIRMATION_TOKEN]
+ALL_ACTION_TOKENS = TEXT_ACTION_TOKENS + [IMAGE_ACTION_TOKEN]
+
+class StreamInterruptedError(Exception):
+    """Raised when the LLM stream fails after some chunks were already delivered."""
+    def __init__(self, message, partial_response):
+        super().__init__(message)
+        self.partial_response = partial_response
+
+def strip_control_tokens(pending_text):
+    """
+    Removes complete text action tokens from streamed text. Returns (safe_text, held_text):
+    held_text is a trailing fragment that could still grow into a control token, so it must
+    not be emitted until more of the stream has arrived.
+    """
+    for token in TEXT_ACTION_TOKENS:
+        pending_text = pending_text.replace(token, "")
+    bracket_pos = pending_text.rfind('[')
+    if bracket_pos != -1:
+        tail = pending_text[bracket_pos:]
+        if any(token.startswith(tail) for token in ALL_ACTION_TOKENS):
+            return pending_text[:bracket_pos], tail
+    return pending_text, ""
+
+def stream_final_response(messages, on_chunk):
+    """
+    Streams the final LLM answer and calls on_chunk(chunk) for each split_message-compatible
+    chunk as soon as it is complete. Control tokens are stripped before anything is emitted;
+    an image action switches to buffering so the image can be parsed from the full output.
+    Returns the same dict shape as parse_final_llm_output plus 'streamed_chunks', or None
+    if nothing was generated.
+    """
+    splitter = StreamingMessageSplitter()
+    raw_parts = []
+    held_text = ""
+    image_mode = False
+    send_failed = False
+    emitted = 0
+
+    def emit(chunks):
+        nonlocal emitted, send_failed
+        for chunk in chunks:
+            if send_failed:
+                return
+            if not on_chunk(chunk):
+                logging.error(f"Failed to send streamed chunk {emitted + 1}. Aborting further sends for this message.")
+                send_failed = True
+                return
+            emitted += 1
+
+    try:
+        for piece in get_ai_model().stream(messages):
+            if getattr(piece, 'usage_metadata', None):
+                record_llm_usage('final', piece)
+            piece_text = piece.content if isinstance(piece.content, str) else ""
+            if not piece_text:
+                continue
+            raw_parts.append(piece_text)
+            if image_mode or send_failed:
+                continue
+            held_text += piece_text
+            if IMAGE_ACTION_TOKEN in held_text:
+                image_mode = True
+                continue
+            safe_text, held_text = strip_control_tokens(held_text)
+            emit(splitter.feed(safe_text))
+    except Exception as e:
+        if emitted:
+            partial_text = "".join(raw_parts)
+            partial_response = parse_final_llm_output(partial_text) or {'type': 'text', 'content': ""}
+            if partial_response['type'] != 'text':
+                partial_response = {'type': 'text', 'content': partial_text.strip()}
+            partial_response.update(streamed_chunks=emitted, stream_aborted=True)
+            raise StreamInterruptedError(str(e), partial_response) from e
+        raise
+
+    final_response_data = parse_final_llm_output("".join(raw_parts))
+    if not final_response_data:
+        return None
+
+    if final_response_data['type'] == 'text' and not send_failed:
+        if image_mode:
+            # Malformed image action: fall back to the cleaned text, skipping what was already sent.
+            emit(split_message(final_response_data['content'])[emitted:])
+        else:
+            emit(splitter.feed(held_text))
+            emit(splitter.finish())
+
+    final_response_data['streamed_chunks'] = emitted
+    final_response_data['stream_aborted'] = send_failed
+    return final_response_data
+
 # === APPOINTMENT SCHEDULING HANDLER (handle_appointment_scheduling) ===
 # WhatsApp sending functions (send_whatsapp_message, send_whatsapp_image_message)
 # have been moved to whatsapp_utils.py
@@ -793,10 +1064,11 @@ def handle_appointment_scheduling(message):
     """Handle appointment scheduling requests. Interprets user input as Dubai time,
     stores events in New York time, and confirms to user in Dubai time."""
     
-    if not CALENDAR_SERVICE: 
+    calendar_client = get_calendar_service_component()
+    if not calendar_client: 
         return "Sorry, appointment scheduling is currently unavailable. Please contact us directly to book your appointment."
 
-    datetime_info = extract_datetime_with_ai(message) 
+    datetime_info = datetime_extractor.extract(message)
 
     if not datetime_info or not datetime_info.get('has_datetime'):
         return (
@@ -844,7 +1116,16 @@ def handle_appointment_scheduling(message):
         logging.info(f"Intended Dubai time: {intended_start_dt_dubai_aware.strftime('%Y-%m-%d %H:%M %Z')}")
         logging.info(f"Equivalent Storage ({EVENT_STORAGE_TIMEZONE.zone}) time for GCal: {event_start_dt_storage_tz_aware.strftime('%Y-%m-%d %H:%M %Z')}")
 
-        if not check_availability(CALENDAR_SERVICE, event_start_dt_storage_tz_naive, event_end_dt_storage_tz_naive):
+        if not check_availability(calendar_client, event_start_dt_storage_tz_naive, event_end_dt_storage_tz_naive) \
+                or not confirm_slot_still_free(calendar_client, event_start_dt_storage_tz_naive, event_end_dt_storage_tz_naive):
+            alternatives = suggest_alternative_slots(calendar_client, intended_start_dt_dubai_aware, duration)
+            if alternatives:
+                options = "\n".join(f"• {slot.strftime('%A, %B %d at %I:%M %p')}" for slot in alternatives)
+                return (
+                    f"Unfortunately, {intended_start_dt_dubai_aware.strftime('%A, %B %d at %I:%M %p %Z')} is not available. \n\n"
+                    f"The nearest available times ({TARGET_DISPLAY_TIMEZONE.zone} time) are:\n{options}\n\n"
+                    f"Reply with the one you prefer, for example: \"book {alternatives[0].strftime('%A %B %d at %I:%M %p')}\"."
+                )
             return (
                 f"Unfortunately, {intended_start_dt_dubai_aware.strftime('%A, %B %d at %I:%M %p %Z')} is not available. \n\n"
                 "Could you please suggest another time? I'd be happy to help you find an alternative slot."
@@ -861,7 +1142,7 @@ def handle_appointment_scheduling(message):
         test_attendee_email = None  
 
         created_event_api_response = create_calendar_event(
-            CALENDAR_SERVICE, 
+            calendar_client, 
             event_title,
             event_start_dt_storage_tz_naive,  
             event_end_dt_storage_tz_naive,    
@@ -908,6 +1189,92 @@ def split_message(text, max_lines=2, max_chars=1000):
     if current_chunk_lines: chunks.append('\n'.join(current_chunk_lines))
     return chunks
 
+class StreamingMessageSplitter:
+    """
+    Incremental counterpart of split_message for streamed text. feed() returns chunks as soon
+    as they are final and finish() returns the rest; together they yield the same chunks as
+    split_message(full_text.strip()).
+    """
+    def __init__(self, max_lines=2, max_chars=1000):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self._chunk_lines = []
+        self._chunk_chars = 0
+        self._partial = ""
+        # Completed lines are held until non-whitespace text follows them: until then any of
+        # them could be the (stripped) end of the answer, which changes the chunk boundaries.
+        self._pending_lines = []
+        self._started = False
+        self._flushed_early = False
+
+    def _add_line(self, line):
+        ready = []
+        # Mirrors split_message exactly, including counting the newline for the first line of a
+        # chunk that was started by a flush (also when that flush happened early in feed()).
+        line_len_with_newline = len(line) + (1 if self._chunk_lines or self._flushed_early else 0)
+        self._flushed_early = False
+        if (len(self._chunk_lines) >= self.max_lines or \
+            self._chunk_chars + line_len_with_newline > self.max_chars) and self._chunk_lines:
+            ready.append('\n'.join(self._chunk_lines))
+            self._chunk_lines = []
+            self._chunk_chars = 0
+        self._chunk_lines.append(line)
+        self._chunk_chars += line_len_with_newline
+        return ready
+
+    def feed(self, text):
+        ready = []
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ready
+            self._started = True
+        self._partial += text
+        if '\n' in self._partial:
+            *completed_lines, self._partial = self._partial.split('\n')
+            self._pending_lines.extend(completed_lines)
+        if self._partial.strip():
+            for line in self._pending_lines:
+                ready.extend(self._add_line(line))
+            self._pending_lines = []
+            # The next line has started, so a full chunk (or one the partial line already
+            # overflows) can be sent now rather than when that line completes. Trailing
+            # whitespace is ignored because the last line of the answer gets stripped.
+            partial_len_with_newline = len(self._partial.rstrip()) + (1 if self._chunk_lines or self._flushed_early else 0)
+            if (len(self._chunk_lines) >= self.max_lines or \
+                self._chunk_chars + partial_len_with_newline > self.max_chars) and self._chunk_lines:
+                ready.append('\n'.join(self._chunk_lines))
+                self._chunk_lines = []
+                self._chunk_chars = 0
+                self._flushed_early = True
+        return ready
+
+    def finish(self):
+        ready = []
+        remaining_text = '\n'.join(self._pending_lines + [self._partial]).rstrip()
+        if remaining_text:
+            for line in remaining_text.split('\n'):
+                ready.extend(self._add_line(line))
+        if self._chunk_lines:
+            ready.append('\n'.join(self._chunk_lines))
+        self._chunk_lines, self._chunk_chars, self._partial, self._pending_lines = [], 0, "", []
+        self._flushed_early = False
+        return ready
+
+def make_streamed_chunk_sender(sender):
+    """Returns an on_chunk callback that sends streamed chunks with the usual inter-chunk delay."""
+    sent_count = 0
+    def send_chunk(chunk):
+        nonlocal sent_count
+        if sent_count:
+            # Same delay as the non-streamed path, to help prevent messages from arriving out of order.
+            time.sleep(random.uniform(2.0, 3.0))
+        if not send_whatsapp_message(sender, chunk):
+            return False
+        sent_count += 1
+        return True
+    return send_chunk
+
 # WhatsApp sending functions (send_whatsapp_message, send_whatsapp_image_message)
 # were moved to whatsapp_utils.py and are imported at the top of script.py.
 # The global WASENDER_API_URL, WASENDER_API_TOKEN, and HTTP_SESSION
@@ -918,6 +1285,25 @@ def split_message(text, max_lines=2, max_chars=1000):
 @app.route('/')
 def health_check(): return "OK", 200
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of stage latencies, errors, queue depths, cache hit rates and token usage."""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/ready')
+def readiness_check():
+    """
+    Reports each startup component's status and initialization time.
+    Returns 503 until every required component is ready.
+    """
+    ready = components.is_ready()
+    return jsonify(ready=ready, components=components.status_report()), (200 if ready else 503)
+
+@app.route('/thumbnails/<name>')
+def catalogue_thumbnail(name):
+    """Resized catalogue images written by image_preflight.py, fetched by WaSender when IMAGE_THUMBNAIL_BASE_URL points here."""
+    return send_from_directory(os.path.abspath(IMAGE_THUMBNAIL_DIR), name, mimetype='image/jpeg', max_age=86400)
+
 # Helper function to extract Google Sheet ID from URL or use if already an ID
 def extract_sheet_id_from_url(url_or_id: str) -> str:
     if not url_or_id:
@@ -943,7 +1329,36 @@ def extract_sheet_id_from_url(url_or_id: str) -> str:
 
 
 # ─── Webhook endpoint ─────────────────────────────────────────────────────────
+def run_outreach_campaign_locked(sheet_id, agent_sender_id, app_context, lock_token):
+    """Runs an outreach campaign and releases its per-sheet lock when it ends."""
+    try:
+        with timed('outreach_campaign'):
+            process_outreach_campaign(sheet_id, agent_sender_id, app_context)
+    finally:
+        shared_state.release_lock(f"outreach:{sheet_id}", lock_token)
+
+def paused_response(sender, body):
+    """
+    Returns the webhook response for a message that is ignored because the bot is
+    paused globally or for this conversation, or None if the message should be handled.
+    """
+    if shared_state.is_globally_paused():
+        logging.info(f"Bot is globally paused. Ignoring message from {sender}: {body[:100]}...") # Log a snippet of body
+        count_event('ignored_globally_paused')
+        return jsonify(status='ignored_globally_paused'), 200
+
+    # Ensure 'sender' is used for checking against 'paused_conversations'
+    # 'sender' typically is in the format 'xxxxxxxxxxx@s.whatsapp.net'
+    # 'target_user_id' when added to paused_conversations should match this format or be adapted.
+    # For now, assuming 'sender' is the correct key format for the set.
+    if shared_state.is_conversation_paused(sender):
+        logging.info(f"Conversation with {sender} is paused. Ignoring message: {body[:100]}...") # Log a snippet of body
+        count_event('ignored_conversation_paused')
+        return jsonify(status='ignored_specifically_paused'), 200
+    return None
+
 @app.route('/webhook', methods=['POST'])
+@timed('webhook')
 def webhook():
     try:
         data = request.json or {} 
@@ -983,6 +1398,14 @@ def webhook():
         if messages_payload.get('key', {}).get('fromMe'):
             logging.info("Webhook ignored: message is from me.")
             return jsonify(status='ignored: from me'), 200
+
+        # WaSender may deliver the same message more than once, possibly to different workers.
+        message_id = messages_payload.get('key', {}).get('id')
+        set_trace_message_id(message_id)
+        if message_id and not shared_state.claim_once(f"message:{message_id}"):
+            logging.info(f"Webhook ignored: duplicate delivery of message {message_id}.")
+            count_event('duplicate_delivery')
+            return jsonify(status='ignored: duplicate'), 200
         
         sender = messages_payload.get('key', {}).get('remoteJid')
         message_content_dict = messages_payload.get('message', {})
@@ -1011,7 +1434,8 @@ def webhook():
                 media_info = message_content_dict['imageMessage']
                 # For images, Layla's RAG is expected to find an image and respond with [ACTION_SEND_IMAGE_VIA_URL]
                 # So, we might just set body to a placeholder indicating image received.
-                body = "[User sent an image. Analyzing context...]"
+                caption = media_info.get('caption')
+                body = f"{caption}\n[User sent an image.]" if caption else "[User sent an image. Analyzing context...]"
                 logging.info(f"Received image message from {sender}. Body set for RAG analysis.")
             elif 'videoMessage' in message_content_dict:
                 is_media = True
@@ -1021,59 +1445,76 @@ def webhook():
                 body = "[User sent a video. Analyzing context...]"
                 logging.info(f"Received video message from {sender}. Body set for RAG analysis.")
 
-            if is_media and media_info:
-                media_url = media_info.get('url')
-                media_key_b64 = media_info.get('mediaKey')
+            # Images and videos cannot carry bot commands, so a paused conversation is ignored
+            # before any download or vision call. Voice notes are transcribed first, as they may.
+            if sender and is_media and media_type != "audio":
+                paused = paused_response(sender, body)
+                if paused:
+                    return paused
 
-                if not media_url or not media_key_b64:
+            if is_media and media_info:
+                # Only media whose content is used is downloaded, within size limits, on a bounded pool.
+                # A photo analysed before (same fileSha256) is answered from the cache without a download.
+                image_analysis = None
+                if media_type == "image" and IMAGE_ANALYSIS_ENABLED:
+                    image_analysis = cached_image_analysis(media_info.get('fileSha256'))
+                if media_type == "image" and (image_analysis is not None or not IMAGE_ANALYSIS_ENABLED):
+                    media_status, decrypted_media_content = MEDIA_SKIPPED, None
+                else:
+                    media_status, decrypted_media_content = fetch_media(media_type, media_info)
+                if media_status == MEDIA_SKIPPED:
+                    if image_analysis is not None:
+                        logging.info(f"Image from {sender} was analysed before; using the cached analysis.")
+                    else:
+                        logging.info(f"Not downloading {media_type} from {sender}; its content is not used.")
+                elif media_status == MEDIA_INVALID:
                     logging.error(f"Media message from {sender} is missing URL or mediaKey. MediaInfo: {media_info}")
                     body = "[Media processing error: Missing URL or key]"
-                else:
-                    if media_type in ["audio", "image", "video"]: # Ensure media_type is one of these before decryption
+                elif media_status == MEDIA_TOO_LARGE:
+                    body = f"[{media_type.capitalize()} is too large to process. Please send a smaller file or type your message.]"
+                elif media_status == MEDIA_BUSY:
+                    body = f"[{media_type.capitalize()} received, but media processing is busy right now. Please try again shortly.]"
+                elif media_status != MEDIA_OK:
+                    logging.error(f"Failed to download or decrypt {media_type} from {sender}.")
+                    body = f"[{media_type.capitalize()} processing failed. Please try sending again.]"
+                elif media_type == "image":
+                    listing_matches = match_listing_photos(decrypted_media_content)
+                    ai_model = get_ai_model()
+                    if ai_model:
                         try:
-                            logging.info(f"Attempting to download and decrypt {media_type} from {sender}. URL: {media_url[:50]}...")
-                            decrypted_media_content = download_and_decrypt_media(media_url, media_key_b64, media_type)
-
-                            if decrypted_media_content:
-                                logging.info(f"Successfully decrypted {media_type} from {sender}. Size: {len(decrypted_media_content)} bytes.")
-                                if media_type == "audio":
-                                    if openai_client:
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as tmp_audio_file:
-                                            tmp_audio_file.write(decrypted_media_content)
-                                            tmp_audio_file_path = tmp_audio_file.name
-
-                                        try:
-                                            logging.info(f"Transcribing audio file: {tmp_audio_file_path}")
-                                            transcript = openai_client.audio.transcriptions.create(
-                                                model="whisper-1",
-                                                file=open(tmp_audio_file_path, "rb")
-                                            )
-                                            body = transcript.text
-                                            logging.info(f"Transcription result for {sender}: {body}")
-                                        except Exception as e_transcribe:
-                                            logging.error(f"Whisper API transcription failed for {sender}: {e_transcribe}", exc_info=True)
-                                            body = "[Audio transcription failed. Please try again or type your message.]"
-                                        finally:
-                                            if os.path.exists(tmp_audio_file_path):
-                                                os.remove(tmp_audio_file_path)
-                                    else:
-                                        logging.warning("OpenAI client not initialized. Cannot transcribe audio.")
-                                        body = "[Audio received, but transcription service is unavailable.]"
-                                # For image/video, body is already set to a placeholder for RAG.
-                                # If specific decrypted content handling for image/video (not RAG based) is needed, add here.
-                            else:
-                                logging.error(f"Failed to decrypt {media_type} from {sender}.")
-                                body = f"[{media_type.capitalize()} decryption failed. Please try sending again.]"
-                        except ValueError as ve: # Catch errors from get_decryption_keys for unsupported media types
-                            logging.error(f"Media handling error for {sender} ({media_type}): {ve}")
-                            body = f"[Unsupported media type for decryption: {media_type}]"
-                        except Exception as e_decrypt:
-                            logging.error(f"General error during media download/decryption for {sender} ({media_type}): {e_decrypt}", exc_info=True)
-                            body = f"[{media_type.capitalize()} processing failed. Please try sending again.]"
+                            image_analysis = analyze_image(ai_model, decrypted_media_content, media_info.get('mimetype'), media_info.get('fileSha256'), listing_matches)
+                        except Exception as e_vision:
+                            logging.error(f"Image analysis failed for {sender}: {e_vision}", exc_info=True)
+                elif media_type == "audio":
+                    logging.info(f"Successfully decrypted audio from {sender}. Size: {len(decrypted_media_content)} bytes.")
+                    openai_client = get_openai_client()
+                    if openai_client:
+                        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as tmp_audio_file:
+                            tmp_audio_file.write(decrypted_media_content)
+                            tmp_audio_file_path = tmp_audio_file.name
+
+                        try:
+                            logging.info(f"Transcribing audio file: {tmp_audio_file_path}")
+                            with timed('whisper_transcription'), open(tmp_audio_file_path, "rb") as audio_file:
+                                transcript = openai_client.audio.transcriptions.create(
+                                    model="whisper-1",
+                                    file=audio_file
+                                )
+                            body = transcript.text
+                            logging.info(f"Transcription result for {sender}: {body}")
+                        except Exception as e_transcribe:
+                            logging.error(f"Whisper API transcription failed for {sender}: {e_transcribe}", exc_info=True)
+                            body = "[Audio transcription failed. Please try again or type your message.]"
+                        finally:
+                            if os.path.exists(tmp_audio_file_path):
+                                os.remove(tmp_audio_file_path)
                     else:
-                        # This case should ideally not be reached if media_type is set correctly above.
-                        logging.warning(f"Media message from {sender} has an unexpected media_type '{media_type}'. MediaInfo: {media_info}")
-                        body = "[Received media of an unexpected type.]"
+                        logging.warning("OpenAI client not initialized. Cannot transcribe audio.")
+                        body = "[Audio received, but transcription service is unavailable.]"
+                if image_analysis is not None:
+                    body = describe_image_message(image_analysis, media_info.get('caption'))
+                    logging.info(f"Image from {sender} described as: {body}")
+                # Otherwise image/video keep the placeholder body set above.
             # If 'body' is still None here (e.g. it was not a text message and not a recognized media message),
             # the check below `if not (sender and body)` will catch it.
 
@@ -1084,65 +1525,57 @@ def webhook():
             return jsonify(status='ignored: no sender or final body content'), 200
 
         # --- Bot Control Command Handling ---
-        normalized_body = body.lower().strip()
-        global is_globally_paused # Needed for reassignment
+        # One compiled pass classifies commands, scheduling and obvious property searches.
+        route = route_message(body)
+        command = route.get('command')
 
-        if normalized_body == "bot pause all":
-            is_globally_paused = True
+        if command == 'pause_all':
+            shared_state.pause_all()
             send_whatsapp_message(sender, "Bot is now globally paused.")
             logging.info(f"Bot globally paused by {sender}.")
             return jsonify(status='success_paused_all'), 200
 
-        if normalized_body == "bot resume all":
-            is_globally_paused = False
-            paused_conversations.clear()
+        if command == 'resume_all':
+            shared_state.resume_all()
             send_whatsapp_message(sender, "Bot is now globally resumed. All specific conversation pauses have been cleared.")
             logging.info(f"Bot globally resumed by {sender}. Specific pauses cleared.")
             return jsonify(status='success_resumed_all'), 200
 
-        if normalized_body.startswith("bot pause "):
-            parts = normalized_body.split("bot pause ", 1)
-            if len(parts) > 1 and parts[1].strip():
-                target_user_id = parts[1].strip()
+        if command == 'pause':
+            target_user_id = route['argument']
+            if target_user_id:
                 # Ensure target_user_id is normalized if it's expected to match sender format (e.g. with @s.whatsapp.net)
                 # For now, assuming it's a direct match or an admin will provide the correct format.
-                paused_conversations.add(target_user_id)
+                shared_state.pause_conversation(target_user_id)
                 send_whatsapp_message(sender, f"Bot interactions will be paused for: {target_user_id}")
                 logging.info(f"Bot interactions paused for {target_user_id} by {sender}.")
             else:
                 send_whatsapp_message(sender, "Invalid command format. Use: bot pause <target_user_id>")
-                logging.info(f"Invalid 'bot pause' command from {sender}: {normalized_body}")
+                logging.info(f"Invalid 'bot pause' command from {sender}: {body}")
             return jsonify(status='success_paused_specific_or_error'), 200
 
-        if normalized_body.startswith("bot resume "):
-            parts = normalized_body.split("bot resume ", 1)
-            if len(parts) > 1 and parts[1].strip():
-                target_user_id = parts[1].strip()
-                paused_conversations.discard(target_user_id) # Use discard to avoid error if ID not in set
+        if command == 'resume':
+            target_user_id = route['argument']
+            if target_user_id:
+                shared_state.resume_conversation(target_user_id)
                 send_whatsapp_message(sender, f"Bot interactions will be resumed for: {target_user_id}")
                 logging.info(f"Bot interactions resumed for {target_user_id} by {sender}.")
             else:
                 send_whatsapp_message(sender, "Invalid command format. Use: bot resume <target_user_id>")
-                logging.info(f"Invalid 'bot resume' command from {sender}: {normalized_body}")
+                logging.info(f"Invalid 'bot resume' command from {sender}: {body}")
             return jsonify(status='success_resumed_specific_or_error'), 200
 
         # --- End of Bot Control Command Handling ---
 
         # --- Outreach Command Handling (NEW) ---
-        is_outreach_command = False
+        is_outreach_command = command == 'start_outreach'
         original_sheet_specifier = None # Will store the raw input (URL or ID from command/env)
 
-        if normalized_body == "bot start outreach":
-            original_sheet_specifier = os.getenv('DEFAULT_OUTREACH_SHEET_ID')
-            is_outreach_command = True
-            logging.info(f"Outreach command detected. Attempting to use default Sheet specifier: '{original_sheet_specifier}' (if set).")
-        elif normalized_body.startswith("bot start outreach "):
-            parts = normalized_body.split("bot start outreach ", 1)
-            original_sheet_specifier = parts[1].strip() if len(parts) > 1 and parts[1].strip() else None
-            is_outreach_command = True
-            if not original_sheet_specifier: # Command was "bot start outreach " (with trailing space but no ID)
+        if is_outreach_command:
+            original_sheet_specifier = route['argument']
+            if not original_sheet_specifier:
                 original_sheet_specifier = os.getenv('DEFAULT_OUTREACH_SHEET_ID')
-                logging.info(f"Outreach command with trailing space detected. Attempting to use default Sheet specifier: '{original_sheet_specifier}' (if set).")
+                logging.info(f"Outreach command detected. Attempting to use default Sheet specifier: '{original_sheet_specifier}' (if set).")
             else:
                 logging.info(f"Outreach command detected with specific Sheet specifier: '{original_sheet_specifier}'")
 
@@ -1159,40 +1592,49 @@ def webhook():
                 return jsonify(status='error_invalid_sheet_specifier'), 200
 
             agent_sender_id = sender
+            # One campaign per sheet at a time, across all workers
+            outreach_lock_token = shared_state.acquire_lock(f"outreach:{parsed_sheet_id}", OUTREACH_LOCK_TTL_SECONDS)
+            if not outreach_lock_token:
+                send_whatsapp_message(agent_sender_id, f"An outreach campaign for Sheet ID {parsed_sheet_id} is already running.")
+                logging.info(f"Outreach command from {agent_sender_id} ignored: campaign for Sheet ID {parsed_sheet_id} already running.")
+                return jsonify(status='outreach_campaign_already_running'), 200
+
             # Use parsed_sheet_id in user-facing messages and for processing
             send_whatsapp_message(agent_sender_id, f"Outreach campaign started using Sheet ID: {parsed_sheet_id}. You will be notified upon completion.")
 
             current_app_context = current_app.app_context()
             try:
-                executor.submit(process_outreach_campaign, parsed_sheet_id, agent_sender_id, current_app_context)
+                executor.submit(run_outreach_campaign_locked, parsed_sheet_id, agent_sender_id, current_app_context, outreach_lock_token)
                 logging.info(f"Outreach campaign initiated by {agent_sender_id} for Sheet ID: {parsed_sheet_id} (Original specifier: '{original_sheet_specifier}').")
                 return jsonify(status='outreach_campaign_started'), 200
             except Exception as e_executor:
+                shared_state.release_lock(f"outreach:{parsed_sheet_id}", outreach_lock_token)
                 logging.error(f"Failed to submit outreach campaign to executor for Sheet ID {parsed_sheet_id} (Original specifier: '{original_sheet_specifier}'). Error: {e_executor}", exc_info=True)
                 send_whatsapp_message(agent_sender_id, "Error: Could not start the outreach campaign due to an internal issue.")
                 return jsonify(status='error_starting_outreach_task'), 500
         # --- End of Outreach Command Handling ---
 
         # --- Check for Pause States (Global or Specific Conversation) ---
-        if is_globally_paused:
-            logging.info(f"Bot is globally paused. Ignoring message from {sender}: {body[:100]}...") # Log a snippet of body
-            return jsonify(status='ignored_globally_paused'), 200
-
-        # Ensure 'sender' is used for checking against 'paused_conversations'
-        # 'sender' typically is in the format 'xxxxxxxxxxx@s.whatsapp.net'
-        # 'target_user_id' when added to paused_conversations should match this format or be adapted.
-        # For now, assuming 'sender' is the correct key format for the set.
-        if sender in paused_conversations:
-            logging.info(f"Conversation with {sender} is paused. Ignoring message: {body[:100]}...") # Log a snippet of body
-            return jsonify(status='ignored_specifically_paused'), 200
+        paused = paused_response(sender, body)
+        if paused:
+            return paused
 
         # --- End of Pause State Checks ---
             
         user_id = ''.join(c for c in sender if c.isalnum()) 
         logging.info(f"Incoming from {sender} (UID: {user_id}): {body}")
         
-        history = load_history(user_id)
-        llm_response_data = get_llm_response(body, sender, history)
+        annotate(media_type=media_type or 'text', route=route['intent'] or 'llm')
+        with span('history_load'):
+            history = load_history(user_id)
+            conversation_summary = load_summary(CONV_DIR, user_id)
+        if APPOINTMENT_DIRECT_BOOKING and route['intent'] == INTENT_SCHEDULING:
+            # Availability check, alternative slots and booking without an LLM turn.
+            with span('appointment_booking'):
+                llm_response_data = {'type': 'text', 'content': handle_appointment_scheduling(body)}
+        else:
+            send_streamed_chunk = make_streamed_chunk_sender(sender)
+            llm_response_data = get_llm_response(body, sender, history, conversation_summary=conversation_summary, on_chunk=send_streamed_chunk, routed_intent=route['intent'])
         
         final_model_response_for_history = ""
 
@@ -1200,7 +1642,9 @@ def webhook():
             image_url = llm_response_data['url']
             caption = llm_response_data['caption']
             logging.info(f"Attempting to send image to {sender}. URL: {image_url}, Caption: {caption}")
-            success = send_whatsapp_image_message(sender, caption, image_url)
+            # Known-bad catalogue images go straight to the fallback instead of through WaSender's retries.
+            send_url = get_image_preflight().delivery_url(image_url) if IMAGE_PREFLIGHT_ENABLED else image_url
+            success = bool(send_url) and send_whatsapp_image_message(sender, caption, send_url)
             if success:
                 final_model_response_for_history = f"[Sent Image: {image_url} with caption: {caption}]"
                 logging.info(f"Successfully sent image to {sender}.")
@@ -1209,6 +1653,10 @@ def webhook():
                 logging.error(f"Failed to send image to {sender}. URL: {image_url}")
                 fallback_message = "I tried to send you an image, but it seems there was a problem. Please try again later or ask me something else!"
                 send_whatsapp_message(sender, fallback_message)
+        elif llm_response_data['type'] == 'text' and 'streamed_chunks' in llm_response_data:
+            # Chunks were already delivered while the answer was being generated.
+            final_model_response_for_history = llm_response_data['content']
+            logging.info(f"Streamed {llm_response_data['streamed_chunks']} chunk(s) to {sender}.")
         elif llm_response_data['type'] == 'text':
             text_content = llm_response_data['content']
             final_model_response_for_history = text_content
@@ -1231,11 +1679,18 @@ def webhook():
         history.append(new_history_user)
         history.append(new_history_model)
         
-        MAX_HISTORY_TURNS = 10 
-        if len(history) > MAX_HISTORY_TURNS * 2:
-            history = history[-(MAX_HISTORY_TURNS * 2):] 
+        if len(history) > MAX_HISTORY_TURNS_TO_SAVE * 2:
+            evicted_messages = history[:-(MAX_HISTORY_TURNS_TO_SAVE * 2)]
+            history = history[-(MAX_HISTORY_TURNS_TO_SAVE * 2):]
+            # Summarization runs on its own executor after the reply has been sent.
+            schedule_summary_update(get_ai_model(), CONV_DIR, user_id, evicted_messages)
             
-        save_history(user_id, history)
+        with span('history_save'):
+            save_history(user_id, history)
+
+        if APPOINTMENT_EMAIL_CONFIRMATION_ENABLED and llm_response_data.get('send_email_confirmation'):
+            # The detail extraction is an LLM call; it and the email delivery stay off the reply path.
+            executor.submit(notify_appointment_request, sender, list(history))
         return jsonify(status='success'), 200
 
     except json.JSONDecodeError as je:
@@ -1243,12 +1698,13 @@ def webhook():
         return jsonify(status='error', message='Invalid JSON payload'), 400
     except Exception as e:
         logging.exception(f"FATAL Error in webhook processing: {e}") 
+        record_error('webhook')
         return jsonify(status='error', message='Internal Server Error'), 500
 
 # ─── Background Task Function for Google Document Updates ──────────────────────
 def process_google_document_update(document_id, app_context):
     """
-    Placeholder function for background processing of Google Document updates.
+    Background processing of Google Document updates in RAG_INDEXER_MODE=inline.
     This function will be executed in a separate thread by the ThreadPoolExecutor.
     It fetches content from Google Drive based on MIME type and processes it for RAG.
     """
@@ -1256,44 +1712,15 @@ def process_google_document_update(document_id, app_context):
         try:
             logging.info(f"Background task started for Google Drive document_id: {document_id}")
 
-            # Get RAG components from Flask app config
-            vector_store = current_app.config.get('VECTOR_STORE')
-            embeddings = current_app.config.get('EMBEDDINGS')
+            # Get RAG components; a sync arriving during startup waits for the vector store to load
+            vector_store = get_writable_vector_store(timeout=600)
+            embeddings = components.peek('embeddings')
 
             if not vector_store or not embeddings:
-                logging.critical(f"Background task for {document_id}: VECTOR_STORE or EMBEDDINGS not found in app.config. Aborting RAG update.")
-                return
-
-            # Get MIME type of the Google Drive file
-            mime_type = get_google_drive_file_mime_type(document_id)
-            if mime_type is None:
-                logging.error(f"Background task for {document_id}: Failed to fetch MIME type, or file not found/accessible. Aborting RAG update.")
+                logging.critical(f"Background task for {document_id}: VECTOR_STORE or EMBEDDINGS not available. Aborting RAG update.")
                 return
 
-            text_content = None
-            # Fetch content based on MIME type
-            if mime_type == 'application/vnd.google-apps.document':
-                logging.info(f"Document ID {document_id} is a Google Doc. Fetching content...")
-                text_content = get_google_doc_content(document_id)
-            elif mime_type == 'application/vnd.google-apps.spreadsheet':
-                logging.info(f"Document ID {document_id} is a Google Sheet. Fetching content...")
-                text_content = get_google_sheet_content(document_id)
-            else:
-                logging.warning(f"Unsupported MIME type '{mime_type}' for document ID {document_id}. Skipping RAG processing.")
-                return # Exit if MIME type is not supported
-
-            # Process content if it was successfully fetched
-            if text_content is not None:
-                logging.info(f"Successfully fetched content for {document_id}. Length: {len(text_content)}. Processing for RAG...")
-                success = process_google_document_text(document_id, text_content, vector_store, embeddings)
-                if success:
-                    logging.info(f"Successfully processed and updated RAG store for document ID {document_id}.")
-                else:
-                    logging.error(f"Failed to process document ID {document_id} for RAG store.")
-            else:
-                # This case implies get_google_doc_content or get_google_sheet_content returned None
-                logging.error(f"Failed to fetch content for document ID {document_id} (MIME type: {mime_type}). RAG store not updated.")
-
+            sync_google_document(document_id, vector_store, embeddings)
             logging.info(f"Background task finished for Google Drive document_id: {document_id}")
 
         except Exception as e:
@@ -1330,12 +1757,26 @@ def webhook_google_sync():
         # Authentication successful
         logging.info(f"/webhook-google-sync: Authentication successful for document_id: {document_id}. Queuing background task.")
 
+        if document_id == PROPERTY_SHEET_ID and IMAGE_PREFLIGHT_ENABLED:
+            # Re-check every catalogue image; verdicts are shared with the other workers.
+            executor.submit(refresh_catalogue_preflight)
+
+        if RAG_INDEXER_MODE == 'external':
+            # The indexer process applies the update and publishes a new snapshot.
+            enqueue_job(JOB_GOOGLE_DOCUMENT, {'document_id': document_id}, dedupe_key=f"{JOB_GOOGLE_DOCUMENT}:{document_id}")
+            if document_id == PROPERTY_SHEET_ID:
+                enqueue_job(JOB_IMAGE_INDEX, {}, dedupe_key=JOB_IMAGE_INDEX)
+            return jsonify(status='success', message='Document update task queued.'), 202
+
         # Get the current Flask app context to pass to the background thread
         # This allows the background thread to use current_app, logging, etc.
         current_app_context = current_app.app_context()
 
         # Submit the task to the ThreadPoolExecutor
         executor.submit(process_google_document_update, document_id, current_app_context)
+        if document_id == PROPERTY_SHEET_ID:
+            # Index new catalogue photos; only photos not seen before are downloaded.
+            executor.submit(refresh_image_index)
 
         return jsonify(status='success', message='Document update task queued.'), 202
 
@@ -1345,14 +1786,8 @@ def webhook_google_sync():
 
 
 if __name__ == '__main__':
-    # Ensure RAG components are available in app.config if initialized globally
-    # This helps if the app is run directly (python script.py) vs gunicorn
-    # For gunicorn, initialization before app creation is usually fine.
-    if not app.config.get('VECTOR_STORE') and 'vector_store_rag' in globals() and vector_store_rag:
-        app.config['VECTOR_STORE'] = vector_store_rag
-    if not app.config.get('EMBEDDINGS') and 'embeddings_rag' in globals() and embeddings_rag:
-        app.config['EMBEDDINGS'] = embeddings_rag
-        
+    # RAG components, AI clients and the Calendar service initialize in the background
+    # (see Component Registration); /ready reports when they are available.
     port = int(os.environ.get("PORT", 5001)) # Default to 5001 if not set
     # debug=False is appropriate for production/staging with gunicorn
     # For local testing, you might set debug=True, but be mindful of executor behavior with Flask's reloader.
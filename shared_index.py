@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import threading
+from collections.abc import Mapping, Sequence
+import numpy as np
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+from index_builder import apply_search_params
+
+# --- Configuration ---
+# When enabled, web workers serve queries from read-only, memory-mapped snapshots that a single
+# writer publishes, instead of each loading its own copy of faiss_index/.
+RAG_SHARED_INDEX = os.getenv('RAG_SHARED_INDEX', 'false').lower() == 'true'
+# How often a worker checks the generation file for a newer snapshot.
+RAG_SNAPSHOT_POLL_SECONDS = float(os.getenv('RAG_SNAPSHOT_POLL_SECONDS', 5))
+# Published generations kept on disk (older ones are deleted; workers still mapping them keep working).
+RAG_SNAPSHOT_KEEP = int(os.getenv('RAG_SNAPSHOT_KEEP', 3))
+
+SNAPSHOTS_DIR_NAME = "snapshots"
+CURRENT_FILE_NAME = "CURRENT"
+PUBLISH_LOCK_FILE_NAME = ".publish.lock"
+DOCSTORE_DATA_FILE = "docstore.bin"
+DOCSTORE_OFFSETS_FILE = "docstore.offsets.npy"
+DOCSTORE_IDS_FILE = "docstore.ids.json"
+INDEX_FILE = "index.faiss"
+# The BM25 keyword index (rag_handler.KeywordIndex.to_arrays) as flat arrays over docstore positions.
+KEYWORD_DIR_NAME = "keywords"
+KEYWORD_TERMS_FILE = "terms.bin"
+KEYWORD_ARRAYS = ('term_offsets', 'postings', 'frequencies', 'doc_lengths', 'totals')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Memory-Mapped Docstore ---
+class _MappedDocuments(Mapping):
+    """
+    Read-only doc_id -> Document view over a snapshot's docstore file. Documents are decoded on access,
+    so the page contents stay in the shared page cache rather than in each worker's heap.
+    """
+    def __init__(self, data, offsets, positions: dict):
+        self._data = data
+        self._offsets = offsets
+        self._positions = positions
+
+    def __getitem__(self, doc_id):
+        position = self._positions[doc_id]
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        record = json.loads(bytes(self._data[start:end]).decode('utf-8'))
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+
+class _MappedStrings(Sequence):
+    """
+    Read-only list of strings stored as one UTF-8 blob plus an offsets array, decoded on access.
+    Sorted, it can be searched with bisect without loading it.
+    """
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __getitem__(self, position):
+        return bytes(self._data[int(self._offsets[position]):int(self._offsets[position + 1])]).decode('utf-8')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+def _map_bytes(path: str):
+    return np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else b''
+
+def _map_keyword_arrays(snapshot_dir: str):
+    keyword_dir = os.path.join(snapshot_dir, KEYWORD_DIR_NAME)
+    if not os.path.isdir(keyword_dir):
+        return None # Published before keyword indexes were part of the snapshot
+    arrays = {name: np.load(os.path.join(keyword_dir, f"{name}.npy"), mmap_mode='r') for name in KEYWORD_ARRAYS + ('term_positions',)}
+    arrays['terms'] = _MappedStrings(_map_bytes(os.path.join(keyword_dir, KEYWORD_TERMS_FILE)), arrays.pop('term_positions'))
+    return arrays
+
+
+class MmapDocstore(Docstore):
+    """
+    Docstore backed by a memory-mapped snapshot file. Exposes `_dict` like InMemoryDocstore, plus the
+    snapshot's published keyword index (`keyword_arrays`) and directory, so workers derive nothing
+    from the records themselves.
+
+    Read-only: it is not an AddableMixin and keeps Docstore.delete (NotImplementedError), so LangChain
+    refuses to add to or delete from a snapshot store. Writes go through the index writer, which
+    publishes a new generation.
+    """
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, DOCSTORE_IDS_FILE)) as f:
+            self.ids = json.load(f)
+        offsets = np.load(os.path.join(snapshot_dir, DOCSTORE_OFFSETS_FILE), mmap_mode='r')
+        data = _map_bytes(os.path.join(snapshot_dir, DOCSTORE_DATA_FILE))
+        self._dict = _MappedDocuments(data, offsets, {doc_id: position for position, doc_id in enumerate(self.ids) if doc_id is not None})
+        self.keyword_arrays = _map_keyword_arrays(snapshot_dir)
+
+    def search(self, search: str):
+        if search not in self._dict:
+            return f"ID {search} not found."
+        return self._dict[search]
+
+
+# --- Publishing (single writer) ---
+def _snapshots_dir(store_path: str) -> str:
+    return os.path.join(store_path, SNAPSHOTS_DIR_NAME)
+
+def read_current_generation(store_path: str):
+    """
+    Returns the contents of the generation file ({generation, snapshot, ...}), or None if nothing is published yet.
+    """
+    path = os.path.join(_snapshots_dir(store_path), CURRENT_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        logging.error(f"Error reading snapshot generation file {path}: {e}")
+        return None
+
+def _write_docstore(vector_store: FAISS, snapshot_dir: str):
+    # Records are written in FAISS position order, so position i of the index is record i.
+    ids = [doc_id for _, doc_id in sorted(vector_store.index_to_docstore_id.items())]
+    offsets = [0]
+    with open(os.path.join(snapshot_dir, DOCSTORE_DATA_FILE), 'wb') as f:
+        for doc_id in ids:
+            if doc_id is None: # Tombstone of a deleted chunk (non-removable index); an empty record
+                offsets.append(offsets[-1])
+                continue
+            doc = vector_store.docstore.search(doc_id)
+            record = json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}, ensure_ascii=False, default=str).encode('utf-8')
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(os.path.join(snapshot_dir, DOCSTORE_OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(snapshot_dir, DOCSTORE_IDS_FILE), 'w') as f:
+        json.dump(ids, f)
+    return ids
+
+def _write_keyword_index(keyword_index, ids: list, snapshot_dir: str):
+    arrays = keyword_index.to_arrays(ids)
+    keyword_dir = os.path.join(snapshot_dir, KEYWORD_DIR_NAME)
+    os.makedirs(keyword_dir)
+    term_positions = [0]
+    with open(os.path.join(keyword_dir, KEYWORD_TERMS_FILE), 'wb') as f:
+        for term in arrays.pop('terms'):
+            encoded = term.encode('utf-8')
+            f.write(encoded)
+            term_positions.append(term_positions[-1] + len(encoded))
+    arrays['term_positions'] = np.array(term_positions, dtype=np.int64)
+    for name, array in arrays.items():
+        np.save(os.path.join(keyword_dir, f"{name}.npy"), array)
+
+def _prune_snapshots(snapshots_dir: str, current_generation: int):
+    for name in os.listdir(snapshots_dir):
+        if not name.startswith("gen-"):
+            continue
+        try:
+            generation = int(name.split("-")[1].split(".")[0])
+        except ValueError:
+            continue
+        if generation <= current_generation - RAG_SNAPSHOT_KEEP or (generation < current_generation and ".tmp" in name):
+            shutil.rmtree(os.path.join(snapshots_dir, name), ignore_errors=True)
+
+def publish_snapshot(vector_store: FAISS, store_path: str, extra_files=(), keyword_index=None) -> int:
+    """
+    Writes the store as a new read-only snapshot generation and atomically points the generation
+    file at it. Returns the new generation number. Serialized across processes with a file lock.
+    keyword_index (a rag_handler.KeywordIndex over the store) is published with it, so workers
+    memory-map it instead of building their own.
+    """
+    snapshots_dir = _snapshots_dir(store_path)
+    os.makedirs(snapshots_dir, exist_ok=True)
+    with open(os.path.join(snapshots_dir, PUBLISH_LOCK_FILE_NAME), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            current = read_current_generation(store_path)
+            generation = (current['generation'] if current else 0) + 1
+            name = f"gen-{generation:06d}"
+            tmp_dir = os.path.join(snapshots_dir, f"{name}.tmp-{os.getpid()}")
+            os.makedirs(tmp_dir)
+            faiss.write_index(vector_store.index, os.path.join(tmp_dir, INDEX_FILE))
+            ids = _write_docstore(vector_store, tmp_dir)
+            if keyword_index is not None:
+                _write_keyword_index(keyword_index, ids, tmp_dir)
+            for extra_file in extra_files:
+                if os.path.exists(extra_file):
+                    shutil.copy2(extra_file, tmp_dir)
+            os.rename(tmp_dir, os.path.join(snapshots_dir, name))
+
+            current_path = os.path.join(snapshots_dir, CURRENT_FILE_NAME)
+            with open(f"{current_path}.tmp", 'w') as f:
+                json.dump({'generation': generation, 'snapshot': name, 'vectors': vector_store.index.ntotal, 'published_at': time.time()}, f)
+            os.replace(f"{current_path}.tmp", current_path)
+            _prune_snapshots(snapshots_dir, generation)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    logging.info(f"Published index snapshot generation {generation} ({vector_store.index.ntotal} vectors).")
+    return generation
+
+
+# --- Reading (every web worker) ---
+def load_snapshot(snapshot_dir: str, embeddings_object) -> FAISS:
+    """
+    Opens a snapshot read-only. The FAISS index is memory-mapped where the index type supports it
+    (flat codes, IVF lists); otherwise it is read into memory.
+    """
+    index_path = os.path.join(snapshot_dir, INDEX_FILE)
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logging.warning(f"Index at {index_path} cannot be memory-mapped ({e}); reading it into memory.")
+        index = faiss.read_index(index_path)
+    docstore = MmapDocstore(snapshot_dir)
+    return FAISS(
+        embedding_function=embeddings_object,
+        index=apply_search_params(index),
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(docstore.ids)),
+    )
+
+
+class SharedIndexReader:
+    """
+    Holds a worker's view of the latest published snapshot. current() checks the generation file at
+    most every RAG_SNAPSHOT_POLL_SECONDS and swaps to a newer generation by replacing one reference,
+    so in-flight queries finish on the store they started with.
+    """
+    def __init__(self, store_path: str, embeddings_object, on_swap=None):
+        self.store_path = store_path
+        self.embeddings_object = embeddings_object
+        self.on_swap = on_swap
+        self.generation = None
+        self._store = None
+        self._current_mtime = None
+        self._last_check = 0.0
+        self._swap_lock = threading.Lock()
+
+    def current(self) -> FAISS:
+        if time.monotonic() - self._last_check >= RAG_SNAPSHOT_POLL_SECONDS:
+            self.refresh()
+        return self._store
+
+    def refresh(self) -> bool:
+        """
+        Loads the published generation if it is newer than the one held. Returns True if it swapped.
+        Only one thread loads at a time; the others keep using the current store meanwhile.
+        """
+        if not self._swap_lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            current_path = os.path.join(_snapshots_dir(self.store_path), CURRENT_FILE_NAME)
+            try:
+                mtime = os.stat(current_path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self._current_mtime:
+                return False
+            current = read_current_generation(self.store_path)
+            if not current or current['generation'] == self.generation:
+                self._current_mtime = mtime
+                return False
+
+            start = time.perf_counter()
+            new_store = load_snapshot(os.path.join(_snapshots_dir(self.store_path), current['snapshot']), self.embeddings_object)
+            old_store, self._store = self._store, new_store
+            self.generation = current['generation']
+            self._current_mtime = mtime
+            logging.info(f"Swapped to index snapshot generation {self.generation} ({new_store.index.ntotal} vectors) in {time.perf_counter() - start:.2f}s.")
+            if old_store is not None and self.on_swap:
+                self.on_swap(old_store)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to load index snapshot from {self.store_path}: {e}", exc_info=True)
+            return False
+        finally:
+            self._swap_lock.release()
@@ -0,0 +1,301 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+# --- Configuration ---
+# Unset: a SQLite file shared by all workers on this machine. "redis://..." uses Redis (needs the redis package).
+SHARED_STATE_URL = os.getenv('SHARED_STATE_URL')
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', 'shared_state.sqlite3')
+# How often a worker checks the backend for changes made by other workers. Between checks,
+# pause lookups are answered from process memory.
+SHARED_STATE_REFRESH_SECONDS = float(os.getenv('SHARED_STATE_REFRESH_SECONDS', 1.0))
+# How long an incoming WhatsApp message ID is remembered for duplicate deliveries.
+MESSAGE_DEDUPE_TTL_SECONDS = int(os.getenv('MESSAGE_DEDUPE_TTL_SECONDS', 3600))
+
+# Expired dedupe keys are purged from the SQLite backend after this many claims.
+PURGE_EVERY_CLAIMS = 500
+
+VERSION_KEY = "state:version"
+PAUSE_GLOBAL_KEY = "pause:global"
+PAUSE_CONVERSATION_PREFIX = "pause:conversation:"
+VALUE_PREFIX = "value:"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# --- Backends ---
+class SQLiteStateBackend:
+    """
+    Key/value state in a SQLite file (WAL mode) shared by the worker processes on one machine.
+    Writes bump a version counter, which workers poll to invalidate their local caches; writes of
+    values that are never cached locally (bump_version=False) leave it alone.
+    """
+    def __init__(self, path: str = None):
+        self.path = path or SHARED_STATE_PATH
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+
+    @contextmanager
+    def _write(self, bump_version: bool = True):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                if bump_version:
+                    self._conn.execute(
+                        "INSERT INTO state (key, value) VALUES (?, '1') ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                        (VERSION_KEY,),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float = None, bump_version: bool = True):
+        with self._write(bump_version) as conn:
+            conn.execute(
+                "INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, value, time.time() + ttl if ttl else None),
+            )
+
+    def set_if_absent(self, key: str, value: str, ttl: float = None) -> bool:
+        """
+        Sets key only if it does not exist (or has expired). Returns True if this call set it.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM state WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, now + ttl if ttl else None),
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return bool(inserted)
+
+    def delete(self, key: str, expected_value: str = None, bump_version: bool = True) -> bool:
+        with self._write(bump_version) as conn:
+            if expected_value is None:
+                return bool(conn.execute("DELETE FROM state WHERE key = ?", (key,)).rowcount)
+            return bool(conn.execute("DELETE FROM state WHERE key = ? AND value = ?", (key, expected_value)).rowcount)
+
+    def delete_prefix(self, prefix: str):
+        with self._write() as conn:
+            conn.execute("DELETE FROM state WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+
+    def keys(self, prefix: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM state WHERE key >= ? AND key < ? AND (expires_at IS NULL OR expires_at > ?)",
+                (prefix, prefix + "\uffff", time.time()),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def version(self) -> int:
+        value = self.get(VERSION_KEY)
+        return int(value) if value else 0
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+
+class RedisStateBackend:
+    """
+    Same interface on Redis, for deployments whose workers do not share a disk.
+    """
+    def __init__(self, url: str):
+        import redis # Optional dependency, only needed when SHARED_STATE_URL points at Redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key: str):
+        return self._redis.get(key)
+
+    def set(self, key: str, value: str, ttl: float = None, bump_version: bool = True):
+        pipe = self._redis.pipeline()
+        pipe.set(key, value, px=int(ttl * 1000) if ttl else None)
+        if bump_version:
+            pipe.incr(VERSION_KEY)
+        pipe.execute()
+
+    def set_if_absent(self, key: str, value: str, ttl: float = None) -> bool:
+        return bool(self._redis.set(key, value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def delete(self, key: str, expected_value: str = None, bump_version: bool = True) -> bool:
+        if expected_value is None:
+            deleted = self._redis.delete(key)
+        else:
+            # Compare-and-delete must be atomic so a lock is never released by a non-owner.
+            deleted = self._redis.eval("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end", 1, key, expected_value)
+        if bump_version:
+            self._redis.incr(VERSION_KEY)
+        return bool(deleted)
+
+    def delete_prefix(self, prefix: str):
+        keys = self.keys(prefix)
+        if keys:
+            self._redis.delete(*keys)
+        self._redis.incr(VERSION_KEY)
+
+    def keys(self, prefix: str) -> list:
+        return list(self._redis.scan_iter(match=f"{prefix}*"))
+
+    def version(self) -> int:
+        value = self._redis.get(VERSION_KEY)
+        return int(value) if value else 0
+
+    def purge_expired(self):
+        pass # Redis expires keys itself
+
+
+def create_backend():
+    if SHARED_STATE_URL and SHARED_STATE_URL.startswith(('redis://', 'rediss://')):
+        logging.info("Using Redis for shared state.")
+        return RedisStateBackend(SHARED_STATE_URL)
+    logging.info(f"Using SQLite shared state at {SHARED_STATE_PATH}.")
+    return SQLiteStateBackend()
+
+
+# --- Shared State ---
+class SharedState:
+    """
+    Pause flags, dedupe keys and job locks shared by all workers. Pause checks are served from a
+    local snapshot that is refreshed only when the backend's version counter has moved.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or create_backend()
+        self._refresh_lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._globally_paused = False
+        self._paused_conversations = frozenset()
+        self._claims = 0
+        self.backend.purge_expired()
+        self._refresh()
+
+    def _refresh(self):
+        version = self.backend.version()
+        if version == self._version:
+            return
+        self._globally_paused = self.backend.get(PAUSE_GLOBAL_KEY) is not None
+        self._paused_conversations = frozenset(key[len(PAUSE_CONVERSATION_PREFIX):] for key in self.backend.keys(PAUSE_CONVERSATION_PREFIX))
+        self._version = version
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._checked_at < SHARED_STATE_REFRESH_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return # Another thread is refreshing; the current snapshot is fine meanwhile
+        try:
+            self._checked_at = time.monotonic()
+            self._refresh()
+        except Exception as e:
+            logging.error(f"Failed to refresh shared state; using cached pause state: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def _changed(self):
+        # Local writes are visible to this worker immediately.
+        with self._refresh_lock:
+            self._checked_at = time.monotonic()
+            self._refresh()
+
+    # --- Pause controls ---
+    def is_globally_paused(self) -> bool:
+        self._maybe_refresh()
+        return self._globally_paused
+
+    def is_conversation_paused(self, user_id: str) -> bool:
+        self._maybe_refresh()
+        return user_id in self._paused_conversations
+
+    def paused_conversations(self) -> frozenset:
+        self._maybe_refresh()
+        return self._paused_conversations
+
+    def pause_all(self):
+        self.backend.set(PAUSE_GLOBAL_KEY, "1")
+        self._changed()
+
+    def resume_all(self):
+        """
+        Clears the global pause and every conversation-specific pause.
+        """
+        self.backend.delete(PAUSE_GLOBAL_KEY)
+        self.backend.delete_prefix(PAUSE_CONVERSATION_PREFIX)
+        self._changed()
+
+    def pause_conversation(self, user_id: str):
+        self.backend.set(f"{PAUSE_CONVERSATION_PREFIX}{user_id}", "1")
+        self._changed()
+
+    def resume_conversation(self, user_id: str):
+        self.backend.delete(f"{PAUSE_CONVERSATION_PREFIX}{user_id}")
+        self._changed()
+
+    # --- Dedupe keys ---
+    def claim_once(self, key: str, ttl: float = MESSAGE_DEDUPE_TTL_SECONDS) -> bool:
+        """
+        Returns True the first time key is claimed by any worker within ttl seconds, False afterwards.
+        """
+        self._claims += 1
+        if self._claims % PURGE_EVERY_CLAIMS == 0:
+            self.backend.purge_expired()
+        return self.backend.set_if_absent(f"dedupe:{key}", "1", ttl)
+
+    # --- Job locks ---
+    def acquire_lock(self, name: str, ttl: float):
+        """
+        Takes a named cross-worker lock that expires after ttl seconds (so a crashed holder cannot block
+        forever). Returns a token to pass to release_lock, or None if another worker holds it.
+        """
+        token = uuid.uuid4().hex
+        return token if self.backend.set_if_absent(f"lock:{name}", token, ttl) else None
+
+    def release_lock(self, name: str, token: str) -> bool:
+        return self.backend.delete(f"lock:{name}", expected_value=token)
+
+    # --- Short-lived values ---
+    def put_value(self, key: str, value: str, ttl: float):
+        """
+        Stores a value any worker can read back until ttl expires. These are read straight from the
+        backend, so writing one does not invalidate the other workers' pause snapshots.
+        """
+        self.backend.set(f"{VALUE_PREFIX}{key}", value, ttl, bump_version=False)
+
+    def get_value(self, key: str):
+        return self.backend.get(f"{VALUE_PREFIX}{key}")
+
+    def delete_value(self, key: str):
+        self.backend.delete(f"{VALUE_PREFIX}{key}", bump_version=False)
+
+
+_shared_state = None
+_shared_state_lock = threading.Lock()
+
+def get_shared_state() -> SharedState:
+    """
+    Returns the process-wide SharedState, creating it on first use.
+    """
+    global _shared_state
+    if _shared_state is None:
+        with _shared_state_lock:
+            if _shared_state is None:
+                _shared_state = SharedState()
+    return _shared_state
@@ -0,0 +1,95 @@
+import os
+import bisect
+from datetime import datetime, timedelta
+
+# --- Configuration ---
+# How many alternative times are offered when the requested slot is taken.
+ALTERNATIVE_SLOT_COUNT = int(os.getenv('ALTERNATIVE_SLOT_COUNT', 3))
+# Offered start times are aligned to this many minutes (e.g. :00 and :30).
+SLOT_STEP_MINUTES = int(os.getenv('SLOT_STEP_MINUTES', 30))
+# How far before and after the requested time alternatives are searched for.
+SLOT_SEARCH_DAYS = int(os.getenv('SLOT_SEARCH_DAYS', 7))
+# The earliest an offered slot may start, counted from now.
+SLOT_MIN_LEAD_MINUTES = int(os.getenv('SLOT_MIN_LEAD_MINUTES', 60))
+
+
+def merge_intervals(busy) -> list:
+    """
+    Sorts (start, end) pairs and merges overlapping or touching ones.
+    """
+    merged = []
+    for start, end in sorted(busy):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def open_period(moment: datetime, open_hour: int, close_hour: int):
+    """
+    The (start, end) of the open period containing moment (aware, in the business timezone), or None if
+    moment is outside opening hours. Handles hours that run past midnight (e.g. 20 to 8).
+    """
+    timezone = moment.tzinfo
+    day = moment.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    hour = moment.hour
+    if open_hour == close_hour:
+        return (moment - timedelta(days=1), moment + timedelta(days=1)) # Open around the clock
+    if open_hour < close_hour:
+        if not open_hour <= hour < close_hour:
+            return None
+        start, end = day + timedelta(hours=open_hour), day + timedelta(hours=close_hour)
+    elif hour >= open_hour:
+        start, end = day + timedelta(hours=open_hour), day + timedelta(days=1, hours=close_hour)
+    elif hour < close_hour:
+        start, end = day - timedelta(days=1) + timedelta(hours=open_hour), day + timedelta(hours=close_hour)
+    else:
+        return None
+    return timezone.localize(start), timezone.localize(end)
+
+
+def find_alternative_slots(requested_start: datetime, duration_minutes: int, busy, open_hour: int, close_hour: int,
+                           now: datetime = None, count: int = ALTERNATIVE_SLOT_COUNT, step_minutes: int = SLOT_STEP_MINUTES,
+                           search_days: int = SLOT_SEARCH_DAYS, min_lead_minutes: int = SLOT_MIN_LEAD_MINUTES) -> list:
+    """
+    The `count` free slots whose start is nearest to requested_start, sorted by start time.
+
+    requested_start is aware, in the business timezone (a pytz zone), and opening hours are read in it.
+    busy holds aware (start, end) pairs, e.g. from FreeBusyCache.busy_between, covering at least
+    search_days either side of the request. Candidates lie on a step_minutes grid and are visited
+    nearest first (later first on ties); each one costs a bisect into the merged busy list.
+    """
+    timezone = requested_start.tzinfo
+    duration = timedelta(minutes=duration_minutes)
+    step = timedelta(minutes=step_minutes)
+    earliest = (now or datetime.now(timezone)) + timedelta(minutes=min_lead_minutes)
+    horizon = timedelta(days=search_days)
+
+    merged = merge_intervals(busy)
+    busy_starts = [start for start, _ in merged]
+
+    def is_free(start):
+        end = start + duration
+        period = open_period(start, open_hour, close_hour)
+        if period is None or end > period[1]:
+            return False
+        i = bisect.bisect_left(busy_starts, end) # Merged intervals starting before the slot ends
+        return i == 0 or merged[i - 1][1] <= start
+
+    # Grid points within the horizon, aligned in local wall time, nearest to the request first.
+    local = requested_start.replace(tzinfo=None)
+    minutes = local.hour * 60 + local.minute
+    aligned = timezone.localize(local.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(minutes=minutes - minutes % step_minutes))
+    steps = int(horizon / step)
+    candidates = [timezone.normalize(aligned + k * step) for k in range(-steps, steps + 1)]
+    candidates.sort(key=lambda candidate: (abs(candidate - requested_start), candidate < requested_start))
+
+    found = []
+    for candidate in candidates:
+        if candidate >= earliest and candidate != requested_start and is_free(candidate):
+            found.append(candidate)
+            if len(found) == count:
+                break
+    return sorted(found)
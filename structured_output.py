@@ -0,0 +1,258 @@
+import os
+import re
+import json
+import logging
+from langchain.schema import HumanMessage, AIMessage
+from metrics import timed, record_llm_usage, record_structured_output
+
+# --- Configuration ---
+# How the model is asked for JSON: "json_mode" (OpenAI response_format), "function_calling"
+# (a forced tool call whose parameters are the schema) or "prompt" (instructions only).
+LLM_STRUCTURED_OUTPUT_MODE = os.getenv('LLM_STRUCTURED_OUTPUT_MODE', 'json_mode').lower()
+# Follow-up calls that show the model its unusable reply and the reason. Local repair is tried first,
+# so these only run when the reply cannot be parsed or does not match the schema at all.
+LLM_STRUCTURED_OUTPUT_RETRIES = int(os.getenv('LLM_STRUCTURED_OUTPUT_RETRIES', 1))
+
+LITERALS = {'True': 'true', 'False': 'false', 'None': 'null', 'NaN': 'null', 'undefined': 'null'}
+WORD_PATTERN = re.compile(r"[^\W\d]\w*") # Unicode letters too, matching the str.isalpha() check that starts a word
+FENCE_PATTERN = re.compile(r"```[A-Za-z0-9_-]*[ \t]*\n?(.*?)(?:```|$)", re.DOTALL)
+SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class StructuredOutputError(ValueError):
+    """Raised when an LLM reply cannot be turned into a value matching its schema."""
+
+
+# --- Tolerant Parsing ---
+def _drop_trailing_comma(out: list):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites the first JSON object or array in text into strict JSON: prose around it is dropped,
+    single-quoted strings and Python literals (True/False/None) are converted, raw newlines in strings
+    are escaped, trailing commas are removed, and brackets left open by a truncated reply are closed.
+    """
+    text = text.translate(SMART_QUOTES)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        raise StructuredOutputError("no JSON object in the reply")
+
+    out, stack = [], []
+    quote, escaped = None, False
+    i = min(starts)
+    while i < len(text):
+        ch = text[i]
+        i += 1
+        if quote:
+            if escaped:
+                escaped = False
+                if ch == "'" and quote == "'":
+                    out[-1] = "'" # \' is not a JSON escape
+                    continue
+                out.append(ch)
+            elif ch == '\\':
+                escaped = True
+                out.append(ch)
+            elif ch == quote:
+                quote = None
+                out.append('"')
+            elif ch == '"':
+                out.append('\\"') # Inside a single-quoted string
+            elif ch == '\n':
+                out.append('\\n')
+            else:
+                out.append(ch)
+        elif ch in '"\'':
+            quote = ch
+            out.append('"')
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+        elif ch in '}]':
+            _drop_trailing_comma(out)
+            if stack:
+                stack.pop()
+            out.append(ch)
+            if not stack:
+                break # End of the top-level value; anything after it is prose
+        elif ch.isalpha() or ch == '_':
+            word = WORD_PATTERN.match(text, i - 1).group()
+            out.append(LITERALS.get(word, word))
+            i += len(word) - 1
+        else:
+            out.append(ch)
+
+    if quote:
+        out.append('"')
+    _drop_trailing_comma(out)
+    if out and out[-1] == ':':
+        out.append('null')
+    out.extend(reversed(stack))
+    return ''.join(out)
+
+def parse_json(text: str):
+    """
+    Parses an LLM reply as JSON. Returns (value, repaired): repaired is True when the reply needed
+    fence stripping or repair_json to parse.
+    """
+    text = (text or '').strip()
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    fenced = FENCE_PATTERN.search(text)
+    if fenced:
+        try:
+            return json.loads(fenced.group(1).strip()), True
+        except ValueError:
+            text = fenced.group(1)
+    repaired = repair_json(text)
+    try:
+        return json.loads(repaired), True
+    except ValueError as e:
+        raise StructuredOutputError(f"reply is not valid JSON even after repair ({e})") from None
+
+
+# --- Schema Validation ---
+_TYPE_CHECKS = {
+    'object': lambda v: isinstance(v, dict),
+    'array': lambda v: isinstance(v, list),
+    'string': lambda v: isinstance(v, str),
+    'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    'integer': lambda v: isinstance(v, int) and not isinstance(v, bool),
+    'boolean': lambda v: isinstance(v, bool),
+    'null': lambda v: v is None,
+}
+
+def _coerce(value, types):
+    """
+    Converts common near-misses (numbers and booleans sent as strings, "null", whole floats for
+    integers) to one of the allowed types. Returns the value unchanged if nothing fits.
+    """
+    if isinstance(value, str):
+        stripped = value.strip()
+        if 'null' in types and stripped.lower() in ('null', 'none', ''):
+            return None
+        if 'boolean' in types and stripped.lower() in ('true', 'false'):
+            return stripped.lower() == 'true'
+        if 'integer' in types or 'number' in types:
+            try:
+                number = float(stripped.replace(',', ''))
+            except ValueError:
+                return value
+            if 'integer' in types and number.is_integer():
+                return int(number)
+            if 'number' in types:
+                return number
+    if isinstance(value, float) and 'integer' in types and 'number' not in types and value.is_integer():
+        return int(value)
+    return value
+
+def conform(value, schema: dict, path: str = '$'):
+    """
+    Validates value against a JSON Schema subset (type, enum, pattern, minimum, maximum, properties,
+    required, additionalProperties, items, default) and returns it with near-miss types coerced and
+    defaults filled in. Raises StructuredOutputError naming the offending path.
+    """
+    types = schema.get('type')
+    if types:
+        types = [types] if isinstance(types, str) else types
+        if 'null' in types and isinstance(value, str) and value.strip().lower() in ('null', 'none'):
+            value = None # A nullable string field answered with the word "null"
+        if not any(_TYPE_CHECKS[t](value) for t in types):
+            value = _coerce(value, types)
+            if not any(_TYPE_CHECKS[t](value) for t in types):
+                raise StructuredOutputError(f"{path} should be {' or '.join(types)}, got {json.dumps(value, ensure_ascii=False)[:80]}")
+    if value is None:
+        return value
+
+    if 'enum' in schema and value not in schema['enum']:
+        raise StructuredOutputError(f"{path} should be one of {schema['enum']}, got {value!r}")
+    if 'pattern' in schema and isinstance(value, str) and not re.search(schema['pattern'], value):
+        raise StructuredOutputError(f"{path} does not match {schema['pattern']}: {value!r}")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if 'minimum' in schema and value < schema['minimum']:
+            raise StructuredOutputError(f"{path} is below {schema['minimum']}: {value}")
+        if 'maximum' in schema and value > schema['maximum']:
+            raise StructuredOutputError(f"{path} is above {schema['maximum']}: {value}")
+
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        for key in schema.get('required', []):
+            if key not in value and 'default' not in properties.get(key, {}):
+                raise StructuredOutputError(f"{path} is missing '{key}'")
+        conformed = {}
+        for key, item in value.items():
+            item_schema = properties.get(key, schema.get('additionalProperties'))
+            conformed[key] = conform(item, item_schema, f"{path}.{key}") if isinstance(item_schema, dict) else item
+        for key, property_schema in properties.items():
+            if key not in conformed and 'default' in property_schema:
+                conformed[key] = property_schema['default']
+        return conformed
+    if isinstance(value, list) and isinstance(schema.get('items'), dict):
+        return [conform(item, schema['items'], f"{path}[{i}]") for i, item in enumerate(value)]
+    return value
+
+
+# --- Structured Invocation ---
+def _bind(ai_model, name: str, schema: dict):
+    try:
+        if LLM_STRUCTURED_OUTPUT_MODE == 'json_mode':
+            return ai_model.bind(response_format={'type': 'json_object'})
+        if LLM_STRUCTURED_OUTPUT_MODE == 'function_calling':
+            tool = {'type': 'function', 'function': {'name': name, 'description': f"Return the {name.replace('_', ' ')} result.", 'parameters': schema}}
+            return ai_model.bind_tools([tool], tool_choice=name)
+    except (AttributeError, NotImplementedError) as e:
+        logging.warning(f"Model does not support structured output mode '{LLM_STRUCTURED_OUTPUT_MODE}' ({e}); relying on the prompt.")
+    return ai_model
+
+def _reply_text(response) -> str:
+    """
+    The raw JSON text of a reply: the forced tool call's arguments in function-calling mode, otherwise
+    the message content.
+    """
+    for tool_call in getattr(response, 'tool_calls', None) or []:
+        return json.dumps(tool_call.get('args', {}), ensure_ascii=False)
+    for tool_call in getattr(response, 'invalid_tool_calls', None) or []:
+        return tool_call.get('args') or ''
+    return response.content if isinstance(response.content, str) else json.dumps(response.content)
+
+def invoke_structured(ai_model, prompt, schema: dict, purpose: str, stage: str = None, retries: int = None):
+    """
+    Calls the model for a JSON object matching schema and returns it (validated, with defaults filled),
+    or None if no usable reply was obtained. prompt is a string or a list of LangChain messages.
+    Replies are parsed locally with repair first; only a reply that is still unusable costs a follow-up
+    call. Outcomes are counted per purpose in /metrics (llm_structured_outputs_total). API errors raise.
+    """
+    messages = [HumanMessage(content=prompt)] if isinstance(prompt, str) else list(prompt)
+    model = _bind(ai_model, purpose, schema)
+    retries = LLM_STRUCTURED_OUTPUT_RETRIES if retries is None else retries
+
+    for attempt in range(retries + 1):
+        with timed(stage or f"llm_{purpose}"):
+            response = model.invoke(messages)
+        record_llm_usage(purpose, response)
+        reply = _reply_text(response)
+        try:
+            value, repaired = parse_json(reply)
+            value = conform(value, schema)
+        except StructuredOutputError as e:
+            logging.warning(f"Unusable structured reply for '{purpose}' (attempt {attempt + 1}/{retries + 1}): {e}. Reply: {reply[:300]!r}")
+            messages = messages + [
+                AIMessage(content=reply),
+                HumanMessage(content=f"That reply could not be used: {e}. Respond again with ONLY the corrected JSON object."),
+            ]
+            continue
+        if repaired:
+            logging.info(f"Repaired structured reply for '{purpose}' locally.")
+        record_structured_output(purpose, 'retried' if attempt else ('repaired' if repaired else 'ok'))
+        return value
+
+    record_structured_output(purpose, 'failed')
+    return None
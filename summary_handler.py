@@ -0,0 +1,152 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema import HumanMessage
+from metrics import timed, record_llm_usage
+
+# --- Configuration ---
+# Rough upper bound for the rolling summary carried in the prompt (in words, not tokens;
+# ~250 words is a few hundred tokens for English and Arabic alike).
+SUMMARY_MAX_WORDS = int(os.getenv('CONVERSATION_SUMMARY_MAX_WORDS', 250))
+SUMMARY_FILE_SUFFIX = ".summary.json"
+
+# A single worker keeps summarization strictly off the reply path and serializes
+# LLM usage for summaries so it never competes with live chat for many threads.
+summary_executor = ThreadPoolExecutor(max_workers=1)
+
+# Per-user locks so two evictions for the same user never interleave their
+# read-modify-write of the summary file.
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+
+
+def _get_user_lock(uid):
+    with _user_locks_guard:
+        lock = _user_locks.get(uid)
+        if lock is None:
+            lock = threading.Lock()
+            _user_locks[uid] = lock
+        return lock
+
+
+def _summary_path(conv_dir, uid):
+    return os.path.join(conv_dir, f"{uid}{SUMMARY_FILE_SUFFIX}")
+
+
+def load_summary(conv_dir, uid):
+    """
+    Loads the rolling summary for a user. Returns the summary text, or "" if none exists.
+    """
+    path = _summary_path(conv_dir, uid)
+    if not os.path.isfile(path):
+        return ""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return data.get('summary') or ""
+        return ""
+    except Exception as e:
+        logging.error(f"Error loading conversation summary for {uid}: {e}")
+        return ""
+
+
+def save_summary(conv_dir, uid, summary_text, summarized_messages):
+    """
+    Writes the rolling summary atomically so readers never see a half-written file.
+    """
+    path = _summary_path(conv_dir, uid)
+    tmp_path = f"{path}.tmp"
+    data = {
+        'summary': summary_text,
+        'summarized_messages': summarized_messages,
+        'updated_at': datetime.utcnow().isoformat() + 'Z',
+    }
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.error(f"Error saving conversation summary for {uid}: {e}")
+
+
+def _get_summarized_count(conv_dir, uid):
+    path = _summary_path(conv_dir, uid)
+    if not os.path.isfile(path):
+        return 0
+    try:
+        with open(path, encoding='utf-8') as f:
+            return int(json.load(f).get('summarized_messages', 0))
+    except Exception:
+        return 0
+
+
+def _format_turns(messages):
+    lines = []
+    for item in messages:
+        role = item.get('role')
+        parts = item.get('parts') or []
+        if not parts:
+            continue
+        speaker = "User" if role == 'user' else "Assistant"
+        lines.append(f"{speaker}: {parts[0]}")
+    return "\n".join(lines)
+
+
+def update_summary(ai_model, conv_dir, uid, evicted_messages):
+    """
+    Folds evicted history messages into the user's rolling summary.
+    Runs on the summary executor; never call this on the reply path.
+    """
+    if not ai_model or not evicted_messages:
+        return False
+
+    with _get_user_lock(uid):
+        previous_summary = load_summary(conv_dir, uid)
+        summarized_count = _get_summarized_count(conv_dir, uid)
+        transcript = _format_turns(evicted_messages)
+        if not transcript:
+            return False
+
+        summary_prompt = (
+            f"You maintain a compact running summary of a WhatsApp conversation between a real estate agent (Assistant) and a client (User).\n"
+            f"Existing summary (may be empty):\n{previous_summary or '(none)'}\n\n"
+            f"Older messages to fold into the summary:\n{transcript}\n\n"
+            f"Write the updated summary in at most {SUMMARY_MAX_WORDS} words. Keep facts the agent must not ask for again: "
+            f"the client's name, contact details, budget, preferred locations, property types, bedrooms, properties already discussed, "
+            f"requested viewing dates/times and any open questions. Drop greetings and small talk. "
+            f"Write plain text in the same language the client uses. Respond with ONLY the summary."
+        )
+
+        try:
+            with timed('summary_update'):
+                response = ai_model.invoke([HumanMessage(content=summary_prompt)])
+            record_llm_usage('summary', response)
+            new_summary = response.content.strip()
+        except Exception as e:
+            logging.error(f"Error summarizing conversation for {uid}: {e}", exc_info=True)
+            return False
+
+        if not new_summary:
+            logging.warning(f"Summarizer returned an empty summary for {uid}. Keeping previous summary.")
+            return False
+
+        save_summary(conv_dir, uid, new_summary, summarized_count + len(evicted_messages))
+        logging.info(f"Updated conversation summary for {uid} with {len(evicted_messages)} evicted messages. Summary length: {len(new_summary)} chars.")
+        return True
+
+
+def schedule_summary_update(ai_model, conv_dir, uid, evicted_messages):
+    """
+    Queues a summary refresh for the evicted messages in the background.
+    """
+    if not ai_model or not evicted_messages:
+        return None
+    try:
+        return summary_executor.submit(update_summary, ai_model, conv_dir, uid, list(evicted_messages))
+    except Exception as e:
+        logging.error(f"Failed to queue conversation summary update for {uid}: {e}", exc_info=True)
+        return None
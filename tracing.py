@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import contextvars
+import urllib.request
+
+# --- Configuration ---
+# 'jsonl' (default): finished spans are appended to TRACE_FILE_PATH, one span per line.
+# 'otlp': spans are POSTed as OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT (any collector, or a local stand-in).
+# 'off': spans are not recorded at all.
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'jsonl').lower()
+TRACE_FILE_PATH = os.getenv('TRACE_FILE_PATH', 'traces.jsonl')
+# The trace file is rotated to TRACE_FILE_PATH + '.1' when it grows past this size.
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 50 * 1024 * 1024))
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'whatsapp-bot')
+
+# Spans are handed to a background exporter so the request thread never waits on disk or network.
+EXPORT_QUEUE_SIZE = 10000
+EXPORT_BATCH_SIZE = 200
+
+MESSAGE_ID_ATTRIBUTE = 'whatsapp.message_id'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+# --- Trace IDs ---
+def trace_id_for_message(message_id: str) -> str:
+    """
+    Derives the 32-hex-digit trace ID for an inbound WhatsApp message from its key.id, so a
+    message's trace can be found from the ID alone (and redeliveries map to the same trace).
+    """
+    return hashlib.sha256(message_id.encode('utf-8')).hexdigest()[:32]
+
+def _new_id(n_bytes: int) -> str:
+    # Not security-sensitive; getrandbits avoids a syscall per span.
+    return f"{random.getrandbits(n_bytes * 8):0{n_bytes * 2}x}"
+
+
+# --- Spans ---
+class _Trace:
+    __slots__ = ('trace_id', 'root', 'spans', 'finished')
+
+    def __init__(self, trace_id: str, root):
+        self.trace_id = trace_id
+        self.root = root
+        self.spans = []
+        self.finished = False
+
+
+class span:
+    """
+    Times a unit of work as a span of the current trace; outside any trace it starts a new one.
+    Use as `with span('drive_fetch', document_id=...):`. metrics.timed opens one of these for
+    every timed stage, so stages show up in traces without extra instrumentation.
+    A trace is exported in one batch when its root span ends.
+    """
+    __slots__ = ('name', 'attributes', 'span_id', 'parent_id', 'trace', 'start_ns', 'end_ns', 'status', '_start_perf', '_token')
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.trace = None
+
+    def __enter__(self):
+        if TRACE_EXPORT == 'off':
+            return self
+        parent = _current_span.get()
+        self.span_id = _new_id(8)
+        if parent is None or parent.trace is None:
+            self.parent_id = None
+            self.trace = _Trace(_new_id(16), self)
+        else:
+            self.parent_id = parent.span_id
+            self.trace = parent.trace
+        self.status = 'ok'
+        self.start_ns = time.time_ns()
+        self._start_perf = time.perf_counter_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is None:
+            return False
+        self.end_ns = self.start_ns + (time.perf_counter_ns() - self._start_perf)
+        if exc_type is not None:
+            self.status = 'error'
+            self.attributes['error'] = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        trace = self.trace
+        if trace.finished:
+            _export([self]) # Outlived its root (e.g. work handed to another thread)
+        elif self.parent_id is None:
+            trace.finished = True
+            _export(trace.spans + [self])
+        else:
+            trace.spans.append(self)
+        return False
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+def current_span():
+    """
+    The innermost active span, or None outside any trace (or when tracing is off).
+    """
+    return _current_span.get()
+
+def annotate(**attributes):
+    """
+    Adds attributes to the innermost active span, if any.
+    """
+    active = _current_span.get()
+    if active is not None:
+        active.attributes.update(attributes)
+
+def set_trace_message_id(message_id: str):
+    """
+    Re-keys the current trace to the trace ID derived from a WhatsApp message's key.id. Called by the
+    webhook once the payload is parsed; spans already recorded move with it since none are exported yet.
+    """
+    active = _current_span.get()
+    if active is None or active.trace is None or not message_id:
+        return
+    active.trace.trace_id = trace_id_for_message(message_id)
+    active.trace.root.attributes[MESSAGE_ID_ATTRIBUTE] = message_id
+
+
+# --- Export ---
+_export_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+_exporter_lock = threading.Lock()
+_exporter_started = False
+_dropped_spans = 0
+
+def _export(spans: list):
+    global _dropped_spans
+    _ensure_exporter()
+    for finished_span in spans:
+        try:
+            _export_queue.put_nowait(finished_span)
+        except queue.Full:
+            _dropped_spans += 1
+
+def _ensure_exporter():
+    global _exporter_started
+    if _exporter_started:
+        return
+    with _exporter_lock:
+        if not _exporter_started:
+            threading.Thread(target=_export_loop, name="trace-exporter", daemon=True).start()
+            _exporter_started = True
+
+def _export_loop():
+    global _dropped_spans
+    while True:
+        batch = [_export_queue.get().to_dict()]
+        while len(batch) < EXPORT_BATCH_SIZE:
+            try:
+                batch.append(_export_queue.get_nowait().to_dict())
+            except queue.Empty:
+                break
+        if _dropped_spans:
+            logging.warning(f"Trace export queue was full; dropped {_dropped_spans} spans.")
+            _dropped_spans = 0
+        try:
+            if TRACE_EXPORT == 'otlp':
+                _post_otlp(batch)
+            else:
+                _write_jsonl(batch)
+        except Exception as e:
+            logging.error(f"Failed to export {len(batch)} spans ({TRACE_EXPORT}): {e}")
+
+def _write_jsonl(batch: list):
+    try:
+        if os.path.getsize(TRACE_FILE_PATH) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE_PATH, f"{TRACE_FILE_PATH}.1")
+    except FileNotFoundError:
+        pass
+    # One write per batch in append mode, so lines from several workers do not interleave.
+    lines = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in batch)
+    with open(TRACE_FILE_PATH, 'a', encoding='utf-8') as f:
+        f.write(lines)
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _to_otlp_span(record: dict) -> dict:
+    otlp_span = {
+        'traceId': record['trace_id'],
+        'spanId': record['span_id'],
+        'name': record['name'],
+        'kind': 1, # SPAN_KIND_INTERNAL
+        'startTimeUnixNano': str(record['start_ns']),
+        'endTimeUnixNano': str(record['end_ns']),
+        'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in record['attributes'].items()],
+        'status': {'code': 2 if record['status'] == 'error' else 1},
+    }
+    if record['parent_span_id']:
+        otlp_span['parentSpanId'] = record['parent_span_id']
+    return otlp_span
+
+def _post_otlp(batch: list):
+    body = {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}]},
+        'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': [_to_otlp_span(record) for record in batch]}],
+    }]}
+    # urllib keeps this module free of third-party imports (metrics.py and the CLI depend on it).
+    request = urllib.request.Request(TRACE_OTLP_ENDPOINT, data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=5) as resp:
+        resp.read() # urlopen raises HTTPError for non-2xx responses
+
+
+# --- Waterfall CLI ---
+def load_trace(trace_or_message_id: str, path: str = None) -> list:
+    """
+    Returns the spans of one trace from a JSONL trace file (and its rotated predecessor), sorted by start.
+    Accepts a trace ID or a WhatsApp message key.id.
+    """
+    path = path or TRACE_FILE_PATH
+    wanted = {trace_or_message_id, trace_id_for_message(trace_or_message_id)}
+    spans = []
+    for candidate in (f"{path}.1", path):
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('trace_id') in wanted:
+                    spans.append(record)
+    return sorted(spans, key=lambda record: record['start_ns'])
+
+def render_waterfall(spans: list, width: int = 50) -> str:
+    if not spans:
+        return "No spans found."
+    children = {}
+    for record in spans:
+        children.setdefault(record['parent_span_id'], []).append(record)
+    span_ids = {record['span_id'] for record in spans}
+    roots = [record for record in spans if record['parent_span_id'] not in span_ids]
+    trace_start = min(record['start_ns'] for record in spans)
+    total_ns = max(max(record['end_ns'] for record in spans) - trace_start, 1)
+
+    rows = []
+    def walk(record, depth):
+        rows.append((depth, record))
+        for child in children.get(record['span_id'], []):
+            walk(child, depth + 1)
+    for root in roots:
+        walk(root, 0)
+
+    name_width = max(len("  " * depth + record['name']) for depth, record in rows)
+    message_id = next((record['attributes'].get(MESSAGE_ID_ATTRIBUTE) for record in roots if record['attributes'].get(MESSAGE_ID_ATTRIBUTE)), None)
+    lines = [f"Trace {spans[0]['trace_id']}" + (f" (message {message_id})" if message_id else "") + f" - {total_ns / 1e6:.1f} ms"]
+    for depth, record in rows:
+        offset_ms = (record['start_ns'] - trace_start) / 1e6
+        duration_ms = (record['end_ns'] - record['start_ns']) / 1e6
+        bar_start = int((record['start_ns'] - trace_start) / total_ns * width)
+        bar_length = max(1, int((record['end_ns'] - record['start_ns']) / total_ns * width))
+        bar = " " * bar_start + "█" * min(bar_length, width - bar_start)
+        marker = " !" if record['status'] == 'error' else ""
+        lines.append(f"{('  ' * depth + record['name']).ljust(name_width)}  {offset_ms:9.1f} ms {duration_ms:9.1f} ms  |{bar.ljust(width)}|{marker}")
+        if record['status'] == 'error':
+            lines.append(f"{' ' * name_width}  {record['attributes'].get('error', '')}")
+    return "\n".join(lines)
+
+def list_recent_traces(path: str = None, limit: int = 20) -> str:
+    path = path or TRACE_FILE_PATH
+    roots = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('parent_span_id') is None:
+                    roots.append(record)
+    lines = []
+    for record in roots[-limit:]:
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['start_ns'] / 1e9))
+        message_id = record['attributes'].get(MESSAGE_ID_ATTRIBUTE, '-')
+        lines.append(f"{started}  {record['trace_id']}  {record['name']:<20} {(record['end_ns'] - record['start_ns']) / 1e6:9.1f} ms  {message_id}")
+    return "\n".join(lines) or "No traces recorded."
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a waterfall of the spans recorded for one message.")
+    parser.add_argument('id', nargs='?', help="WhatsApp message key.id or trace ID. Omit to list recent traces.")
+    parser.add_argument('--file', default=TRACE_FILE_PATH, help="JSONL trace file (default: TRACE_FILE_PATH).")
+    parser.add_argument('--limit', type=int, default=20, help="Number of recent traces to list.")
+    args = parser.parse_args()
+    if args.id:
+        print(render_waterfall(load_trace(args.id, args.file)))
+    else:
+        print(list_recent_traces(args.file, args.limit))
+    sys.exit(0)
@@ -4,6 +4,7 @@ import time
 import random
 import logging
 import requests
+from metrics import timed, record_error
 
 WASENDER_API_URL = os.getenv('WASENDER_API_URL', "https://www.wasenderapi.com/api/send-message")
 WASENDER_API_TOKEN = os.getenv('WASENDER_API_TOKEN')
@@ -13,6 +14,7 @@ HTTP_SESSION = requests.Session()
 # These will inherit the basicConfig from the main script.py if this module is imported,
 # or use default Python logging if run standalone (though it's not designed for standalone).
 
+@timed('whatsapp_send_text')
 def send_whatsapp_message(to, text):
     """Sends a text message via WaSenderAPI with robust retry logic."""
     # These variables are now module-level in whatsapp_utils.py
@@ -66,8 +68,10 @@ def send_whatsapp_message(to, text):
             time.sleep(wait_time)
 
     logging.error(f"All {max_retries} attempts to send message to {clean_to} failed. Message: {text[:50]}...")
+    record_error('whatsapp_send_text')
     return False
 
+@timed('whatsapp_send_image')
 def send_whatsapp_image_message(to, caption, image_url):
     """Sends an image message via WaSenderAPI with retry logic."""
     # These variables are now module-level in whatsapp_utils.py
@@ -124,4 +128,5 @@ def send_whatsapp_image_message(to, caption, image_url):
             time.sleep(wait_time)
 
     logging.error(f"All {max_retries} attempts to send image to {clean_to} failed. URL: {image_url}")
+    record_error('whatsapp_send_image')
     return False